@@ -60,6 +60,16 @@ function parseXmlWithRegex(xmlData: string, filename: string, imagePath?: string
   }
 }
 
+// HARINAのエラーレスポンス（{"detail": "..."}）からメッセージを取り出す関数
+function harinaErrorDetail(errorText: string): string | undefined {
+  try {
+    const detail = JSON.parse(errorText)?.detail
+    return typeof detail === 'string' ? detail : undefined
+  } catch {
+    return undefined
+  }
+}
+
 // XMLデータをパースしてReceiptDataに変換する関数
 function parseXmlToReceiptData(xmlData: string, filename: string, imagePath?: string): Promise<ReceiptData> {
   return new Promise((resolve, reject) => {
@@ -173,6 +183,7 @@ export async function POST(request: NextRequest) {
     
     harinaFormData.append('model', harinaModel)
     harinaFormData.append('format', 'xml') // XMLフォーマットで取得
+    harinaFormData.append('uploader', uploader) // アップローダーごとの受付制御に使う
     if (additionalPrompt && additionalPrompt.trim().length > 0) {
       harinaFormData.append('instructions', additionalPrompt.trim())
     }
@@ -188,6 +199,21 @@ export async function POST(request: NextRequest) {
     if (!harinaResponse.ok) {
       const errorText = await harinaResponse.text()
       console.error('HARINA service error response:', errorText)
+      // サイズ超過はリトライしても同じ結果になるので、ダミーデータにせずそのまま返す
+      if (harinaResponse.status === 413) {
+        return NextResponse.json(
+          { error: harinaErrorDetail(errorText) || '画像ファイルが大きすぎます' },
+          { status: 413 }
+        )
+      }
+      // 受付制限（429）はダミーデータにせず、Retry-After とともにそのまま返して再送を促す
+      if (harinaResponse.status === 429) {
+        const retryAfter = harinaResponse.headers.get('Retry-After')
+        return NextResponse.json(
+          { error: harinaErrorDetail(errorText) || '混み合っているため受け付けられませんでした' },
+          { status: 429, headers: retryAfter ? { 'Retry-After': retryAfter } : undefined }
+        )
+      }
       throw new Error(`HARINA service error: ${harinaResponse.status} - ${errorText}`)
     }
 
@@ -197,6 +223,13 @@ export async function POST(request: NextRequest) {
     const keyType = typeof harinaResult.keyType === 'string' ? harinaResult.keyType : undefined
 
     // HARINA APIのレスポンス形式をチェック
+    // 画質チェックでの不合格は撮り直しが必要なので、障害と区別できるよう理由コード付きで返す
+    if (!harinaResult.success && typeof harinaResult.preflightReason === 'string') {
+      return NextResponse.json(
+        { error: harinaResult.error || '画像を読み取れませんでした', preflightReason: harinaResult.preflightReason },
+        { status: 422 }
+      )
+    }
     if (!harinaResult.success) {
       throw new Error(`HARINA processing failed: ${harinaResult.error || 'Unknown error'}`)
     }
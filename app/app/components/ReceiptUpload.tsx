@@ -75,6 +75,13 @@ export default function ReceiptUpload({ onReceiptProcessed, onUpload }: ReceiptU
     })
 
     if (!response.ok) {
+      // 画質チェックで弾かれた場合は障害ではないので、撮り直しを促す
+      if (response.status === 422) {
+        const body = await response.json().catch(() => null)
+        if (body?.preflightReason) {
+          throw new Error(`画像を読み取れませんでした。撮り直してください（${body.error}）`)
+        }
+      }
       throw new Error('レシート処理に失敗しました')
     }
 
@@ -0,0 +1,5 @@
+-- Perceptual image hashes (dHash) used by HARINA's duplicate index
+CREATE TABLE IF NOT EXISTS receipt_image_hashes (
+    receipt_id INTEGER PRIMARY KEY REFERENCES receipts(id) ON DELETE CASCADE,
+    dhash BIGINT NOT NULL
+);
@@ -0,0 +1,15 @@
+-- Hourly LLM token, latency and cost aggregates written by HARINA's usage tracker
+CREATE TABLE IF NOT EXISTS llm_usage (
+    bucket_start TIMESTAMPTZ NOT NULL,
+    model VARCHAR(100) NOT NULL,
+    key_label VARCHAR(20) NOT NULL,
+    uploader VARCHAR(50) NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+    completion_tokens BIGINT NOT NULL DEFAULT 0,
+    image_tokens BIGINT NOT NULL DEFAULT 0,
+    latency_ms_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+    cost_usd NUMERIC(12, 6) NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket_start, model, key_label, uploader)
+);
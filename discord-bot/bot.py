@@ -1,11 +1,44 @@
+import asyncio
+import contextlib
 import logging
 import os
-from typing import Optional, Dict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, AsyncContextManager, Callable, Optional, Dict, List, Tuple, Union
 
 import aiohttp
 import discord
 import discord.abc
 
+from http_client import (
+    APIError,
+    AttachmentFetchError,
+    CircuitBreaker,
+    CircuitOpenError,
+    RETRYABLE_STATUSES,
+    api_error,
+    backoff_delay,
+    counts_as_outage,
+    is_retryable,
+    server_retry_after,
+)
+from checkpoints import ChannelCursorStore
+from dedupe import DedupeIndex
+from image_tools import dhash, downscale_image
+from metrics import (
+    API_RETRIES,
+    ATTACHMENTS,
+    BUSY_WORKERS,
+    RETRY_QUEUE_DEPTH,
+    WORK_QUEUE_DEPTH,
+    start_metrics_server,
+    track_stage,
+)
+from retry_queue import FailedSubmission, RetryQueue
+from status import AttachmentStatus, EditRateLimiter, StatusBoard, patch_posted_status
+from work_queue import FairWorkQueue
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("receipt.discord.bot")
 
@@ -26,6 +59,51 @@ ALLOWED_CHANNEL_IDS = {
 }
 MAX_FILE_SIZE_MB = float(os.getenv("DISCORD_MAX_FILE_MB", "15"))
 MAX_FILE_BYTES = int(MAX_FILE_SIZE_MB * 1024 * 1024)
+ATTACHMENT_CHUNK_BYTES = 64 * 1024
+# 1メッセージ内で同時に処理する添付の上限と、ボット全体のワーカー数・待ち行列の長さ
+ATTACHMENT_CONCURRENCY = max(1, int(os.getenv("DISCORD_ATTACHMENT_CONCURRENCY", "3")))
+WORKER_COUNT = max(1, int(os.getenv("DISCORD_WORKER_COUNT", "4")))
+QUEUE_MAX_SIZE = max(0, int(os.getenv("DISCORD_QUEUE_MAX_SIZE", "100")))
+# レシートAPI向け HTTP クライアントの設定
+HTTP_POOL_LIMIT = int(os.getenv("DISCORD_HTTP_POOL_LIMIT", "20"))
+HTTP_POOL_PER_HOST = int(os.getenv("DISCORD_HTTP_POOL_PER_HOST", "8"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("DISCORD_HTTP_KEEPALIVE_SECONDS", "30"))
+API_TIMEOUT_SECONDS = float(os.getenv("DISCORD_API_TIMEOUT_SECONDS", "180"))
+API_READ_TIMEOUT_SECONDS = float(os.getenv("DISCORD_API_READ_TIMEOUT_SECONDS", "150"))
+API_MAX_RETRIES = max(0, int(os.getenv("DISCORD_API_MAX_RETRIES", "3")))
+API_RETRY_BASE_SECONDS = float(os.getenv("DISCORD_API_RETRY_BASE_SECONDS", "1"))
+API_RETRY_MAX_SECONDS = float(os.getenv("DISCORD_API_RETRY_MAX_SECONDS", "30"))
+BREAKER_FAILURE_THRESHOLD = max(1, int(os.getenv("DISCORD_BREAKER_THRESHOLD", "5")))
+BREAKER_RESET_SECONDS = float(os.getenv("DISCORD_BREAKER_RESET_SECONDS", "30"))
+# 0 より大きければ長辺をこのピクセル数まで縮小して JPEG で再エンコードしてから送信する
+RESIZE_MAX_EDGE = max(0, int(os.getenv("DISCORD_RESIZE_MAX_EDGE", "0")))
+RESIZE_JPEG_QUALITY = int(os.getenv("DISCORD_RESIZE_JPEG_QUALITY", "85"))
+IMAGE_WORKERS = max(1, int(os.getenv("DISCORD_IMAGE_WORKERS", "2")))
+# ボットのローカル状態（SQLite）を保存するディレクトリ
+STATE_DIR = os.getenv("DISCORD_STATE_DIR", "data")
+# 知覚ハッシュによる重複検知。ハミング距離がこの値以下なら同じレシートとみなす
+DEDUPE_ENABLED = os.getenv("DISCORD_DEDUPE_ENABLED", "1").lower() not in {"0", "false", "no"}
+DEDUPE_MAX_DISTANCE = int(os.getenv("DISCORD_DEDUPE_MAX_DISTANCE", "3"))
+DEDUPE_THUMBNAIL_EDGE = 256
+# 停止中に投稿されたメッセージの取りこぼし処理（同時処理数・1分あたりの開始数・最大件数）
+CATCH_UP_ENABLED = os.getenv("DISCORD_CATCH_UP_ENABLED", "1").lower() not in {"0", "false", "no"}
+CATCH_UP_CONCURRENCY = max(1, int(os.getenv("DISCORD_CATCH_UP_CONCURRENCY", "2")))
+CATCH_UP_RATE_PER_MINUTE = float(os.getenv("DISCORD_CATCH_UP_RATE_PER_MINUTE", "20"))
+CATCH_UP_MAX_MESSAGES = max(1, int(os.getenv("DISCORD_CATCH_UP_MAX_MESSAGES", "500")))
+CATCH_UP_PROGRESS_SECONDS = 15.0
+# API 停止中に失敗した送信をディスクに保持して復旧後に再送するキュー
+RETRY_QUEUE_MAX_ITEMS = max(1, int(os.getenv("DISCORD_RETRY_QUEUE_MAX_ITEMS", "200")))
+RETRY_QUEUE_MAX_AGE_SECONDS = float(os.getenv("DISCORD_RETRY_QUEUE_MAX_AGE_HOURS", "24")) * 3600
+RETRY_QUEUE_BASE_SECONDS = float(os.getenv("DISCORD_RETRY_QUEUE_BASE_SECONDS", "30"))
+RETRY_QUEUE_MAX_DELAY_SECONDS = float(os.getenv("DISCORD_RETRY_QUEUE_MAX_DELAY_SECONDS", "1800"))
+RETRY_QUEUE_POLL_SECONDS = 10.0
+# 進捗メッセージの編集間隔と、チャンネルごとの送信/編集レート（Discord は概ね 5 回 / 5 秒）
+STATUS_DEBOUNCE_SECONDS = float(os.getenv("DISCORD_STATUS_DEBOUNCE_SECONDS", "1.5"))
+STATUS_EDIT_RATE = max(1, int(os.getenv("DISCORD_STATUS_EDIT_RATE", "4")))
+STATUS_EDIT_PER_SECONDS = float(os.getenv("DISCORD_STATUS_EDIT_PER_SECONDS", "5"))
+# ステージ別レイテンシなどのメトリクスを公開するローカル HTTP エンドポイント（ポート 0 で無効）
+METRICS_HOST = os.getenv("DISCORD_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("DISCORD_METRICS_PORT", "9108"))
 
 
 def parse_channel_uploaders(raw_mapping: str) -> Dict[str, str]:
@@ -62,6 +140,11 @@ intents = discord.Intents.default()
 intents.message_content = True
 
 
+def retake_message(exc: APIError) -> str:
+    """Status text for a photo rejected by the quality check, which needs a new photo rather than a resend."""
+    return f"画像を読み取れませんでした。撮り直して投稿してください（{exc.preflight_reason}）"
+
+
 def build_result_message(payload: dict) -> str:
     lines = [
         "✅ レシート処理が完了しました",
@@ -124,28 +207,101 @@ def build_result_message(payload: dict) -> str:
     return "\n".join(lines)
 
 
+BodyFactory = Callable[[], AsyncContextManager[Any]]
+
+
+def stream_attachment(session: aiohttp.ClientSession, url: str) -> BodyFactory:
+    """Body factory that pipes the attachment from Discord's CDN into the upload without buffering it."""
+
+    @contextlib.asynccontextmanager
+    async def _open():
+        # 本文はアップロードと並行して流れるため、ここで計測できるのは CDN の応答ヘッダーまで
+        with track_stage("attachment_open"):
+            try:
+                resp = await session.get(url)
+            except aiohttp.ClientConnectorError as exc:
+                raise AttachmentFetchError(str(exc), retryable=True) from exc
+            except aiohttp.ClientError as exc:
+                raise AttachmentFetchError(str(exc)) from exc
+            if resp.status >= 400:
+                resp.release()
+                raise AttachmentFetchError(f"CDN {resp.status}", retryable=resp.status in RETRYABLE_STATUSES)
+        async with resp:
+            yield _relay_attachment(resp.content)
+
+    return _open
+
+
+async def _relay_attachment(content: aiohttp.StreamReader):
+    # 送信途中で CDN 側が切れた場合も API の障害と区別できるようにする
+    try:
+        async for chunk in content.iter_chunked(ATTACHMENT_CHUNK_BYTES):
+            yield chunk
+    except aiohttp.ClientError as exc:
+        raise AttachmentFetchError(str(exc)) from exc
+
+
 async def send_receipt_to_api(
     session: aiohttp.ClientSession,
-    file_bytes: bytes,
+    body: Union[bytes, BodyFactory],
     filename: str,
     content_type: Optional[str] = None,
     uploader: Optional[str] = None,
+    breaker: Optional[CircuitBreaker] = None,
 ) -> dict:
-    form = aiohttp.FormData()
-    form.add_field(
-        name="file",
-        value=file_bytes,
-        filename=filename,
-        content_type=content_type or "application/octet-stream",
+    open_body: BodyFactory = (
+        (lambda: contextlib.nullcontext(body)) if isinstance(body, bytes) else body
     )
-    form.add_field("model", DEFAULT_MODEL)
-    form.add_field("uploader", uploader or DEFAULT_UPLOADER)
+    attempt = 0
+    while True:
+        if breaker:
+            await breaker.before_call()
+
+        try:
+            # FormData もストリームも一度送信すると再利用できないため試行ごとに組み立てる
+            with track_stage("api_request"):
+                async with open_body() as file_value:
+                    form = aiohttp.FormData()
+                    form.add_field(
+                        name="file",
+                        value=file_value,
+                        filename=filename,
+                        content_type=content_type or "application/octet-stream",
+                    )
+                    form.add_field("model", DEFAULT_MODEL)
+                    form.add_field("uploader", uploader or DEFAULT_UPLOADER)
+
+                    async with session.post(RECEIPT_API_URL, data=form) as resp:
+                        if resp.status >= 400:
+                            text = await resp.text()
+                            raise api_error(resp.status, text, resp.headers.get("Retry-After"))
+                        payload = await resp.json()
+        except Exception as exc:  # pylint: disable=broad-except
+            if breaker:
+                if counts_as_outage(exc):
+                    await breaker.record_failure()
+                else:
+                    # 不正なリクエストや CDN の失敗は API の復旧を示さないため、ブレーカーは閉じない
+                    await breaker.release_probe()
+            if attempt >= API_MAX_RETRIES or not is_retryable(exc):
+                raise
+            requested = server_retry_after(exc)
+            if requested is not None and requested > API_RETRY_MAX_SECONDS:
+                # 長く待つよう指示された場合はワーカーを占有せず、呼び出し元の再試行キューに任せる
+                raise
+            if requested is None:
+                delay = backoff_delay(attempt, API_RETRY_BASE_SECONDS, API_RETRY_MAX_SECONDS)
+            else:
+                delay = requested
+            attempt += 1
+            API_RETRIES.inc()
+            logger.warning("API送信に失敗したため %.1f 秒後に再試行します (%d/%d): %s", delay, attempt, API_MAX_RETRIES, exc)
+            await asyncio.sleep(delay)
+            continue
 
-    async with session.post(RECEIPT_API_URL, data=form) as resp:
-        if resp.status >= 400:
-            text = await resp.text()
-            raise RuntimeError(f"APIエラー: {resp.status} {text}")
-        return await resp.json()
+        if breaker:
+            await breaker.record_success()
+        return payload
 
 
 class ResponseThread(discord.abc.Messageable):
@@ -162,7 +318,8 @@ class ResponseThread(discord.abc.Messageable):
     async def close(self) -> None:
         if self.thread and not self.thread.locked:
             try:
-                await self.thread.edit(locked=True, archived=True)
+                with track_stage("thread_close"):
+                    await self.thread.edit(locked=True, archived=True)
             except discord.HTTPException as exc:
                 logger.warning("スレッドのクローズに失敗しました: %s", exc)
 
@@ -176,7 +333,8 @@ async def ensure_response_thread(message: discord.Message) -> ResponseThread:
     if isinstance(channel, discord.TextChannel):
         thread_name = f"receipt-{message.id}"
         try:
-            thread = await message.create_thread(name=thread_name, auto_archive_duration=60)
+            with track_stage("thread_create"):
+                thread = await message.create_thread(name=thread_name, auto_archive_duration=60)
             return ResponseThread(thread, thread)
         except discord.HTTPException as exc:
             logger.warning("スレッド作成に失敗しました: %s", exc)
@@ -185,22 +343,120 @@ async def ensure_response_thread(message: discord.Message) -> ResponseThread:
     return ResponseThread(channel)
 
 
+@dataclass
+class AttachmentJob:
+    message: discord.Message
+    attachment: discord.Attachment
+    uploader: Optional[str]
+    board: StatusBoard
+    retry_queued: bool = False
+    done: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+def _image_attachments(message: discord.Message) -> List[discord.Attachment]:
+    return [
+        att
+        for att in message.attachments
+        if (att.content_type and att.content_type.startswith("image/"))
+        or att.filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"))
+    ]
+
+
+def _attachment_size(attachment: discord.Attachment) -> Optional[Tuple[int, int]]:
+    # Discord が添付のメタデータとして返す元画像の寸法（取得できない場合は完全一致のみで重複判定）
+    if attachment.width and attachment.height:
+        return attachment.width, attachment.height
+    return None
+
+
 class ReceiptBot(discord.Client):
     def __init__(self, **options):
         super().__init__(**options)
         self.http_session: Optional[aiohttp.ClientSession] = None
+        self.api_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+        self.work_queue: FairWorkQueue[AttachmentJob] = FairWorkQueue(QUEUE_MAX_SIZE)
+        self._workers: List[asyncio.Task] = []
+        self._busy_workers = 0
+        self.dedupe_index: Optional[DedupeIndex] = None
+        self.cursors: Optional[ChannelCursorStore] = None
+        self.retry_queue: Optional[RetryQueue] = None
+        self._retry_task: Optional[asyncio.Task] = None
+        self._catch_up_task: Optional[asyncio.Task] = None
+        self._catch_up_cursors: Dict[int, int] = {}
+        self._metrics_runner = None
+        self.edit_limiter = EditRateLimiter(STATUS_EDIT_RATE, STATUS_EDIT_PER_SECONDS)
+        self.image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="receipt-image")
 
     async def setup_hook(self) -> None:
-        self.http_session = aiohttp.ClientSession()
-        logger.info("Discord bot is ready. Waiting for attachments...")
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=API_TIMEOUT_SECONDS,
+            sock_connect=10,
+            sock_read=API_READ_TIMEOUT_SECONDS,
+        )
+        self.http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        os.makedirs(STATE_DIR, exist_ok=True)
+        self.cursors = await asyncio.to_thread(ChannelCursorStore, os.path.join(STATE_DIR, "cursors.sqlite3"))
+        # ゲートウェイ接続前に位置を控えておく。on_ready より先に届いた新着でカーソルが進んでも取りこぼさない
+        self._catch_up_cursors = self.cursors.channels()
+        self.retry_queue = await asyncio.to_thread(
+            RetryQueue,
+            os.path.join(STATE_DIR, "retry_queue.sqlite3"),
+            RETRY_QUEUE_MAX_ITEMS,
+            RETRY_QUEUE_MAX_AGE_SECONDS,
+        )
+        pending = await asyncio.to_thread(len, self.retry_queue)
+        if pending:
+            logger.info("再試行キューに %d 件の送信が残っています", pending)
+        self._retry_task = asyncio.create_task(self._drain_retry_queue(), name="receipt-retry-queue")
+        WORK_QUEUE_DEPTH.set_function(self.work_queue.qsize)
+        BUSY_WORKERS.set_function(lambda: self._busy_workers)
+        RETRY_QUEUE_DEPTH.set_function(lambda: len(self.retry_queue))
+        if METRICS_PORT > 0:
+            try:
+                self._metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+            except OSError as exc:
+                logger.warning("メトリクスエンドポイントを起動できませんでした: %s", exc)
+        if DEDUPE_ENABLED:
+            self.dedupe_index = await asyncio.to_thread(
+                DedupeIndex, os.path.join(STATE_DIR, "dedupe.sqlite3")
+            )
+            logger.info("重複検知インデックスを読み込みました (%d 件)", len(self.dedupe_index))
+        self._workers = [
+            asyncio.create_task(self._worker(index), name=f"receipt-worker-{index}")
+            for index in range(WORKER_COUNT)
+        ]
+        logger.info("Discord bot is ready with %d workers. Waiting for attachments...", WORKER_COUNT)
 
     async def close(self) -> None:
+        for task in (self._catch_up_task, self._retry_task):
+            if task:
+                task.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
         if self.http_session and not self.http_session.closed:
             await self.http_session.close()
+        self.image_executor.shutdown(wait=False, cancel_futures=True)
+        if self.dedupe_index:
+            self.dedupe_index.close()
+        if self.cursors:
+            self.cursors.close()
+        if self.retry_queue:
+            self.retry_queue.close()
         await super().close()
 
     async def on_ready(self):
         logger.info("Logged in as %s (ID: %s)", self.user, self.user.id)
+        # on_ready は再接続のたびに呼ばれるので、取りこぼし処理は起動時に一度だけ行う
+        if CATCH_UP_ENABLED and self._catch_up_task is None:
+            self._catch_up_task = asyncio.create_task(self._catch_up(), name="receipt-catch-up")
 
     async def on_message(self, message: discord.Message):
         if message.author.bot:
@@ -209,14 +465,104 @@ class ReceiptBot(discord.Client):
         if ALLOWED_CHANNEL_IDS and message.channel.id not in ALLOWED_CHANNEL_IDS:
             return
 
+        try:
+            await self._handle_message(message)
+        finally:
+            if self.cursors:
+                await asyncio.to_thread(self.cursors.advance, message.channel.id, message.id)
+
+    async def _catch_up(self) -> None:
+        channel_ids = set(ALLOWED_CHANNEL_IDS) or set(self._catch_up_cursors)
+        for channel_id in sorted(channel_ids):
+            try:
+                await self._catch_up_channel(channel_id, self._catch_up_cursors.get(channel_id, 0))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("チャンネル %s の取りこぼし処理に失敗しました", channel_id)
+
+    async def _catch_up_channel(self, channel_id: int, last_id: int) -> None:
+        channel = self.get_channel(channel_id) or await self.fetch_channel(channel_id)
+        if not last_id:
+            # 初回起動時は過去ログを遡らず、現在位置から記録を始める
+            if getattr(channel, "last_message_id", None):
+                await asyncio.to_thread(self.cursors.advance, channel_id, channel.last_message_id)
+            return
+
+        missed = []
+        last_seen_id = last_id
+        scanned = 0
+        async for message in channel.history(
+            after=discord.Object(id=last_id), oldest_first=True, limit=CATCH_UP_MAX_MESSAGES
+        ):
+            scanned += 1
+            last_seen_id = message.id
+            if not message.author.bot and _image_attachments(message):
+                missed.append(message)
+
+        # 上限まで読んだ場合は続きが残っているので、次回起動時は読み終えた位置から再開する
+        resume_id = last_seen_id if scanned >= CATCH_UP_MAX_MESSAGES else None
+
+        if not missed:
+            await asyncio.to_thread(self.cursors.advance, channel_id, last_seen_id)
+            await self._settle_catch_up(channel_id, resume_id)
+            return
+
+        # 処理し終えるまでは、途中で停止しても次回起動時にここから再処理する
+        await asyncio.to_thread(self.cursors.hold, channel_id, last_id)
+
+        logger.info("チャンネル %s で未処理のメッセージが %d 件見つかりました", channel_id, len(missed))
+        await self.edit_limiter.acquire(channel_id)
+        summary = await channel.send(f"📥 停止中に投稿された {len(missed)} 件のメッセージを処理します…")
+
+        semaphore = asyncio.Semaphore(CATCH_UP_CONCURRENCY)
+        interval = 60.0 / CATCH_UP_RATE_PER_MINUTE if CATCH_UP_RATE_PER_MINUTE > 0 else 0.0
+        processed = 0
+        failed_ids: List[int] = []
+        last_progress = time.monotonic()
+
+        async def replay(message: discord.Message) -> None:
+            nonlocal processed, last_progress
+            try:
+                await self._handle_message(message)
+            except Exception:  # pylint: disable=broad-except
+                failed_ids.append(message.id)
+                logger.exception("取りこぼしメッセージ %s の処理に失敗しました", message.id)
+            finally:
+                processed += 1
+                semaphore.release()
+            if time.monotonic() - last_progress >= CATCH_UP_PROGRESS_SECONDS and processed < len(missed):
+                last_progress = time.monotonic()
+                await self.edit_limiter.acquire(channel_id)
+                await summary.edit(content=f"📥 取りこぼし処理中… {processed}/{len(missed)} 件")
+
+        tasks = []
+        for index, message in enumerate(missed):
+            await semaphore.acquire()
+            if index and interval:
+                await asyncio.sleep(interval)
+            tasks.append(asyncio.create_task(replay(message)))
+        await asyncio.gather(*tasks)
+
+        # 失敗したメッセージがあれば、次回起動時にその直前から再処理する（成功分は重複検知で弾かれる）
+        await asyncio.to_thread(self.cursors.advance, channel_id, last_seen_id)
+        await self._settle_catch_up(channel_id, min(failed_ids) - 1 if failed_ids else resume_id)
+        failed = len(failed_ids)
+        await self.edit_limiter.acquire(channel_id)
+        await summary.edit(
+            content=f"✅ 取りこぼし処理が完了しました: {processed} 件中 {processed - failed} 件成功"
+            + (f" / {failed} 件失敗" if failed else "")
+        )
+
+    async def _settle_catch_up(self, channel_id: int, resume_id: Optional[int]) -> None:
+        """Hold the next startup's replay at ``resume_id``, or drop the hold when nothing is left."""
+        if resume_id is not None:
+            await asyncio.to_thread(self.cursors.hold, channel_id, resume_id)
+        else:
+            await asyncio.to_thread(self.cursors.release, channel_id)
+
+    async def _handle_message(self, message: discord.Message) -> None:
         uploader_override = self._resolve_uploader(message)
 
-        image_attachments = [
-            att
-            for att in message.attachments
-            if (att.content_type and att.content_type.startswith("image/"))
-            or att.filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"))
-        ]
+        image_attachments = _image_attachments(message)
 
         if not image_attachments:
             return
@@ -226,37 +572,307 @@ class ReceiptBot(discord.Client):
             return
 
         response_channel = await ensure_response_thread(message)
+        board = StatusBoard(
+            response_channel,
+            getattr(response_channel.channel, "id", message.channel.id),
+            self.edit_limiter,
+            STATUS_DEBOUNCE_SECONDS,
+        )
+        accepted = []
         for attachment in image_attachments:
             if attachment.size and attachment.size > MAX_FILE_BYTES:
-                await response_channel.send(
-                    f"⚠️ `{attachment.filename}` は大きすぎます (最大 {MAX_FILE_SIZE_MB}MB まで)。"
+                board.add(
+                    str(attachment.id),
+                    attachment.filename,
+                    "skipped",
+                    f"大きすぎます (最大 {MAX_FILE_SIZE_MB}MB まで)",
                 )
-                continue
-
-            status_msg = await response_channel.send(
-                f"📸 `{attachment.filename}` を処理しています…"
+            else:
+                board.add(str(attachment.id), attachment.filename, "queued", "待機中…")
+                accepted.append(attachment)
+        await board.start()
+
+        semaphore = asyncio.Semaphore(ATTACHMENT_CONCURRENCY)
+
+        jobs = [AttachmentJob(message, attachment, uploader_override, board) for attachment in accepted]
+
+        async def handle(job: AttachmentJob) -> None:
+            async with semaphore:
+                await self._submit(message.channel.id, job)
+
+        await asyncio.gather(*(handle(job) for job in jobs))
+        await board.finish()
+        # 再試行待ちがある場合は、再送結果を書き込めるようにスレッドを開いたままにする
+        if not any(job.retry_queued for job in jobs):
+            await response_channel.close()
+
+    async def _submit(self, channel_id: int, job: AttachmentJob) -> None:
+        # 空きワーカーがなければ API を叩かずに待ち順だけ知らせる
+        if self._busy_workers >= WORKER_COUNT or self.work_queue.full():
+            job.board.update(
+                str(job.attachment.id),
+                "queued",
+                f"順番待ちです（待ち {self.work_queue.qsize() + 1} 件目）",
             )
+        await self.work_queue.put(channel_id, job)
+        await job.done
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await self.work_queue.get()
+            self._busy_workers += 1
+            try:
+                await self._process_attachment(job)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("ワーカー %d で予期しないエラーが発生しました", index)
+            finally:
+                self._busy_workers -= 1
+                if not job.done.done():
+                    job.done.set_result(None)
+
+    async def _process_attachment(self, job: AttachmentJob) -> None:
+        attachment = job.attachment
+        key = str(attachment.id)
+        try:
+            job.board.update(key, "processing", "処理しています…")
+            state, detail = await self._run_pipeline(attachment, job.uploader, job.message.channel.id)
+        except Exception as exc:  # pylint: disable=broad-except
+            # 再送しても二重登録にならない失敗だけを再試行キューに回す
+            if isinstance(exc, CircuitOpenError) or is_retryable(exc):
+                logger.warning("一時的に送信できないため再試行キューに登録します: %s (%s)", attachment.filename, exc)
+                state, detail = await self._enqueue_retry(job, exc)
+            elif isinstance(exc, APIError) and exc.preflight_reason:
+                logger.info("画質チェックで不合格になりました: %s (%s)", attachment.filename, exc.preflight_reason)
+                state, detail = "skipped", retake_message(exc)
+            else:
+                logger.exception("画像処理に失敗しました")
+                state, detail = "error", f"処理に失敗しました: {exc}"
+        ATTACHMENTS.inc(state=state)
+        job.board.update(key, state, detail)
+
+    async def _run_pipeline(
+        self, attachment: discord.Attachment, uploader: Optional[str], channel_id: int
+    ) -> Tuple[str, str]:
+        """Dedupe, upload and record one attachment; returns the (state, detail) to show."""
+        if attachment.size == 0:
+            raise RuntimeError("添付ファイルの内容が空でした")
+
+        # 縮小する場合は全体が必要なので先に読み込み、ハッシュ計算にも使い回す
+        file_bytes = await self._download(attachment) if RESIZE_MAX_EDGE > 0 else None
+        image_hash = await self._image_hash(attachment, file_bytes)
+        image_size = _attachment_size(attachment)
+        if image_hash is not None and self.dedupe_index:
+            match = self.dedupe_index.find(image_hash, DEDUPE_MAX_DISTANCE, image_size)
+            if match:
+                logger.info(
+                    "重複画像のため送信をスキップしました %s -> receipt %d (distance=%d, size=%s)",
+                    attachment.filename,
+                    match.receipt_id,
+                    match.distance,
+                    image_size,
+                )
+                receipt_url = build_receipt_url(match.receipt_id)
+                return (
+                    "duplicate",
+                    "同じレシートは登録済みです\n"
+                    + (f"🔗 {receipt_url}" if receipt_url else f"レシートID: {match.receipt_id}"),
+                )
 
+        body, filename, content_type = await self._prepare_upload(attachment, file_bytes)
+        result = await send_receipt_to_api(
+            self.http_session,
+            body,
+            filename,
+            content_type,
+            uploader,
+            breaker=self.api_breaker,
+        )
+        await self._remember_hash(image_hash, result.get("id"), channel_id, attachment.id, image_size)
+        return "done", build_result_message(result)
+
+    async def _enqueue_retry(self, job: AttachmentJob, exc: Exception) -> Tuple[str, str]:
+        status_message = job.board.message
+        delay = max(self.api_breaker.retry_in() or RETRY_QUEUE_BASE_SECONDS, server_retry_after(exc) or 0.0)
+        accepted = await asyncio.to_thread(
+            self.retry_queue.push,
+            job.message.channel.id,
+            job.message.id,
+            job.attachment.id,
+            job.attachment.filename,
+            job.uploader,
+            status_message.channel.id if status_message else None,
+            status_message.id if status_message else None,
+            job.board.index_of(str(job.attachment.id)),
+            str(exc),
+            delay,
+        )
+        if not accepted:
+            return "error", f"一時的に送信できず、再試行キューも満杯のため処理できませんでした: {exc}"
+        job.retry_queued = True
+        return "retrying", f"一時的に送信できないため、復旧後に自動で再送します（{exc}）"
+
+    async def _drain_retry_queue(self) -> None:
+        while True:
+            await asyncio.sleep(RETRY_QUEUE_POLL_SECONDS)
             try:
-                file_bytes = await attachment.read()
-                if not file_bytes:
-                    raise RuntimeError("添付ファイルの内容が空でした")
+                for entry in await asyncio.to_thread(self.retry_queue.pop_expired):
+                    await self._patch_status(
+                        entry, "error", "再送の期限を過ぎたため処理を中止しました。もう一度投稿してください"
+                    )
+                if self.api_breaker.state == "open":
+                    continue
+                for entry in await asyncio.to_thread(self.retry_queue.due, 10):
+                    if not await self._retry_submission(entry):
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("再試行キューの処理中にエラーが発生しました")
+
+    async def _retry_submission(self, entry: FailedSubmission) -> bool:
+        """Retry one queued submission; returns False when the API still looks down."""
+        try:
+            channel = self.get_channel(entry.channel_id) or await self.fetch_channel(entry.channel_id)
+            message = await channel.fetch_message(entry.message_id)
+        except discord.NotFound:
+            await asyncio.to_thread(self.retry_queue.remove, entry.id)
+            return True
+        except discord.HTTPException as exc:
+            # Discord 側の一時的な失敗はこのエントリだけ後回しにし、残りの再送は続ける
+            await self._reschedule(entry, exc)
+            return True
+        attachment = next((att for att in message.attachments if att.id == entry.attachment_id), None)
+        if attachment is None:
+            await asyncio.to_thread(self.retry_queue.remove, entry.id)
+            return True
 
-                content_type = attachment.content_type
-                result = await send_receipt_to_api(
-                    self.http_session,
+        try:
+            state, detail = await self._run_pipeline(attachment, entry.uploader, entry.channel_id)
+        except Exception as exc:  # pylint: disable=broad-except
+            if isinstance(exc, CircuitOpenError) or is_retryable(exc):
+                await self._reschedule(entry, exc)
+                # API がまだ停止しているなら、残りのエントリも今は送らない
+                return not (isinstance(exc, CircuitOpenError) or counts_as_outage(exc))
+            if isinstance(exc, APIError) and exc.preflight_reason:
+                state, detail = "skipped", retake_message(exc)
+            else:
+                logger.exception("再送した画像の処理に失敗しました")
+                state, detail = "error", f"処理に失敗しました: {exc}"
+
+        await asyncio.to_thread(self.retry_queue.remove, entry.id)
+        ATTACHMENTS.inc(state=state)
+        logger.info("再試行キューから再送しました: %s", entry.filename)
+        await self._patch_status(entry, state, detail)
+        return True
+
+    async def _reschedule(self, entry: FailedSubmission, exc: Exception) -> None:
+        attempts = entry.attempts + 1
+        delay = min(RETRY_QUEUE_MAX_DELAY_SECONDS, RETRY_QUEUE_BASE_SECONDS * (2 ** attempts))
+        # サーバーが Retry-After で指定した時間より前には送らない
+        delay = max(delay, server_retry_after(exc) or 0.0)
+        await asyncio.to_thread(self.retry_queue.reschedule, entry.id, attempts, delay, str(exc))
+        logger.warning("再送に失敗しました (%s, %d 回目)。%.0f 秒後に再試行します", entry.filename, attempts, delay)
+
+    async def _patch_status(self, entry: FailedSubmission, state: str, detail: str) -> None:
+        if entry.status_channel_id is None or entry.status_message_id is None or entry.status_field_index is None:
+            return
+        try:
+            channel = self.get_channel(entry.status_channel_id) or await self.fetch_channel(entry.status_channel_id)
+            status_message = await channel.fetch_message(entry.status_message_id)
+            await patch_posted_status(
+                status_message,
+                entry.status_field_index,
+                AttachmentStatus(entry.filename, state, detail),
+                self.edit_limiter,
+                entry.status_channel_id,
+            )
+            remaining = await asyncio.to_thread(self.retry_queue.pending_for_status, entry.status_message_id)
+            if remaining == 0 and isinstance(channel, discord.Thread):
+                await ResponseThread(channel, channel).close()
+        except discord.HTTPException as exc:
+            logger.warning("ステータスメッセージを更新できませんでした: %s", exc)
+
+    async def _image_hash(self, attachment: discord.Attachment, file_bytes: Optional[bytes]) -> Optional[int]:
+        """dHash of the attachment, from the bytes if we have them or else a small CDN thumbnail."""
+        if not self.dedupe_index:
+            return None
+        data = file_bytes
+        try:
+            if data is None:
+                separator = "&" if "?" in attachment.proxy_url else "?"
+                thumbnail_url = (
+                    f"{attachment.proxy_url}{separator}width={DEDUPE_THUMBNAIL_EDGE}&height={DEDUPE_THUMBNAIL_EDGE}"
+                )
+                with track_stage("thumbnail_download"):
+                    async with self.http_session.get(thumbnail_url) as resp:
+                        resp.raise_for_status()
+                        data = await resp.read()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.image_executor, dhash, data)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("知覚ハッシュを計算できませんでした (%s): %s", attachment.filename, exc)
+            return None
+
+    async def _remember_hash(
+        self,
+        image_hash: Optional[int],
+        receipt_id: object,
+        channel_id: int,
+        attachment_id: int,
+        image_size: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        if image_hash is None or not self.dedupe_index:
+            return
+        try:
+            receipt_id_int = int(receipt_id)  # type: ignore[arg-type]
+        except (TypeError, ValueError):
+            return
+        await asyncio.to_thread(
+            self.dedupe_index.add,
+            image_hash,
+            receipt_id_int,
+            channel_id,
+            attachment_id,
+            image_size,
+        )
+
+    @staticmethod
+    async def _download(attachment: discord.Attachment) -> bytes:
+        with track_stage("attachment_download"):
+            return await attachment.read()
+
+    async def _prepare_upload(self, attachment: discord.Attachment, file_bytes: Optional[bytes] = None):
+        """Return (body, filename, content_type), streaming from the CDN unless resizing is enabled."""
+        content_type = attachment.content_type or "application/octet-stream"
+        if RESIZE_MAX_EDGE <= 0:
+            return stream_attachment(self.http_session, attachment.url), attachment.filename, content_type
+
+        # 縮小にはデコードが必要なので全体を読み込み、CPU 処理はスレッドプールで行う
+        if file_bytes is None:
+            file_bytes = await self._download(attachment)
+        if not file_bytes:
+            raise RuntimeError("添付ファイルの内容が空でした")
+        loop = asyncio.get_running_loop()
+        try:
+            with track_stage("image_resize"):
+                prepared = await loop.run_in_executor(
+                    self.image_executor,
+                    downscale_image,
                     file_bytes,
                     attachment.filename,
                     content_type,
-                    uploader_override,
+                    RESIZE_MAX_EDGE,
+                    RESIZE_JPEG_QUALITY,
                 )
-                response_msg = build_result_message(result)
-                await status_msg.edit(content=response_msg)
-            except Exception as exc:  # pylint: disable=broad-except
-                logger.exception("画像処理に失敗しました")
-                await status_msg.edit(content=f"❌ `{attachment.filename}` の処理に失敗しました: {exc}")
-
-        await response_channel.close()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("画像の縮小に失敗したため元の画像を送信します (%s): %s", attachment.filename, exc)
+            return file_bytes, attachment.filename, content_type
+        if len(prepared.data) < len(file_bytes):
+            logger.info(
+                "画像を縮小しました %s: %d -> %d bytes", attachment.filename, len(file_bytes), len(prepared.data)
+            )
+            return prepared.data, prepared.filename, prepared.content_type
+        return file_bytes, attachment.filename, content_type
 
     def _resolve_uploader(self, message: discord.Message) -> Optional[str]:
         channel_name = None
@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+from typing import Dict
+
+
+class ChannelCursorStore:
+    """Last processed message id per channel, persisted so missed messages can be replayed on startup."""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS channel_cursors (
+                    channel_id INTEGER PRIMARY KEY,
+                    last_message_id INTEGER NOT NULL
+                )
+                """
+            )
+            # 取りこぼし処理が終わっていない（または失敗した）位置。次回起動時はここから再処理する
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS channel_replay_holds (
+                    channel_id INTEGER PRIMARY KEY,
+                    message_id INTEGER NOT NULL
+                )
+                """
+            )
+            rows = self._conn.execute("SELECT channel_id, last_message_id FROM channel_cursors").fetchall()
+            holds = self._conn.execute("SELECT channel_id, message_id FROM channel_replay_holds").fetchall()
+        self._cursors: Dict[int, int] = dict(rows)
+        self._holds: Dict[int, int] = dict(holds)
+
+    def get(self, channel_id: int) -> int:
+        """Where the next catch-up should start: the held position while a replay is unfinished."""
+        cursor = self._cursors.get(channel_id, 0)
+        held = self._holds.get(channel_id)
+        return cursor if held is None else min(cursor, held)
+
+    def channels(self) -> Dict[int, int]:
+        return {channel_id: self.get(channel_id) for channel_id in set(self._cursors) | set(self._holds)}
+
+    def hold(self, channel_id: int, message_id: int) -> None:
+        """Replay from ``message_id`` on later startups, however far live messages move the cursor."""
+        if self._holds.get(channel_id) == message_id:
+            return
+        self._holds[channel_id] = message_id
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO channel_replay_holds (channel_id, message_id) VALUES (?, ?) "
+                "ON CONFLICT (channel_id) DO UPDATE SET message_id = excluded.message_id",
+                (channel_id, message_id),
+            )
+
+    def release(self, channel_id: int) -> None:
+        if self._holds.pop(channel_id, None) is None:
+            return
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM channel_replay_holds WHERE channel_id = ?", (channel_id,))
+
+    def advance(self, channel_id: int, message_id: int) -> None:
+        # Discord のメッセージIDは時系列順なので、大きい方だけを残す
+        if message_id <= self._cursors.get(channel_id, 0):
+            return
+        self._cursors[channel_id] = message_id
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO channel_cursors (channel_id, last_message_id) VALUES (?, ?) "
+                "ON CONFLICT (channel_id) DO UPDATE SET last_message_id = MAX(last_message_id, excluded.last_message_id)",
+                (channel_id, message_id),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
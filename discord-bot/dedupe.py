@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+_SIGN_BIT = 1 << 63
+
+
+def _to_signed(value: int) -> int:
+    # SQLite の INTEGER は符号付き 64bit
+    return value - (1 << 64) if value & _SIGN_BIT else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+@dataclass(frozen=True)
+class DedupeMatch:
+    receipt_id: int
+    distance: int
+
+
+Size = Optional[Tuple[int, int]]
+
+
+class DedupeIndex:
+    """Perceptual hashes of processed attachments mapped to the receipt they produced.
+
+    Hashes are kept in memory for lookups (a linear XOR/popcount scan handles tens of
+    thousands of receipts in a few milliseconds) and persisted to SQLite.
+
+    Only an identical hash counts as a duplicate on its own. Receipts printed from
+    the same template can hash a few bits apart, so a near match also needs the
+    original image to have the same width and height.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS image_hashes (
+                    image_hash INTEGER NOT NULL,
+                    receipt_id INTEGER NOT NULL,
+                    channel_id INTEGER,
+                    message_id INTEGER,
+                    created_at REAL NOT NULL,
+                    width INTEGER,
+                    height INTEGER
+                )
+                """
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(image_hashes)")}
+            # 寸法を保存する前に作られたデータベースには列を追加する（既存の行は完全一致のみで判定）
+            for column in ("width", "height"):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE image_hashes ADD COLUMN {column} INTEGER")
+            rows = self._conn.execute("SELECT image_hash, receipt_id, width, height FROM image_hashes").fetchall()
+        self._entries: List[Tuple[int, int, Size]] = [
+            (_to_unsigned(h), rid, (w, ht) if w and ht else None) for h, rid, w, ht in rows
+        ]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def find(self, image_hash: int, max_distance: int, size: Size = None) -> Optional[DedupeMatch]:
+        best: Optional[DedupeMatch] = None
+        for known_hash, receipt_id, known_size in self._entries:
+            distance = (known_hash ^ image_hash).bit_count()
+            if distance > max_distance or (best is not None and distance >= best.distance):
+                continue
+            if distance > 0 and (size is None or known_size != size):
+                continue
+            best = DedupeMatch(receipt_id, distance)
+            if distance == 0:
+                break
+        return best
+
+    def add(
+        self,
+        image_hash: int,
+        receipt_id: int,
+        channel_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+        size: Size = None,
+    ) -> None:
+        width, height = size or (None, None)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO image_hashes (image_hash, receipt_id, channel_id, message_id, created_at, width, height) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (_to_signed(image_hash), receipt_id, channel_id, message_id, time.time(), width, height),
+            )
+        self._entries.append((image_hash, receipt_id, size))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
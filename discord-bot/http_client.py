@@ -0,0 +1,176 @@
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import aiohttp
+
+# 502/503/504 はアプリ再起動中などでリクエストが処理されていないことが多く、429 は明示的な再送要求
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+
+class APIError(RuntimeError):
+    def __init__(
+        self,
+        status: int,
+        text: str,
+        preflight_reason: Optional[str] = None,
+        retry_after: Optional[float] = None,
+    ):
+        super().__init__(f"APIエラー: {status} {text}")
+        self.status = status
+        # 画質チェックで弾かれた場合の理由コード（撮り直しが必要で、再送しても結果は変わらない）
+        self.preflight_reason = preflight_reason
+        # 429 などでサーバーが指定した再送までの待ち時間（秒）
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a ``Retry-After`` header (delta-seconds or HTTP date); None when absent or unparseable."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def api_error(status: int, text: str, retry_after: Optional[str] = None) -> APIError:
+    """Build an :class:`APIError`, picking up ``preflightReason`` from a 422 JSON body and the ``Retry-After`` header."""
+    reason = None
+    if status == 422:
+        try:
+            payload = json.loads(text)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and isinstance(payload.get("preflightReason"), str):
+            reason = payload["preflightReason"]
+            text = payload.get("error") or text
+    return APIError(status, text, reason, parse_retry_after(retry_after))
+
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, retry_in: float):
+        super().__init__(f"レシートAPIが停止中のため送信を見合わせています（約{int(retry_in) + 1}秒後に再開）")
+        self.retry_in = retry_in
+
+
+class AttachmentFetchError(RuntimeError):
+    """Downloading the attachment from Discord's CDN failed; says nothing about the receipt API."""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(f"添付ファイルの取得に失敗しました: {message}")
+        self.retryable = retryable
+
+
+def _attachment_failure(exc: BaseException) -> Optional[AttachmentFetchError]:
+    # aiohttp は本文の送信中に起きた例外を ClientConnectionError で包むため、原因をたどる
+    while exc is not None:
+        if isinstance(exc, AttachmentFetchError):
+            return exc
+        exc = exc.__cause__
+    return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Only failures where the request certainly did not create a receipt are retried.
+
+    A connection that could not be opened, or an attachment that could not be
+    fetched before the upload started, never sent anything to the app. A dropped
+    connection, a read timeout or a 500 may come after the receipt was already
+    saved, so those are surfaced instead of duplicated.
+    """
+    if isinstance(exc, APIError):
+        return exc.status in RETRYABLE_STATUSES
+    attachment_failure = _attachment_failure(exc)
+    if attachment_failure is not None:
+        return attachment_failure.retryable
+    return isinstance(exc, aiohttp.ClientConnectorError)
+
+
+def counts_as_outage(exc: BaseException) -> bool:
+    """Failures that say the receipt API itself is unhealthy (as opposed to a bad request or a slow OCR run).
+
+    CDN errors are raised as :class:`AttachmentFetchError` and never count.
+    """
+    if isinstance(exc, APIError):
+        return exc.status in RETRYABLE_STATUSES
+    if _attachment_failure(exc) is not None:
+        return False
+    return isinstance(exc, aiohttp.ClientConnectionError)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def server_retry_after(exc: BaseException) -> Optional[float]:
+    """The wait the API asked for with ``Retry-After``, if any."""
+    if isinstance(exc, APIError):
+        return exc.retry_after
+    return None
+
+
+class CircuitBreaker:
+    """Stops calling the API after consecutive failures, then lets one probe through after a cool-down."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def retry_in(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    async def before_call(self) -> None:
+        async with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            raise CircuitOpenError(self.retry_in() or self.reset_timeout)
+
+    async def record_success(self) -> None:
+        async with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    async def release_probe(self) -> None:
+        """End a call that said nothing about the API's health (a bad request, a CDN error) without closing the breaker."""
+        async with self._lock:
+            self._probe_in_flight = False
+
+    async def record_failure(self) -> None:
+        async with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
@@ -0,0 +1,57 @@
+import io
+import os
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    content_type: str
+    filename: str
+
+
+def downscale_image(
+    data: bytes,
+    filename: str,
+    content_type: str,
+    max_edge: int,
+    quality: int = 85,
+) -> PreparedImage:
+    """Shrink the long edge to ``max_edge`` and re-encode as JPEG.
+
+    CPU bound; run it in an executor. Images already within the limit are passed through untouched.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_edge:
+            return PreparedImage(data, content_type, filename)
+
+        # JPEG はデコード時に 1/2, 1/4, 1/8 へ縮小できるので先に draft で粗く縮める
+        image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+
+    stem, _ = os.path.splitext(filename)
+    return PreparedImage(buffer.getvalue(), "image/jpeg", f"{stem}.jpg")
+
+
+def dhash(data: bytes, hash_size: int = 8) -> int:
+    """64-bit difference hash; near-identical photos land within a few bits of each other."""
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        image = ImageOps.exif_transpose(image)
+        small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
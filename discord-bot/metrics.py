@@ -0,0 +1,200 @@
+import bisect
+import contextlib
+import logging
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from aiohttp import web
+
+logger = logging.getLogger("receipt.discord.metrics")
+
+LabelValues = Tuple[str, ...]
+
+# Discord API・CDN の数十ms から LLM 込みの数十秒までを 1 つの物差しで見られるようにする
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(header + list(self.samples()))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """Gauge read from a callback at scrape time, so queue sizes never go stale."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._callback: Optional[Callable[[], float]] = None
+
+    def set_function(self, callback: Callable[[], float]) -> None:
+        self._callback = callback
+
+    def samples(self) -> Iterator[str]:
+        if self._callback is None:
+            return
+        try:
+            value = self._callback()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("メトリクス %s を取得できませんでした: %s", self.name, exc)
+            return
+        yield f"{self.name} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in sorted(self._counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(self._sums[key])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "receipt_bot_stage_duration_seconds",
+        "Latency of each pipeline stage (attachment download, API round trip, Discord calls).",
+        ("stage", "outcome"),
+    )
+)
+STAGE_TOTAL = REGISTRY.register(
+    Counter("receipt_bot_stage_total", "Pipeline stage calls by outcome.", ("stage", "outcome"))
+)
+API_RETRIES = REGISTRY.register(
+    Counter("receipt_bot_api_retries_total", "Receipt API attempts retried after a transient failure.")
+)
+ATTACHMENTS = REGISTRY.register(
+    Counter("receipt_bot_attachments_total", "Attachments handled, by final state.", ("state",))
+)
+WORK_QUEUE_DEPTH = REGISTRY.register(
+    Gauge("receipt_bot_work_queue_depth", "Attachments waiting for a worker.")
+)
+BUSY_WORKERS = REGISTRY.register(
+    Gauge("receipt_bot_busy_workers", "Workers currently processing an attachment.")
+)
+RETRY_QUEUE_DEPTH = REGISTRY.register(
+    Gauge("receipt_bot_retry_queue_depth", "Failed submissions waiting in the on-disk retry queue.")
+)
+
+
+@contextlib.contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """Time the wrapped block into the stage histogram, labelled by success/failure."""
+    started = time.perf_counter()
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage, outcome=outcome)
+        STAGE_TOTAL.inc(stage=stage, outcome=outcome)
+
+
+async def start_metrics_server(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    async def handle_metrics(_request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("メトリクスを http://%s:%d/metrics で公開しています", host, port)
+    return runner
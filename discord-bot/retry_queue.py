@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class FailedSubmission:
+    id: int
+    channel_id: int
+    message_id: int
+    attachment_id: int
+    filename: str
+    uploader: Optional[str]
+    status_channel_id: Optional[int]
+    status_message_id: Optional[int]
+    status_field_index: Optional[int]
+    attempts: int
+    next_attempt_at: float
+    created_at: float
+    last_error: str
+
+
+_COLUMNS = (
+    "id, channel_id, message_id, attachment_id, filename, uploader, status_channel_id, "
+    "status_message_id, status_field_index, attempts, next_attempt_at, created_at, last_error"
+)
+
+
+class RetryQueue:
+    """On-disk queue of submissions that failed because the API was unreachable.
+
+    Only Discord references are stored (channel/message/attachment ids), so the
+    attachment is re-fetched with a fresh CDN URL when it is retried.
+    """
+
+    def __init__(self, path: str, max_items: int, max_age_seconds: float):
+        self.max_items = max_items
+        self.max_age_seconds = max_age_seconds
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS failed_submissions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    attachment_id INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    uploader TEXT,
+                    status_channel_id INTEGER,
+                    status_message_id INTEGER,
+                    status_field_index INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_error TEXT NOT NULL DEFAULT '',
+                    UNIQUE (message_id, attachment_id)
+                )
+                """
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM failed_submissions").fetchone()[0]
+
+    def push(
+        self,
+        channel_id: int,
+        message_id: int,
+        attachment_id: int,
+        filename: str,
+        uploader: Optional[str],
+        status_channel_id: Optional[int],
+        status_message_id: Optional[int],
+        status_field_index: Optional[int],
+        error: str,
+        delay: float,
+    ) -> bool:
+        """Add a failed submission; returns False when the queue is full."""
+        now = time.time()
+        with self._lock, self._conn:
+            count = self._conn.execute("SELECT COUNT(*) FROM failed_submissions").fetchone()[0]
+            if count >= self.max_items:
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO failed_submissions (channel_id, message_id, attachment_id, filename, "
+                "uploader, status_channel_id, status_message_id, status_field_index, attempts, next_attempt_at, "
+                "created_at, last_error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                (
+                    channel_id,
+                    message_id,
+                    attachment_id,
+                    filename,
+                    uploader,
+                    status_channel_id,
+                    status_message_id,
+                    status_field_index,
+                    now + delay,
+                    now,
+                    error,
+                ),
+            )
+        return True
+
+    def due(self, limit: int) -> List[FailedSubmission]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM failed_submissions WHERE next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+        return [FailedSubmission(*row) for row in rows]
+
+    def reschedule(self, entry_id: int, attempts: int, delay: float, error: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE failed_submissions SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time() + delay, error, entry_id),
+            )
+
+    def remove(self, entry_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM failed_submissions WHERE id = ?", (entry_id,))
+
+    def pending_for_status(self, status_message_id: int) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM failed_submissions WHERE status_message_id = ?",
+                (status_message_id,),
+            ).fetchone()[0]
+
+    def pop_expired(self) -> List[FailedSubmission]:
+        cutoff = time.time() - self.max_age_seconds
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM failed_submissions WHERE created_at < ?", (cutoff,)
+            ).fetchall()
+            self._conn.execute("DELETE FROM failed_submissions WHERE created_at < ?", (cutoff,))
+        return [FailedSubmission(*row) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Hashable, List, Optional
+
+import discord
+import discord.abc
+
+from metrics import track_stage
+
+logger = logging.getLogger("receipt.discord.status")
+
+STATE_ICONS = {
+    "queued": "⏳",
+    "processing": "🔄",
+    "done": "✅",
+    "duplicate": "♻️",
+    "error": "❌",
+    "skipped": "⚠️",
+    "paused": "🔌",
+    "retrying": "🔁",
+}
+FINAL_STATES = {"done", "duplicate", "error", "skipped", "paused", "retrying"}
+
+# Discord の埋め込みの上限（フィールド値 1024 文字・25 フィールド・全体 6000 文字）
+EMBED_FIELD_VALUE_LIMIT = 1024
+EMBED_FIELD_LIMIT = 25
+EMBED_FIELDS_TOTAL_BUDGET = 5000
+
+
+class EditRateLimiter:
+    """Sliding-window limiter per Discord bucket (we key buckets by channel id).
+
+    Discord allows roughly 5 message sends/edits per 5 seconds per channel; staying under that
+    on our side avoids 429s that would otherwise stall every status update in the channel.
+    """
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self._calls: Dict[Hashable, Deque[float]] = {}
+        self._blocked_until: Dict[Hashable, float] = {}
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+
+    async def acquire(self, bucket: Hashable) -> None:
+        lock = self._locks.setdefault(bucket, asyncio.Lock())
+        async with lock:
+            calls = self._calls.setdefault(bucket, deque())
+            while True:
+                now = time.monotonic()
+                blocked = self._blocked_until.get(bucket, 0.0) - now
+                while calls and now - calls[0] >= self.per:
+                    calls.popleft()
+                if blocked > 0:
+                    await asyncio.sleep(blocked)
+                elif len(calls) >= self.rate:
+                    await asyncio.sleep(self.per - (now - calls[0]))
+                else:
+                    calls.append(now)
+                    return
+
+    def penalize(self, bucket: Hashable, retry_after: float) -> None:
+        """Record a 429 so the next acquire waits out Discord's retry-after."""
+        self._blocked_until[bucket] = time.monotonic() + retry_after
+
+
+@dataclass
+class AttachmentStatus:
+    filename: str
+    state: str = "queued"
+    detail: str = ""
+
+
+class StatusBoard:
+    """Single progress message per user message, rendered as one embed and edited on a debounce."""
+
+    def __init__(
+        self,
+        channel: discord.abc.Messageable,
+        bucket: Hashable,
+        limiter: EditRateLimiter,
+        debounce_seconds: float,
+    ):
+        self.channel = channel
+        self.bucket = bucket
+        self.limiter = limiter
+        self.debounce_seconds = debounce_seconds
+        self.message: Optional[discord.Message] = None
+        self._entries: Dict[str, AttachmentStatus] = {}
+        self._dirty = False
+        self._last_flush = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+        # 遅延更新のタスクがまだデバウンス待ちで、送信を始めていない間だけ True
+        self._debouncing = False
+        self._send_lock = asyncio.Lock()
+
+    def add(self, key: str, filename: str, state: str = "queued", detail: str = "") -> None:
+        self._entries[key] = AttachmentStatus(filename, state, detail)
+        self._mark_dirty()
+
+    def update(self, key: str, state: str, detail: str = "") -> None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry.state = state
+        entry.detail = detail
+        self._mark_dirty()
+
+    def entries(self) -> List[AttachmentStatus]:
+        return list(self._entries.values())
+
+    def index_of(self, key: str) -> Optional[int]:
+        for index, entry_key in enumerate(self._entries):
+            if entry_key == key:
+                return index
+        return None
+
+    async def start(self) -> None:
+        """Post the progress message right away so users see the bot picked the message up."""
+        await self._flush()
+
+    async def finish(self) -> None:
+        task = self._flush_task
+        if task and not task.done():
+            # デバウンス待ちなら取り消す。送信を始めた更新は最後まで待つ
+            if self._debouncing:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self._dirty or self.message is None:
+            await self._flush()
+
+    def _mark_dirty(self) -> None:
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._debouncing = True
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        delay = self.debounce_seconds - (time.monotonic() - self._last_flush)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._debouncing = False
+        await self._flush()
+
+    async def _flush(self) -> None:
+        async with self._send_lock:
+            if not self._dirty and self.message is not None:
+                return
+            self._dirty = False
+            embed = self.render()
+            await self.limiter.acquire(self.bucket)
+            try:
+                if self.message is None:
+                    with track_stage("discord_send"):
+                        self.message = await self.channel.send(embed=embed)
+                else:
+                    with track_stage("discord_edit"):
+                        self.message = await self.message.edit(embed=embed)
+            except discord.HTTPException as exc:
+                if exc.status == 429:
+                    retry_after = float(getattr(exc, "retry_after", 0) or self.limiter.per)
+                    self.limiter.penalize(self.bucket, retry_after)
+                logger.warning("ステータスメッセージの更新に失敗しました: %s", exc)
+                self._dirty = True
+            except asyncio.CancelledError:
+                # 描画しきれなかった状態を次の flush で送り直す
+                self._dirty = True
+                raise
+            finally:
+                self._last_flush = time.monotonic()
+
+    def render(self) -> discord.Embed:
+        entries = self.entries()
+        finished = sum(1 for entry in entries if entry.state in FINAL_STATES)
+        failed = any(entry.state == "error" for entry in entries)
+        if finished < len(entries):
+            colour = discord.Colour.blurple()
+        elif failed:
+            colour = discord.Colour.red()
+        else:
+            colour = discord.Colour.green()
+
+        embed = discord.Embed(
+            title="🧾 レシート処理状況",
+            description=f"{finished}/{len(entries)} 件完了",
+            colour=colour,
+        )
+        shown = entries[:EMBED_FIELD_LIMIT]
+        value_limit = _field_value_limit(len(shown))
+        for entry in shown:
+            name, value = _render_field(entry, value_limit)
+            embed.add_field(name=name, value=value, inline=False)
+        return embed
+
+
+def _field_value_limit(field_count: int) -> int:
+    return min(EMBED_FIELD_VALUE_LIMIT, EMBED_FIELDS_TOTAL_BUDGET // max(field_count, 1))
+
+
+def _render_field(entry: AttachmentStatus, value_limit: int):
+    value = entry.detail or entry.state
+    if len(value) > value_limit:
+        value = value[: value_limit - 1] + "…"
+    return f"{STATE_ICONS.get(entry.state, '•')} {entry.filename}"[:256], value
+
+
+async def patch_posted_status(
+    message: discord.Message,
+    index: int,
+    entry: AttachmentStatus,
+    limiter: EditRateLimiter,
+    bucket: Hashable,
+) -> None:
+    """Rewrite one attachment's field on an already posted progress message (e.g. after a later retry)."""
+    if not message.embeds or index >= len(message.embeds[0].fields):
+        return
+    embed = message.embeds[0]
+    name, value = _render_field(entry, _field_value_limit(len(embed.fields)))
+    embed.set_field_at(index, name=name, value=value, inline=False)
+    await limiter.acquire(bucket)
+    with track_stage("discord_edit"):
+        await message.edit(embed=embed)
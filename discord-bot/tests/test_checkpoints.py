@@ -0,0 +1,43 @@
+from checkpoints import ChannelCursorStore
+
+
+def test_cursor_only_moves_forward_and_persists(tmp_path):
+    path = str(tmp_path / "cursors.sqlite3")
+    store = ChannelCursorStore(path)
+    store.advance(1, 200)
+    store.advance(1, 150)
+    store.close()
+
+    reopened = ChannelCursorStore(path)
+    assert reopened.get(1) == 200
+    assert reopened.get(2) == 0
+    reopened.close()
+
+
+def test_hold_keeps_replay_position_until_released(tmp_path):
+    path = str(tmp_path / "cursors.sqlite3")
+    store = ChannelCursorStore(path)
+    store.advance(1, 100)
+    store.hold(1, 100)
+    # 取りこぼし処理中に新着メッセージでカーソルが進んでも、次回はホールド位置から再処理する
+    store.advance(1, 300)
+    assert store.get(1) == 100
+
+    store.hold(1, 180)
+    store.close()
+    reopened = ChannelCursorStore(path)
+    assert reopened.get(1) == 180
+
+    reopened.release(1)
+    assert reopened.get(1) == 300
+    reopened.close()
+    assert ChannelCursorStore(path).get(1) == 300
+
+
+def test_channels_report_held_positions(tmp_path):
+    store = ChannelCursorStore(str(tmp_path / "cursors.sqlite3"))
+    store.advance(1, 50)
+    store.advance(2, 90)
+    store.hold(2, 70)
+
+    assert store.channels() == {1: 50, 2: 70}
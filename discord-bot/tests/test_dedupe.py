@@ -0,0 +1,38 @@
+import sqlite3
+
+from dedupe import DedupeIndex
+
+
+def test_near_match_needs_the_same_dimensions(tmp_path):
+    index = DedupeIndex(str(tmp_path / "dedupe.sqlite3"))
+    index.add(0b1010, 7, size=(1080, 1920))
+
+    # 同じテンプレートの別レシートは数ビットしか違わないことがあるため、寸法が違えば重複としない
+    assert index.find(0b1011, 3, (1080, 1440)) is None
+    assert index.find(0b1011, 3, None) is None
+    match = index.find(0b1011, 3, (1080, 1920))
+    assert (match.receipt_id, match.distance) == (7, 1)
+    assert index.find(0b1010, 3, None).receipt_id == 7
+    index.close()
+
+
+def test_old_rows_without_dimensions_only_match_exactly(tmp_path):
+    path = str(tmp_path / "dedupe.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE image_hashes (image_hash INTEGER NOT NULL, receipt_id INTEGER NOT NULL, "
+        "channel_id INTEGER, message_id INTEGER, created_at REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO image_hashes VALUES (?, ?, NULL, NULL, 0)", (0b1010, 3))
+    conn.commit()
+    conn.close()
+
+    index = DedupeIndex(path)
+    assert index.find(0b1011, 3, (1080, 1920)) is None
+    assert index.find(0b1010, 3, (1080, 1920)).receipt_id == 3
+    index.add(0b1010, 4, size=(1080, 1920))
+    index.close()
+
+    reopened = DedupeIndex(path)
+    assert reopened.find(0b1011, 3, (1080, 1920)).receipt_id == 4
+    reopened.close()
@@ -0,0 +1,89 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp.client_reqrep import ConnectionKey
+
+from http_client import (
+    APIError,
+    AttachmentFetchError,
+    CircuitBreaker,
+    api_error,
+    counts_as_outage,
+    is_retryable,
+    server_retry_after,
+)
+
+
+def _connector_error() -> aiohttp.ClientConnectorError:
+    key = ConnectionKey("app", 3000, False, None, None, None, None)
+    return aiohttp.ClientConnectorError(key, ConnectionRefusedError(111, "Connection refused"))
+
+
+def _wrapped(cause: BaseException) -> aiohttp.ClientConnectionError:
+    # aiohttp は本文の送信中に起きた例外を ClientConnectionError で包む
+    error = aiohttp.ClientConnectionError("failed to send body")
+    error.__cause__ = cause
+    return error
+
+
+@pytest.mark.parametrize(
+    "exc, retryable, outage",
+    [
+        (APIError(503, "Service Unavailable"), True, True),
+        (APIError(429, "Too Many Requests"), True, True),
+        (APIError(500, "Internal Server Error"), False, False),
+        (APIError(400, "Bad Request"), False, False),
+        (_connector_error(), True, True),
+        (aiohttp.ServerDisconnectedError(), False, True),
+        (asyncio.TimeoutError(), False, False),
+        (AttachmentFetchError("CDN 503", retryable=True), True, False),
+        (AttachmentFetchError("CDN 404"), False, False),
+        (_wrapped(AttachmentFetchError("CDN reset", retryable=True)), True, False),
+        (_wrapped(AttachmentFetchError("CDN 403")), False, False),
+        (RuntimeError("添付ファイルの内容が空でした"), False, False),
+    ],
+)
+def test_retry_and_outage_classification(exc, retryable, outage):
+    assert is_retryable(exc) is retryable
+    assert counts_as_outage(exc) is outage
+
+
+def test_api_error_reads_preflight_reason_from_422():
+    error = api_error(422, '{"error": "画像がぼやけています", "preflightReason": "blurry"}')
+
+    assert error.status == 422
+    assert error.preflight_reason == "blurry"
+    assert "画像がぼやけています" in str(error)
+    assert not is_retryable(error)
+
+
+@pytest.mark.parametrize("status, text", [(422, "not json"), (500, '{"preflightReason": "blurry"}')])
+def test_api_error_without_preflight_reason(status, text):
+    assert api_error(status, text).preflight_reason is None
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [("12", 12.0), ("0.5", 0.5), ("-3", 0.0), ("soon", None), (None, None)],
+)
+def test_api_error_reads_retry_after(header, expected):
+    assert server_retry_after(api_error(429, "Too Many Requests", header)) == expected
+
+
+def test_half_open_breaker_closes_only_on_success():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        await breaker.record_failure()
+        assert breaker.state == "half-open"
+
+        # 400 や CDN の失敗は API の健全性を示さないため、半開のまま次の試行を待つ
+        await breaker.before_call()
+        await breaker.release_probe()
+        assert breaker.state == "half-open"
+
+        await breaker.before_call()
+        await breaker.record_success()
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
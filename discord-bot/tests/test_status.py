@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from status import EditRateLimiter, StatusBoard
+
+
+class _Message:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, embed):
+        await self.channel.deliver(embed)
+        return self
+
+
+class _Channel:
+    """Records the embeds it was asked to draw; ``gate`` holds every send/edit until it is set."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.in_flight = asyncio.Event()
+        self.drawn = []
+
+    async def deliver(self, embed):
+        self.in_flight.set()
+        await self.gate.wait()
+        self.drawn.append(embed.fields[0].name)
+
+    async def send(self, embed):
+        await self.deliver(embed)
+        return _Message(self)
+
+
+def _board(channel, debounce_seconds):
+    return StatusBoard(channel, "bucket", EditRateLimiter(rate=100, per=1), debounce_seconds)
+
+
+def test_finish_waits_for_an_edit_in_flight_and_draws_the_last_state():
+    async def scenario():
+        channel = _Channel()
+        board = _board(channel, debounce_seconds=0)
+        board.add("1", "receipt.jpg")
+        await board.start()
+
+        channel.gate.clear()
+        channel.in_flight.clear()
+        board.update("1", "done", "登録しました")
+        # 遅延更新が最後の状態を描画し始めたところで finish する
+        await channel.in_flight.wait()
+        finishing = asyncio.create_task(board.finish())
+        await asyncio.sleep(0.01)
+        channel.gate.set()
+        await asyncio.wait_for(finishing, 1)
+        return channel.drawn
+
+    drawn = asyncio.run(scenario())
+
+    assert drawn[-1] == "✅ receipt.jpg"
+
+
+def test_finish_skips_the_debounce_wait():
+    async def scenario():
+        channel = _Channel()
+        board = _board(channel, debounce_seconds=30)
+        board.add("1", "receipt.jpg")
+        await board.start()
+        board.update("1", "done", "登録しました")
+        started = time.monotonic()
+        await board.finish()
+        return channel.drawn, time.monotonic() - started
+
+    drawn, elapsed = asyncio.run(scenario())
+
+    assert drawn == ["⏳ receipt.jpg", "✅ receipt.jpg"]
+    assert elapsed < 1
@@ -0,0 +1,38 @@
+import asyncio
+
+from work_queue import FairWorkQueue
+
+
+def test_items_are_handed_out_round_robin_across_lanes():
+    async def scenario():
+        queue = FairWorkQueue()
+        for index in range(3):
+            await queue.put("busy", f"busy-{index}")
+        await queue.put("quiet", "quiet-0")
+        await queue.put("other", "other-0")
+        return [await queue.get() for _ in range(queue.qsize())]
+
+    assert asyncio.run(scenario()) == ["busy-0", "quiet-0", "other-0", "busy-1", "busy-2"]
+
+
+def test_put_reports_items_ahead():
+    async def scenario():
+        queue = FairWorkQueue()
+        return [await queue.put(lane, index) for index, lane in enumerate("aab")]
+
+    assert asyncio.run(scenario()) == [0, 1, 2]
+
+
+def test_put_waits_while_full():
+    async def scenario():
+        queue = FairWorkQueue(maxsize=1)
+        await queue.put("a", 1)
+        blocked = asyncio.create_task(queue.put("b", 2))
+        await asyncio.sleep(0.01)
+        assert queue.full() and not blocked.done()
+
+        assert await queue.get() == 1
+        await asyncio.wait_for(blocked, 1)
+        return await queue.get()
+
+    assert asyncio.run(scenario()) == 2
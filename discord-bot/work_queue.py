@@ -0,0 +1,54 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class FairWorkQueue(Generic[T]):
+    """Bounded asyncio queue that hands out items round-robin across lanes (e.g. channels).
+
+    A channel posting a burst of receipts only gets one turn per rotation, so other
+    channels are not stuck behind it.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self._maxsize = maxsize
+        self._lanes: Dict[Hashable, Deque[T]] = {}
+        self._rotation: Deque[Hashable] = deque()
+        self._size = 0
+        self._condition = asyncio.Condition()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def full(self) -> bool:
+        return self._maxsize > 0 and self._size >= self._maxsize
+
+    async def put(self, lane: Hashable, item: T) -> int:
+        """Enqueue ``item`` and return how many items were waiting ahead of it."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self.full())
+            ahead = self._size
+            queue = self._lanes.get(lane)
+            if queue is None:
+                queue = self._lanes[lane] = deque()
+                self._rotation.append(lane)
+            queue.append(item)
+            self._size += 1
+            self._condition.notify_all()
+            return ahead
+
+    async def get(self) -> T:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._size > 0)
+            lane = self._rotation.popleft()
+            queue = self._lanes[lane]
+            item = queue.popleft()
+            if queue:
+                self._rotation.append(lane)
+            else:
+                del self._lanes[lane]
+            self._size -= 1
+            self._condition.notify_all()
+            return item
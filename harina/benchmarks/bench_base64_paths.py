@@ -0,0 +1,96 @@
+"""
+Harina v3 画像受け渡し経路のベンチマーク
+
+LLM に渡す data URL を作るまでのコストを経路ごとに比較する。
+
+- legacy:      BASE64 JSON → b64decode → 一時ファイル → Image.open → image_to_base64
+- raw:         バイナリ本文 → Image.open → image_to_base64（/process_raw）
+- passthrough: JPEG の BASE64 をそのまま転送（/process_base64 の高速パス）
+
+    docker compose exec harina uv run python benchmarks/bench_base64_paths.py --megapixels 12
+"""
+import argparse
+import base64
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from loguru import logger
+from PIL import Image
+
+from harina.uploads import is_jpeg_base64
+from harina.utils import image_to_base64
+
+
+def legacy_path(payload_b64: str) -> str:
+    image_data = base64.b64decode(payload_b64)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
+        temp_file.write(image_data)
+        temp_path = Path(temp_file.name)
+    try:
+        return image_to_base64(Image.open(temp_path))
+    finally:
+        temp_path.unlink()
+
+
+def raw_path(payload: bytes) -> str:
+    return image_to_base64(Image.open(io.BytesIO(payload)))
+
+
+def passthrough_path(payload_b64: str) -> str:
+    if not is_jpeg_base64(payload_b64):
+        raise ValueError("payload is not a JPEG base64 string")
+    return payload_b64
+
+
+def measure(label: str, func, arg, runs: int) -> None:
+    cpu_samples = []
+    peak_samples = []
+    for _ in range(runs):
+        tracemalloc.start()
+        started = time.process_time()
+        func(arg)
+        cpu_samples.append(time.process_time() - started)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_samples.append(peak)
+    logger.info(
+        "{:<12} cpu={:.1f}ms peak={:.1f}MB",
+        label,
+        1000 * sum(cpu_samples) / runs,
+        max(peak_samples) / 1024 / 1024,
+    )
+
+
+def load_payload(image: str, megapixels: float) -> bytes:
+    if image:
+        return Path(image).read_bytes()
+    side = int((megapixels * 1_000_000) ** 0.5)
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--image", default="", help="計測に使う JPEG（未指定ならランダム画像を生成）")
+    parser.add_argument("--megapixels", type=float, default=12.0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    payload = load_payload(args.image, args.megapixels)
+    payload_b64 = base64.b64encode(payload).decode("ascii")
+    logger.info("📏 payload: {:.1f}MB (base64 {:.1f}MB)", len(payload) / 1024 / 1024, len(payload_b64) / 1024 / 1024)
+
+    measure("legacy", legacy_path, payload_b64, args.runs)
+    measure("raw", raw_path, payload, args.runs)
+    measure("passthrough", passthrough_path, payload_b64, args.runs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Harina v3 レシート切り抜きのベンチマーク
+
+同じ画像を切り抜きなし / 切り抜きあり（--deskew で傾き補正も）で処理し、LLM に送った
+BASE64 のサイズ、使用トークン（実 API の場合）、エンドツーエンドの時間を比較する。
+画像を指定しない場合は、暗い机の上に傾けて置いた 12MP 相当の合成レシートを使う。
+
+    docker compose exec harina uv run python benchmarks/bench_crop.py IMG_8923.jpg --runs 3
+
+--stub-seconds を指定すると LLM を呼ばずに一定時間待つスタブで置き換え、
+送信サイズと前処理の時間だけを計測する（API キー不要）。
+"""
+import argparse
+import base64
+import io
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from loguru import logger
+from PIL import Image, ImageDraw
+
+import harina.cropping as cropping
+from harina.core import HarinaCore
+
+_STUB_XML = "<receipt><store_info><name>stub</name></store_info><items/><totals><total>0</total></totals></receipt>"
+
+
+def synthetic_photo(angle: float) -> bytes:
+    paper = Image.new("RGB", (1200, 3000), (240, 240, 235))
+    draw = ImageDraw.Draw(paper)
+    for index, y in enumerate(range(120, 2880, 60)):
+        draw.rectangle((100, y, 100 + 200 + (index * 137) % 800, y + 24), fill=(25, 25, 25))
+    mask = Image.new("L", paper.size, 255).rotate(angle, expand=True)
+    photo = Image.new("RGB", (3000, 4000), (58, 50, 42))
+    photo.paste(paper.rotate(angle, expand=True), (700, 350), mask)
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def recording_completion(sent: list, stub_seconds: float):
+    original = HarinaCore._run_completion_with_fallback
+
+    def _completion(self, messages):
+        url = messages[-1]["content"][1]["image_url"]["url"]
+        sent.append(len(url.split(",", 1)[1]))
+        if stub_seconds <= 0:
+            return original(self, messages)
+        time.sleep(stub_seconds)
+        self.last_used_key_label = "stub"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=_STUB_XML))])
+
+    return _completion
+
+
+def run(label: str, core: HarinaCore, payload: bytes, runs: int, sent: list) -> None:
+    encoded = base64.b64encode(payload).decode("ascii")
+    for path, call in (
+        ("file", lambda: core.process_receipt(io.BytesIO(payload))),
+        ("base64", lambda: core.process_receipt_base64(encoded)),
+    ):
+        latencies = []
+        tokens = []
+        for _ in range(runs):
+            sent.clear()
+            core.last_crop = None
+            started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - started)
+            if core.last_usage:
+                tokens.append(core.last_usage.prompt_tokens)
+        latencies.sort()
+        logger.info(
+            "{:<8} {:<6} sent={:>9,} chars area -{:>4.0%} median={:.3f}s prompt_tokens={}",
+            label,
+            path,
+            sum(sent),
+            core.last_crop.reduction if core.last_crop else 0.0,
+            latencies[len(latencies) // 2],
+            tokens[len(tokens) // 2] if tokens else "-",
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?", type=Path, help="レシートの写真（省略時は合成画像）")
+    parser.add_argument("--angle", type=float, default=6.0, help="合成画像のレシートの傾き（度）")
+    parser.add_argument("--model", default="gemini/gemini-2.5-flash")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--deskew", action="store_true", help="傾き補正も有効にする")
+    parser.add_argument("--stub-seconds", type=float, default=0.0, help="LLM 呼び出しの代わりに待つ秒数")
+    args = parser.parse_args()
+
+    payload = args.image.read_bytes() if args.image else synthetic_photo(args.angle)
+    sent: list = []
+    HarinaCore._run_completion_with_fallback = recording_completion(sent, args.stub_seconds)
+    cropping.DESKEW_ENABLED = args.deskew
+
+    for label, enabled in (("full", False), ("cropped", True)):
+        core = HarinaCore(model_name=args.model)
+        core.crop_enabled = enabled
+        core.tiling_enabled = False
+        run(label, core, payload, args.runs, sent)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
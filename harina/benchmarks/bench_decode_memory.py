@@ -0,0 +1,131 @@
+"""
+Harina v3 大きな画像の復号メモリベンチマーク
+
+48MP 相当の JPEG を HarinaCore.process_receipt に同時に渡し、プロセスの最大 RSS を
+「全画素を復号（従来）」「JPEG の縮小復号のみ」「縮小復号 + 復号メモリの上限」で比較する。
+最大 RSS はプロセス単位でしか測れないので、設定ごとに子プロセスを起動して計測する。
+LLM 呼び出しは固定 XML を返すスタブに差し替えるので API キーは不要。
+
+    docker compose exec harina uv run python benchmarks/bench_decode_memory.py --concurrency 6 --megapixels 48
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+from loguru import logger
+from PIL import Image, ImageDraw
+
+_STUB_XML = "<receipt><store_info><name>stub</name></store_info><items/><totals><total>0</total></totals></receipt>"
+
+MODES = {
+    "full": {"HARINA_DECODE_TARGET_PIXELS": "0", "HARINA_DECODE_BUDGET_MB": "0"},
+    "draft": {"HARINA_DECODE_BUDGET_MB": "0"},
+    "draft+budget": {},
+}
+
+
+def synthetic_photo(path: Path, megapixels: float) -> None:
+    height = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    width = int(height * 3 / 4)
+    photo = Image.new("RGB", (width, height), (58, 50, 42))
+    draw = ImageDraw.Draw(photo)
+    left, top, right, bottom = width // 5, height // 12, width * 4 // 5, height * 11 // 12
+    draw.rectangle((left, top, right, bottom), fill=(240, 240, 235))
+    step = max(8, height // 120)
+    for index, y in enumerate(range(top + step, bottom - step, step)):
+        draw.rectangle((left + step, y, left + step + (index * 137) % (right - left - 2 * step), y + step // 2), fill=(25, 25, 25))
+    photo.save(path, format="JPEG", quality=90)
+
+
+def worker(path: Path, concurrency: int, runs: int) -> dict:
+    """Runs inside the child process with the mode's environment already applied."""
+    from harina.core import HarinaCore
+
+    def _completion(self, messages):
+        self.last_used_key_label = "stub"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=_STUB_XML))])
+
+    HarinaCore._run_completion_with_fallback = _completion
+    payload = path.read_bytes()
+
+    def process(_: int) -> float:
+        core = HarinaCore()
+        core.preflight_enabled = False
+        core.reconcile_enabled = False
+        core.memo_enabled = False
+        started = time.perf_counter()
+        core.process_receipt(io.BytesIO(payload))
+        return time.perf_counter() - started
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(process, range(concurrency * runs)))
+    return {
+        "baseline_mb": baseline,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "seconds": time.perf_counter() - started,
+        "median": latencies[len(latencies) // 2],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?", type=Path, help="JPEG 画像（省略時は合成画像）")
+    parser.add_argument("--megapixels", type=float, default=48.0, help="合成画像の画素数（MP）")
+    parser.add_argument("--concurrency", type=int, default=6)
+    parser.add_argument("--runs", type=int, default=1, help="並列数 × runs 件を処理する")
+    parser.add_argument("--budget-mb", type=float, default=256.0, help="draft+budget での HARINA_DECODE_BUDGET_MB")
+    parser.add_argument("--worker", choices=list(MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(args.image, args.concurrency, args.runs)))
+        return 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.image
+        if path is None:
+            path = Path(directory) / "synthetic.jpg"
+            synthetic_photo(path, args.megapixels)
+        with Image.open(path) as image:
+            logger.info("🖼️ {} {}x{} ({:.1f}MB)", path.name, *image.size, path.stat().st_size / 1024 / 1024)
+
+        for mode, overrides in MODES.items():
+            env = {**os.environ, **overrides}
+            if mode == "draft+budget":
+                env["HARINA_DECODE_BUDGET_MB"] = str(args.budget_mb)
+            completed = subprocess.run(
+                [
+                    sys.executable, __file__, str(path), "--worker", mode,
+                    "--concurrency", str(args.concurrency), "--runs", str(args.runs),
+                ],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            logger.info(
+                "{:<13} concurrency={} peak_rss={:>7.1f}MB (+{:.1f}MB over baseline) total={:.2f}s median={:.2f}s",
+                mode,
+                args.concurrency,
+                result["max_rss_mb"],
+                result["max_rss_mb"] - result["baseline_mb"],
+                result["seconds"],
+                result["median"],
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Harina v3 重複インデックスのベンチマーク
+
+合成したレシート N 件でインデックスを構築し、取り込み時の重複判定（キー / 画像ハッシュ）と
+/duplicates のページ取得（インデックス側のみ）のレイテンシを計測する。データベースは使わない。
+
+    docker compose exec harina uv run python benchmarks/bench_duplicates.py --receipts 300000
+"""
+import argparse
+import random
+import sys
+import time
+
+from loguru import logger
+
+from harina.duplicates import DuplicateIndex, duplicate_key
+
+
+def percentile(samples, ratio: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", type=int, default=300_000)
+    parser.add_argument("--stores", type=int, default=2_000)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.02, help="重複として再登録するレシートの割合")
+    parser.add_argument("--lookups", type=int, default=10_000)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    index = DuplicateIndex()
+    hashes = []
+    started = time.perf_counter()
+    for receipt_id in range(1, args.receipts + 1):
+        if hashes and rng.random() < args.duplicate_ratio:
+            # 撮り直し相当: 同じキーで、ハッシュが数ビットだけ違う
+            original = rng.randrange(len(hashes))
+            key, image_hash = hashes[original]
+            image_hash ^= 1 << rng.randrange(64)
+        else:
+            key = duplicate_key(
+                f"店舗{rng.randrange(args.stores)}",
+                f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                rng.randint(100, 30_000),
+            )
+            image_hash = rng.getrandbits(64)
+        index.add(receipt_id, key, image_hash)
+        hashes.append((key, image_hash))
+    logger.info("🗂️ built index of {} receipts in {:.2f}s", len(index), time.perf_counter() - started)
+
+    key_samples = []
+    image_samples = []
+    hits = 0
+    for _ in range(args.lookups):
+        key, image_hash = hashes[rng.randrange(len(hashes))]
+        probe = image_hash ^ (1 << rng.randrange(64))
+
+        started = time.perf_counter()
+        index.find(key)
+        key_samples.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        hits += index.find(image_hash=probe) is not None
+        image_samples.append(time.perf_counter() - started)
+
+    for label, samples in (("key", key_samples), ("image", image_samples)):
+        logger.info(
+            "{:<6} p50={:.1f}us p99={:.1f}us max={:.1f}us",
+            label,
+            percentile(samples, 0.5) * 1e6,
+            percentile(samples, 0.99) * 1e6,
+            max(samples) * 1e6,
+        )
+    logger.info("image hits: {}/{}", hits, args.lookups)
+
+    for label in ("first page (cold)", "next page (cached)"):
+        started = time.perf_counter()
+        total, _ = index.group_page(args.page_size, args.page_size)
+        logger.info("{:<19} {:.2f}ms ({} groups)", label, (time.perf_counter() - started) * 1000, total)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
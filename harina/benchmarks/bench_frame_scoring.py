@@ -0,0 +1,92 @@
+"""
+Harina v3 カメラフレーム評価のスループットベンチマーク
+
+/ws/capture が受け取るプレビューフレーム（既定 480x640 の JPEG）を 1 コアに固定して
+score_frame で評価し、1 枚あたりの処理時間と毎秒のフレーム数を表示する。
+ぼかし・白飛びの異なるフレームを混ぜ、最もシャープなフレームが選ばれることも確認する。
+
+    docker compose exec harina uv run python benchmarks/bench_frame_scoring.py --frames 300 --width 480
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+from loguru import logger
+from PIL import Image, ImageDraw, ImageFilter
+
+from harina.frames import FrameBurst, score_frame
+
+# (ぼかし半径, 白飛び) の組み合わせ。最初の組が最良フレームになるはず
+VARIANTS = [(0, False), (1, False), (2, False), (4, False), (0, True), (3, True)]
+
+
+def synthetic_frame(width: int, height: int, blur: float, glare: bool) -> bytes:
+    frame = Image.new("RGB", (width, height), (58, 50, 42))
+    draw = ImageDraw.Draw(frame)
+    left, top, right, bottom = width // 4, height // 10, width * 3 // 4, height * 9 // 10
+    draw.rectangle((left, top, right, bottom), fill=(236, 236, 230))
+    step = max(4, height // 60)
+    for index, y in enumerate(range(top + step, bottom - step, step)):
+        draw.rectangle((left + step, y, left + step + (index * 37) % (right - left - 2 * step), y + step // 2), fill=(25, 25, 25))
+    if glare:
+        draw.ellipse((left, top, right, (top + bottom) // 2), fill=(255, 255, 255))
+    if blur:
+        frame = frame.filter(ImageFilter.GaussianBlur(blur))
+    buffer = io.BytesIO()
+    frame.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=300, help="評価するフレーム数")
+    parser.add_argument("--width", type=int, default=480, help="プレビューフレームの幅（高さは 4:3）")
+    parser.add_argument("--fps", type=float, default=30.0, help="比較するカメラのフレームレート")
+    args = parser.parse_args()
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    height = args.width * 4 // 3
+    payloads = [synthetic_frame(args.width, height, blur, glare) for blur, glare in VARIANTS]
+    logger.info(
+        "🎞️ {}x{} JPEG frames ({:.0f}KB avg), {} frames on 1 core",
+        args.width,
+        height,
+        sum(len(payload) for payload in payloads) / len(payloads) / 1024,
+        args.frames,
+    )
+
+    for payload in payloads:  # ウォームアップ
+        score_frame(payload)
+
+    burst = FrameBurst(max_frames=args.frames)
+    latencies = []
+    started = time.perf_counter()
+    while not burst.full:
+        index = burst.next_index()
+        frame_started = time.perf_counter()
+        burst.offer(score_frame(payloads[index % len(payloads)], index))
+        latencies.append((time.perf_counter() - frame_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    throughput = args.frames / elapsed
+    logger.info(
+        "⏱️ median={:.2f}ms p95={:.2f}ms max={:.2f}ms -> {:.0f} frames/s ({:.1f}x {:.0f}fps)",
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.95) - 1],
+        latencies[-1],
+        throughput,
+        throughput / args.fps,
+        args.fps,
+    )
+    variant = VARIANTS[burst.best.index % len(VARIANTS)]
+    logger.info("🏆 best frame: blur={} glare={} score={:.3f}", variant[0], variant[1], burst.best.score)
+    return 0 if variant == VARIANTS[0] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
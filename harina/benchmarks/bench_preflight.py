@@ -0,0 +1,121 @@
+"""
+Harina v3 事前チェック（プレフライト）のベンチマーク
+
+合成したレシート画像（鮮明 / ぼけ / 無地 / 白飛び / 暗い / 低解像度）と、指定した実画像について
+各指標（鮮明度・コントラスト・白飛び/黒つぶれの割合）と判定、判定にかかった時間を表示する。
+閾値（HARINA_PREFLIGHT_*）の調整に使う。
+
+    docker compose exec harina uv run python benchmarks/bench_preflight.py --megapixels 12 IMG_8923.jpg
+"""
+import argparse
+import base64
+import io
+import random
+import sys
+import time
+from pathlib import Path
+
+from loguru import logger
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+
+from harina.preflight import PreflightError, check_base64, check_image
+
+
+def synthetic_receipt(megapixels: float) -> Image.Image:
+    height = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    width = height * 3 // 4
+    image = Image.new("RGB", (width, height), (96, 84, 72))
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = width // 4, height // 10, width * 3 // 4, height * 9 // 10
+    draw.rectangle((left, top, right, bottom), fill=(245, 243, 238))
+    rng = random.Random(0)
+    line = max(8, height // 120)
+    for y in range(top + line * 2, bottom - line * 2, line * 2):
+        x = left + line
+        while x < right - line * 4:
+            word = rng.randint(2, 8) * line // 2
+            draw.rectangle((x, y, min(x + word, right - line), y + line), fill=(30, 30, 30))
+            x += word + line
+    return image
+
+
+def variants(megapixels: float):
+    sharp = synthetic_receipt(megapixels)
+    yield "sharp", sharp
+    for radius in (2, 6):
+        yield f"blur r={radius}", sharp.filter(ImageFilter.GaussianBlur(radius * max(1, sharp.width // 1000)))
+    yield "blank", Image.new("RGB", sharp.size, (236, 236, 232))
+    yield "overexposed", ImageEnhance.Brightness(sharp).enhance(8.0)
+    yield "dark", ImageEnhance.Brightness(sharp).enhance(0.02)
+    yield "low-res", sharp.resize((sharp.width // 12, sharp.height // 12))
+
+
+def encode(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def median_ms(func, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def verdict(func) -> str:
+    try:
+        report = func()
+    except PreflightError as exc:
+        return f"reject:{exc.reason:<12} {exc.metrics}"
+    return f"ok{'':<15} {report.metrics() if report else 'numpy unavailable'}"
+
+
+def measure(label: str, payload: bytes, runs: int) -> None:
+    encoded = base64.b64encode(payload).decode("ascii")
+
+    # /process はこのあと同じ画像を BASE64 化するので、デコード済みの画像に対する追加コストを測る
+    decoded = Image.open(io.BytesIO(payload))
+    decoded.load()
+
+    def from_file():
+        return check_image(decoded)
+
+    def from_base64():
+        return check_base64(encoded)
+
+    logger.info(
+        "{:<14} file={:6.1f}ms base64={:6.1f}ms {}",
+        label,
+        median_ms(lambda: _swallow(from_file), runs),
+        median_ms(lambda: _swallow(from_base64), runs),
+        verdict(from_base64),
+    )
+
+
+def _swallow(func) -> None:
+    try:
+        func()
+    except PreflightError:
+        pass
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", type=Path, help="判定を確認したい実画像")
+    parser.add_argument("--megapixels", type=float, default=12.0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for label, image in variants(args.megapixels):
+        measure(label, encode(image), args.runs)
+    for path in args.images:
+        measure(path.name[:14], path.read_bytes(), args.runs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+Harina v3 縦長レシートの分割 OCR ベンチマーク
+
+同じ画像を 1 回で処理した場合と、重なりのある帯に分割して並列処理した場合とで
+レイテンシと商品の再現率（正解 XML に含まれる商品のうち抽出できた割合）を比較する。
+
+    docker compose exec harina uv run python benchmarks/bench_tiling.py --image long.jpg --truth long.xml
+
+--stub-seconds を指定すると LLM を呼ばずに一定時間待つスタブで置き換え、
+分割・エンコード・並列化のオーバーヘッドだけを計測する（API キー不要）。
+"""
+import argparse
+import re
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+
+from harina.core import HarinaCore
+
+_NAME_NOISE = re.compile(r"[\s　・\-－ー*＊]+")
+
+_STUB_XML = (
+    "<receipt><store_info><name>stub</name></store_info>"
+    "<items><item><name>stub</name><total_price>0</total_price></item></items>"
+    "<totals><total>0</total></totals></receipt>"
+)
+
+
+def item_names(xml: str) -> Counter:
+    root = ET.fromstring(xml.strip())
+    names = (item.findtext("n") or item.findtext("name") or "" for item in root.iter("item"))
+    return Counter(_NAME_NOISE.sub("", name).lower() for name in names if name.strip())
+
+
+def recall(result: Counter, truth: Counter) -> float:
+    if not truth:
+        return float("nan")
+    return sum((result & truth).values()) / sum(truth.values())
+
+
+def stub_completion(seconds: float):
+    def _completion(self, messages):
+        time.sleep(seconds)
+        self.last_used_key_label = "stub"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=_STUB_XML))])
+
+    return _completion
+
+
+def run(label: str, core: HarinaCore, image: Path, runs: int, truth: Counter) -> None:
+    latencies = []
+    recalls = []
+    counts = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        with image.open("rb") as handle:
+            xml = core.process_receipt(handle)
+        latencies.append(time.perf_counter() - started)
+        names = item_names(xml)
+        counts.append(sum(names.values()))
+        recalls.append(recall(names, truth))
+    latencies.sort()
+    logger.info(
+        "{:<7} median={:.2f}s max={:.2f}s items={} recall={}",
+        label,
+        latencies[len(latencies) // 2],
+        latencies[-1],
+        counts,
+        ", ".join(f"{value:.0%}" for value in recalls) if truth else "-",
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", required=True, help="縦長レシートの画像")
+    parser.add_argument("--truth", default="", help="正解の商品一覧を含むレシート XML（再現率の計算に使用）")
+    parser.add_argument("--model", default="gemini/gemini-2.5-flash")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--stub-seconds", type=float, default=0.0, help="LLM 呼び出しの代わりに待つ秒数")
+    args = parser.parse_args()
+
+    if args.stub_seconds > 0:
+        HarinaCore._run_completion_with_fallback = stub_completion(args.stub_seconds)
+
+    truth = item_names(Path(args.truth).read_text(encoding="utf-8")) if args.truth else Counter()
+    image = Path(args.image)
+
+    single = HarinaCore(model_name=args.model)
+    single.tiling_enabled = False
+    tiled = HarinaCore(model_name=args.model)
+    tiled.tiling_enabled = True
+
+    run("single", single, image, args.runs, truth)
+    run("tiled", tiled, image, args.runs, truth)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
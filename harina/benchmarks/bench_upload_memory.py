@@ -0,0 +1,151 @@
+"""
+Harina v3 アップロード経路のメモリベンチマーク
+
+uvicorn で起動した別プロセスのサーバーに大きな JPEG を同時アップロードし、サーバープロセスの
+最大 RSS（/proc/<pid>/status の VmHWM）を計測する。エンドポイントごとに新しいサーバーを起動し、
+小さな画像を 1 枚だけ処理させた時点の値をベースラインとして差分も表示する。
+デコード・プリフライト・切り抜き・分割処理などは本番と同じ経路を通り、差し替えるのは LLM 呼び出し
+（`_run_completion_with_fallback`）だけなので API キーは不要。Linux 専用。
+
+    docker compose exec harina uv run python benchmarks/bench_upload_memory.py --concurrency 8 --megapixels 12
+"""
+import argparse
+import asyncio
+import io
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from loguru import logger
+from PIL import Image
+
+ENDPOINTS = ["/process", "/process_raw"]
+
+SERVER = (
+    "import sys\n"
+    "from types import SimpleNamespace\n"
+    "import uvicorn\n"
+    "from harina.core import HarinaCore\n"
+    "XML = '<receipt><store_name>bench</store_name><items/></receipt>'\n"
+    "def _completion(self, messages):\n"
+    "    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=XML))])\n"
+    "HarinaCore._run_completion_with_fallback = _completion\n"
+    "from harina.server import create_app\n"
+    "uvicorn.run(create_app(), host='127.0.0.1', port=int(sys.argv[1]), log_level='warning')\n"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def synthetic_jpeg(megapixels: float) -> bytes:
+    """A noisy receipt-sized JPEG so the encoded size is close to a real phone photo."""
+    width = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    noise = Image.frombytes("L", (width, height), os.urandom(width * height))
+    image = Image.merge("RGB", (noise, noise, noise))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def peak_rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status", encoding="ascii") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError("VmHWM を取得できません")
+
+
+async def upload(client: httpx.AsyncClient, endpoint: str, payload: bytes) -> str:
+    if endpoint == "/process_raw":
+        response = await client.post(endpoint, content=payload, headers={"content-type": "image/jpeg"})
+    else:
+        response = await client.post(endpoint, files={"file": ("bench.jpg", payload, "image/jpeg")}, data={"format": "xml"})
+    if response.status_code != 200:
+        return str(response.status_code)
+    return "ok" if response.json().get("success") else "failed"
+
+
+async def measure_endpoint(endpoint: str, payloads, warmup: bytes, timeout: float):
+    port = free_port()
+    env = dict(os.environ)
+    env.pop("DATABASE_URL", None)
+    env.pop("POSTGRES_HOST", None)
+    server = subprocess.Popen([sys.executable, "-c", SERVER, str(port)], env=env, stdout=subprocess.DEVNULL)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=timeout) as client:
+            started = time.perf_counter()
+            while True:
+                if server.poll() is not None:
+                    raise RuntimeError(f"サーバーが終了しました (exit {server.returncode})")
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.perf_counter() - started > timeout:
+                    raise TimeoutError("サーバーが起動しませんでした")
+                await asyncio.sleep(0.05)
+
+            warmed = await upload(client, endpoint, warmup)
+            if warmed != "ok":
+                raise RuntimeError(f"ウォームアップのリクエストが失敗しました ({warmed})")
+            baseline = peak_rss_mb(server.pid)
+            started = time.perf_counter()
+            statuses = await asyncio.gather(*(upload(client, endpoint, payload) for payload in payloads))
+            elapsed = time.perf_counter() - started
+            return baseline, peak_rss_mb(server.pid), elapsed, sorted(set(statuses))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def run(args) -> int:
+    payloads = [synthetic_jpeg(args.megapixels) for _ in range(args.concurrency)]
+    warmup = synthetic_jpeg(0.3)
+    logger.info(
+        "🖼️ {} uploads of {:.1f}MP JPEG ({:.1f}MB avg)",
+        args.concurrency,
+        args.megapixels,
+        sum(len(payload) for payload in payloads) / len(payloads) / 1024 / 1024,
+    )
+
+    failed = False
+    for endpoint in args.endpoints:
+        try:
+            baseline, peak, elapsed, statuses = await measure_endpoint(endpoint, payloads, warmup, args.timeout)
+        except (RuntimeError, TimeoutError) as exc:
+            logger.error("❌ {}: {}", endpoint, exc)
+            return 1
+        failed |= statuses != ["ok"]
+        logger.info(
+            "🧠 {:<12} baseline={:.1f}MB peak={:.1f}MB (+{:.1f}MB) elapsed={:.2f}s status={}",
+            endpoint,
+            baseline,
+            peak,
+            peak - baseline,
+            elapsed,
+            statuses,
+        )
+    return 1 if failed else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8, help="同時アップロード数")
+    parser.add_argument("--megapixels", type=float, default=12.0, help="アップロードする画像の画素数（MP）")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS, help="計測するエンドポイント")
+    parser.add_argument("--timeout", type=float, default=300.0, help="起動・1 リクエストを打ち切る秒数")
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,431 @@
+"""Resumable bulk import of a directory of receipt images.
+
+    uv run python -m harina.bulk_import /data/scans --output /data/out --format xml,csv --persist
+
+Images are decoded and re-encoded in a process pool, LLM calls run with bounded
+concurrency (and an optional requests-per-minute cap for the key pool), and every
+finished file is appended to ``manifest.jsonl`` in the output directory so an
+interrupted run picks up where it stopped. With ``--persist`` an image whose
+SHA-256 is already in the manifest or the database is not inserted again.
+
+The importer calls :class:`HarinaCore` directly, so the server's admission
+control (priority lanes, 429) does not apply; ``--concurrency`` and ``--rpm``
+are the only limits.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from dotenv import load_dotenv
+from loguru import logger
+from PIL import ImageOps
+
+from .category_memo import record_items, start_memo_load
+from .core import HarinaCore
+from .decoding import bounded_decode, open_image
+from .receipt_store import find_receipt_by_content, parse_receipt_xml, save_receipt
+from .usage import get_usage_tracker, start_usage_flusher
+from .utils import convert_xml_to_csv, image_to_base64
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+MANIFEST_NAME = "manifest.jsonl"
+PROGRESS_INTERVAL_SECONDS = 5.0
+
+
+@dataclass
+class PreparedImage:
+    relative: str
+    image_base64: str
+    sha256: str
+
+
+def discover_images(root: Path) -> List[Path]:
+    return sorted(
+        path for path in root.rglob("*")
+        if path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES
+    )
+
+
+def _fingerprint(path: Path) -> Dict[str, int]:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_manifest(path: Path) -> Dict[str, dict]:
+    """Latest manifest entry per file; a torn last line from a crash is ignored."""
+    entries: Dict[str, dict] = {}
+    if not path.exists():
+        return entries
+    with path.open(encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry["file"]] = entry
+    return entries
+
+
+def prepare_image(root: str, relative: str) -> PreparedImage:
+    """Decode, apply EXIF rotation and encode for the LLM; runs in a worker process."""
+    path = Path(root) / relative
+    data = path.read_bytes()
+    with open_image(path) as opened, bounded_decode(opened) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image_base64 = image_to_base64(image)
+    return PreparedImage(relative, image_base64, hashlib.sha256(data).hexdigest())
+
+
+class RateLimiter:
+    """Spaces LLM call starts evenly so a run stays under a requests-per-minute quota.
+
+    HarinaCore calls :meth:`wait` before every API request from its worker thread,
+    so tiled bands, retries and follow-up calls all count against the quota.
+    """
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BulkImporter:
+    def __init__(
+        self,
+        root: Path,
+        output: Path,
+        formats: Sequence[str],
+        model: str,
+        concurrency: int,
+        workers: int,
+        requests_per_minute: float,
+        persist: bool,
+        uploader: Optional[str],
+        instructions: Optional[str],
+        retry_failed: bool,
+    ):
+        self.root = root
+        self.output = output
+        self.formats = formats
+        self.model = model
+        self.concurrency = concurrency
+        self.workers = workers
+        self.limiter = RateLimiter(requests_per_minute)
+        self.persist = persist
+        self.uploader = uploader
+        self.instructions = instructions
+        self.retry_failed = retry_failed
+        self.manifest_path = output / MANIFEST_NAME
+        self._manifest = None
+        # 取り込み済み（または処理中）の画像の SHA-256 -> ファイル
+        self._imported: Dict[str, str] = {}
+        self._imported_lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started = 0.0
+
+    def pending_files(self) -> List[str]:
+        finished = load_manifest(self.manifest_path)
+        self._imported = {
+            entry["sha256"]: relative
+            for relative, entry in finished.items()
+            if entry["status"] == "done" and entry.get("sha256")
+        }
+        pending = []
+        skipped = 0
+        for path in discover_images(self.root):
+            relative = path.relative_to(self.root).as_posix()
+            entry = finished.get(relative)
+            unchanged = entry is not None and entry.get("fingerprint") == _fingerprint(path)
+            if unchanged and (entry["status"] == "done" or (entry["status"] == "failed" and not self.retry_failed)):
+                skipped += 1
+                continue
+            pending.append(relative)
+        if skipped:
+            logger.info("⏭️ {} files already in the manifest, skipping", skipped)
+        return pending
+
+    def _record(self, relative: str, status: str, **fields) -> None:
+        entry = {
+            "file": relative,
+            "status": status,
+            "fingerprint": _fingerprint(self.root / relative),
+            "finished_at": time.time(),
+            **fields,
+        }
+        # 1 行ずつ flush + fsync し、途中で止まっても完了分は再処理しない
+        self._manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._manifest.flush()
+        os.fsync(self._manifest.fileno())
+
+    def _write_outputs(self, relative: str, xml_result: str) -> List[str]:
+        written = []
+        base = self.output / relative
+        base.parent.mkdir(parents=True, exist_ok=True)
+        for output_format in self.formats:
+            # IMG_1.jpg と IMG_1.png が衝突しないよう元の拡張子を残す
+            target = base.with_name(f"{base.name}.{output_format}")
+            payload = xml_result if output_format == "xml" else convert_xml_to_csv(xml_result)
+            target.write_text(payload, encoding="utf-8")
+            written.append(target.relative_to(self.output).as_posix())
+        return written
+
+    def _already_imported(self, prepared: PreparedImage) -> Optional[dict]:
+        """Manifest or database entry for an identical image, claiming the digest otherwise."""
+        with self._imported_lock:
+            previous = self._imported.get(prepared.sha256)
+            if previous is None:
+                self._imported[prepared.sha256] = prepared.relative
+        if previous is not None and previous != prepared.relative:
+            return {"sha256": prepared.sha256, "skipped": "duplicate", "same_as": previous}
+        receipt_id = find_receipt_by_content(prepared.sha256)
+        if receipt_id is not None:
+            return {"sha256": prepared.sha256, "skipped": "duplicate", "receipt_id": receipt_id}
+        return None
+
+    def _release(self, prepared: PreparedImage) -> None:
+        with self._imported_lock:
+            if self._imported.get(prepared.sha256) == prepared.relative:
+                del self._imported[prepared.sha256]
+
+    def _process(self, prepared: PreparedImage) -> dict:
+        """Blocking part of one file: LLM call, outputs and optional database insert."""
+        if self.persist:
+            duplicate = self._already_imported(prepared)
+            if duplicate is not None:
+                logger.info("⏭️ {} is already imported ({}), skipping", prepared.relative, prepared.sha256[:12])
+                return duplicate
+        try:
+            return self._recognise(prepared)
+        except Exception:
+            if self.persist:
+                self._release(prepared)
+            raise
+
+    def _recognise(self, prepared: PreparedImage) -> dict:
+        started = time.perf_counter()
+        ocr = HarinaCore(model_name=self.model, uploader=self.uploader)
+        ocr.rate_limiter = self.limiter
+        xml_result = ocr.process_receipt_base64(
+            prepared.image_base64,
+            output_format="xml",
+            additional_instructions=self.instructions,
+        )
+        result = {
+            "sha256": prepared.sha256,
+            "outputs": self._write_outputs(prepared.relative, xml_result),
+            "key": ocr.last_used_key_label,
+        }
+        if self.persist:
+            record = parse_receipt_xml(xml_result)
+            saved = save_receipt(
+                record,
+                filename=Path(prepared.relative).name,
+                model_used=self.model,
+                uploader=self.uploader,
+                content_sha256=prepared.sha256,
+            )
+            if not saved.already_saved:
+                record_items(record.store_name, record.items)
+            result["receipt_id"] = saved.id
+            result["duplicate_of"] = saved.duplicate_of
+        result["seconds"] = round(time.perf_counter() - started, 2)
+        return result
+
+    def _log_progress(self, final: bool = False) -> None:
+        elapsed = time.monotonic() - self.started
+        finished = self.done + self.failed
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - finished
+        eta = remaining / rate if rate > 0 else float("inf")
+        logger.info(
+            "{} {}/{} files ({} failed) | {:.1f} files/min | elapsed {} | ETA {}",
+            "🏁" if final else "📈",
+            finished,
+            self.total,
+            self.failed,
+            rate * 60,
+            _format_duration(elapsed),
+            "-" if final or eta == float("inf") else _format_duration(eta),
+        )
+        if final:
+            usage = get_usage_tracker().totals()
+            tokens = sum(totals.prompt_tokens + totals.completion_tokens for totals in usage.values())
+            cost = sum(totals.cost_usd for totals in usage.values())
+            logger.info("🪙 {} tokens | ${:.4f}", tokens, cost)
+
+    async def run(self) -> int:
+        pending = self.pending_files()
+        self.total = len(pending)
+        if not pending:
+            logger.info("✅ Nothing to import")
+            return 0
+
+        self.output.mkdir(parents=True, exist_ok=True)
+        logger.info(
+            "🚚 Importing {} files: {} preprocess workers, {} concurrent LLM calls",
+            self.total,
+            self.workers,
+            self.concurrency,
+        )
+        loop = asyncio.get_running_loop()
+        paths: asyncio.Queue = asyncio.Queue()
+        for relative in pending:
+            paths.put_nowait(relative)
+        # 前処理済み画像は LLM 側の並列数の 2 倍までしか溜めない（メモリを抑える）
+        prepared: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.started = time.monotonic()
+
+        async def preprocess(pool: ProcessPoolExecutor) -> None:
+            while True:
+                try:
+                    relative = paths.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    item = await loop.run_in_executor(pool, prepare_image, str(self.root), relative)
+                except Exception as exc:  # noqa: BLE001 - one bad file must not stop the run
+                    logger.warning("⚠️ Failed to read {}: {}", relative, exc)
+                    self.failed += 1
+                    self._record(relative, "failed", error=f"preprocess: {exc}")
+                    continue
+                await prepared.put(item)
+
+        async def recognise(threads: ThreadPoolExecutor) -> None:
+            while True:
+                item = await prepared.get()
+                if item is None:
+                    return
+                try:
+                    result = await loop.run_in_executor(threads, self._process, item)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("⚠️ Failed to process {}: {}", item.relative, exc)
+                    self.failed += 1
+                    self._record(item.relative, "failed", sha256=item.sha256, error=str(exc))
+                else:
+                    self.done += 1
+                    self._record(item.relative, "done", **result)
+
+        async def report() -> None:
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+                self._log_progress()
+
+        with self.manifest_path.open("a", encoding="utf-8") as manifest, \
+                ProcessPoolExecutor(max_workers=self.workers) as pool, \
+                ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="harina-bulk") as threads:
+            self._manifest = manifest
+            reporter = asyncio.create_task(report())
+            consumers = [asyncio.create_task(recognise(threads)) for _ in range(self.concurrency)]
+            try:
+                await asyncio.gather(*(preprocess(pool) for _ in range(self.workers)))
+                for _ in consumers:
+                    await prepared.put(None)
+                await asyncio.gather(*consumers)
+            finally:
+                reporter.cancel()
+                for consumer in consumers:
+                    consumer.cancel()
+                self._log_progress(final=True)
+
+        return 1 if self.failed else 0
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m harina.bulk_import",
+        description="ディレクトリ内のレシート画像を一括で解析し、XML/CSV（とデータベース）に保存します",
+    )
+    parser.add_argument("source", type=Path, help="画像を探索するディレクトリ")
+    parser.add_argument("--output", type=Path, default=Path("bulk_output"), help="XML/CSV とマニフェストの出力先")
+    parser.add_argument("--format", default="xml", help="出力形式（カンマ区切り: xml,csv）")
+    parser.add_argument("--model", default="gemini/gemini-2.5-flash")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.environ.get("HARINA_BULK_CONCURRENCY", "4")),
+        help="同時に実行する LLM 呼び出し数",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) - 1),
+        help="画像の前処理に使うプロセス数",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        default=float(os.environ.get("HARINA_BULK_RPM", "0")),
+        help="1分あたりの LLM API 呼び出し上限。分割処理・再試行・再確認・分類の呼び出しも数える（0 で無制限）",
+    )
+    parser.add_argument("--persist", action="store_true", help="解析結果を receipts / receipt_items に保存する")
+    parser.add_argument("--uploader", default=None, help="保存時のアップローダー")
+    parser.add_argument("--instructions", default=None, help="追加の解析指示")
+    parser.add_argument("--retry-failed", action="store_true", help="前回失敗したファイルも再処理する")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    load_dotenv(Path.cwd() / ".env")
+
+    formats = [value.strip().lower() for value in args.format.split(",") if value.strip()]
+    if not formats or any(value not in ("xml", "csv") for value in formats):
+        parser.error("--format には xml / csv を指定してください")
+    if not args.source.is_dir():
+        parser.error(f"ディレクトリが見つかりません: {args.source}")
+
+    importer = BulkImporter(
+        root=args.source,
+        output=args.output,
+        formats=formats,
+        model=args.model,
+        concurrency=max(1, args.concurrency),
+        workers=max(1, args.workers),
+        requests_per_minute=args.rpm,
+        persist=args.persist,
+        uploader=args.uploader,
+        instructions=args.instructions,
+        retry_failed=args.retry_failed,
+    )
+    start_usage_flusher()
+    start_memo_load()
+    try:
+        return asyncio.run(importer.run())
+    except KeyboardInterrupt:
+        logger.warning("⏸️ Interrupted; rerun the same command to resume from {}", importer.manifest_path)
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""Learned item-name → category memo built from stored ``receipt_items``.
+
+Most items repeat every week, so the (category, subcategory) they were filed
+under before is a better answer than asking the LLM again. The memo counts
+how often each normalized item name (per store, and across all stores) was
+stored with each category, and answers only when one category dominates.
+
+It is used in two ways after OCR:
+
+* ``prefill``: confident memo answers overwrite the LLM's categories.
+* ``deferred``: the OCR prompt omits the category catalog altogether; the
+  memo fills what it knows and only the unknown item names are categorised
+  with a short text-only call.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import time
+import unicodedata
+from dataclasses import dataclass
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+
+from .category_sync import is_valid_category
+from .database import database_dsn, load_psycopg
+from .duplicates import normalize_store_name
+from .receipt_store import ReceiptItemRecord, element_text
+
+MEMO_OFF = "off"
+MEMO_PREFILL = "prefill"
+MEMO_DEFERRED = "deferred"
+
+# off / prefill / deferred（deferred はカテゴリ一覧をプロンプトに含めず、未知の商品だけを別途分類する）
+CATEGORY_MEMO_MODE = os.environ.get("HARINA_CATEGORY_MEMO_MODE", MEMO_PREFILL).lower()
+# この回数以上、かつこの割合以上同じカテゴリで保存されていれば確定とみなす
+CATEGORY_MEMO_MIN_COUNT = int(os.environ.get("HARINA_CATEGORY_MEMO_MIN_COUNT", "2"))
+CATEGORY_MEMO_MIN_SHARE = float(os.environ.get("HARINA_CATEGORY_MEMO_MIN_SHARE", "0.8"))
+# アプリ側での編集や再分類を取り込むための再構築間隔
+CATEGORY_MEMO_REFRESH_SECONDS = float(os.environ.get("HARINA_CATEGORY_MEMO_REFRESH_SECONDS", "600"))
+_LOAD_BATCH_SIZE = 5000
+
+_NAME_NOISE = re.compile(r"[\s\W_]+")
+_ITEMS = re.compile(r"<items\b.*?</items>", re.DOTALL)
+
+Assignment = Tuple[str, str]
+Catalog = Dict[str, Set[str]]
+
+
+def normalize_item_name(name: Optional[str]) -> str:
+    value = unicodedata.normalize("NFKC", name or "")
+    return _NAME_NOISE.sub("", value).lower()
+
+
+@dataclass(frozen=True)
+class MemoHit:
+    category: str
+    subcategory: str
+    count: int
+    share: float
+    scope: str
+
+
+class CategoryMemo:
+    """Category counts per (store, item name) and per item name."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._by_store: Dict[Tuple[str, str], Dict[Assignment, int]] = {}
+        self._by_name: Dict[str, Dict[Assignment, int]] = {}
+        self._last_refresh = 0.0
+        self._refreshing = False
+        self.ready = False
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._by_name)
+
+    def add(self, store_name: Optional[str], item_name: str, category: str, subcategory: str, count: int = 1) -> None:
+        name = normalize_item_name(item_name)
+        if not name or not category:
+            return
+        assignment = (category, subcategory or "")
+        store = normalize_store_name(store_name)
+        with self._lock:
+            for counts in (
+                self._by_store.setdefault((store, name), {}),
+                self._by_name.setdefault(name, {}),
+            ):
+                counts[assignment] = counts.get(assignment, 0) + count
+
+    def lookup(self, store_name: Optional[str], item_name: str, catalog: Catalog) -> Optional[MemoHit]:
+        """The dominant category for this store, else across stores; None when not confident."""
+        name = normalize_item_name(item_name)
+        if not name:
+            return None
+        store = normalize_store_name(store_name)
+        with self._lock:
+            for scope, counts in (("store", self._by_store.get((store, name))), ("any", self._by_name.get(name))):
+                hit = _confident(counts, scope, catalog)
+                if hit is not None:
+                    return hit
+        return None
+
+    def rebuild(self, conn) -> int:
+        """Replace the counts with an aggregate over ``receipt_items``; returns the aggregate row count."""
+        by_store: Dict[Tuple[str, str], Dict[Assignment, int]] = {}
+        by_name: Dict[str, Dict[Assignment, int]] = {}
+        rows = 0
+        with conn.transaction(), conn.cursor(name="harina_category_memo") as cur:
+            cur.itersize = _LOAD_BATCH_SIZE
+            cur.execute(
+                "SELECT r.store_name, ri.name, ri.category, COALESCE(ri.subcategory, ''), COUNT(*) "
+                "FROM receipt_items ri JOIN receipts r ON r.id = ri.receipt_id "
+                "WHERE ri.category IS NOT NULL AND ri.category <> '' "
+                "GROUP BY 1, 2, 3, 4"
+            )
+            for store_name, item_name, category, subcategory, count in cur:
+                name = normalize_item_name(item_name)
+                if not name:
+                    continue
+                assignment = (category, subcategory)
+                for counts in (
+                    by_store.setdefault((normalize_store_name(store_name), name), {}),
+                    by_name.setdefault(name, {}),
+                ):
+                    counts[assignment] = counts.get(assignment, 0) + count
+                rows += 1
+        with self._lock:
+            self._by_store = by_store
+            self._by_name = by_name
+        self._last_refresh = time.monotonic()
+        return rows
+
+    def refresh_due(self) -> bool:
+        return time.monotonic() - self._last_refresh >= CATEGORY_MEMO_REFRESH_SECONDS
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"ready": self.ready, "names": len(self._by_name), "storeNames": len(self._by_store)}
+
+
+def _confident(counts: Optional[Dict[Assignment, int]], scope: str, catalog: Catalog) -> Optional[MemoHit]:
+    if not counts:
+        return None
+    assignment, count = max(counts.items(), key=lambda entry: entry[1])
+    share = count / sum(counts.values())
+    if count < CATEGORY_MEMO_MIN_COUNT or share < CATEGORY_MEMO_MIN_SHARE:
+        return None
+    # カテゴリ一覧の変更で無くなった分類は使わない
+    if not is_valid_category(catalog, *assignment):
+        return None
+    return MemoHit(assignment[0], assignment[1], count, share, scope)
+
+
+_MEMO = CategoryMemo()
+
+
+def get_category_memo() -> CategoryMemo:
+    return _MEMO
+
+
+def _connect():
+    dsn = database_dsn()
+    if not dsn:
+        return None
+    psycopg = load_psycopg()
+    if psycopg is None:
+        return None
+    return psycopg.connect(dsn, autocommit=True)
+
+
+def refresh_category_memo() -> Optional[int]:
+    try:
+        conn = _connect()
+        if conn is None:
+            return None
+        with conn:
+            rows = _MEMO.rebuild(conn)
+    except Exception as exc:  # pragma: no cover - defensive logging
+        logger.exception("Failed to build the category memo: {}", exc)
+        return None
+    _MEMO.ready = True
+    return rows
+
+
+def start_memo_load() -> Thread:
+    """Build (or rebuild) the memo in a daemon thread; lookups miss until it is ready."""
+
+    def _run() -> None:
+        started = time.perf_counter()
+        try:
+            rows = refresh_category_memo()
+        finally:
+            _MEMO._refreshing = False
+        if rows is not None:
+            logger.info(
+                "🏷️ 商品カテゴリのメモを構築しました: {} 商品名 ({:.1f}s)", len(_MEMO), time.perf_counter() - started
+            )
+
+    _MEMO._refreshing = True
+    thread = Thread(target=_run, name="harina-category-memo", daemon=True)
+    thread.start()
+    return thread
+
+
+def refresh_in_background_if_due() -> None:
+    if _MEMO.ready and not _MEMO._refreshing and _MEMO.refresh_due():
+        start_memo_load()
+
+
+def record_items(store_name: Optional[str], items: Iterable[ReceiptItemRecord]) -> None:
+    """Count the items of a receipt saved by this process."""
+    for item in items:
+        _MEMO.add(store_name, item.name, item.category, item.subcategory)
+
+
+def prefill(root: ET.Element, catalog: Catalog) -> Tuple[int, int, List[ET.Element]]:
+    """Apply confident memo answers to ``root``; returns (hits, values changed, items still unknown)."""
+    store_name = element_text(root.find("store_info"), "n", "name")
+    hits = changed = 0
+    unknown: List[ET.Element] = []
+    for item in root.findall("./items/item"):
+        hit = _MEMO.lookup(store_name, element_text(item, "n", "name"), catalog)
+        if hit is None:
+            unknown.append(item)
+            continue
+        hits += 1
+        changed += set_category(item, (hit.category, hit.subcategory))
+    return hits, changed, unknown
+
+
+def set_category(item: ET.Element, assignment: Assignment) -> int:
+    changed = 0
+    for field, value in zip(("category", "subcategory"), assignment):
+        node = item.find(field)
+        if node is None:
+            node = ET.SubElement(item, field)
+        if (node.text or "").strip() != value:
+            node.text = value
+            changed = 1
+    return changed
+
+
+def build_categorize_prompt(categories_xml: str, names: Sequence[str]) -> str:
+    """Text-only prompt asking for the category of each numbered item name."""
+    lines = [
+        "以下はレシートから読み取った商品名の一覧です。",
+        "各商品について、下のカテゴリ一覧から最も適切なカテゴリとサブカテゴリを選択してください。",
+        "カテゴリ名・サブカテゴリ名は一覧の表記をそのまま使ってください。",
+        "",
+        categories_xml,
+        "",
+        "商品一覧（番号: 商品名）:",
+    ]
+    lines.extend(f"{index}: {name}" for index, name in enumerate(names, start=1))
+    lines.extend([
+        "",
+        "商品名は出力せず、番号ごとに以下の XML 形式のみで回答してください。",
+        "<items>",
+        '  <item index="1"><category></category><subcategory></subcategory></item>',
+        "</items>",
+    ])
+    return "\n".join(lines)
+
+
+def parse_categorize_answer(response_text: str, count: int) -> Dict[int, Assignment]:
+    """0-based index -> (category, subcategory) from an ``<items>`` answer; malformed entries are skipped."""
+    match = _ITEMS.search(response_text or "")
+    if not match:
+        return {}
+    try:
+        root = ET.fromstring(match.group(0))
+    except ET.ParseError:
+        return {}
+    answers: Dict[int, Assignment] = {}
+    for item in root.findall("item"):
+        index = item.get("index", "")
+        if not index.isdigit() or not 1 <= int(index) <= count:
+            continue
+        answers[int(index) - 1] = (element_text(item, "category"), element_text(item, "subcategory"))
+    return answers
@@ -2,19 +2,16 @@
 
 from __future__ import annotations
 
-import importlib
 import os
+import tempfile
 from dataclasses import dataclass
-from threading import Lock
-from typing import Iterable, List, Optional
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterable, List, Optional, Set
 from xml.etree import ElementTree as ET
 
 from loguru import logger
 
-try:  # psycopg is optional when running without a database
-    import psycopg
-except ModuleNotFoundError:  # pragma: no cover - runtime guard
-    psycopg = None  # type: ignore
+from .database import database_dsn, load_psycopg
 
 
 @dataclass(frozen=True)
@@ -29,41 +26,10 @@ _DEFAULT_SOURCE_PATH = os.environ.get(
     "HARINA_CATEGORY_SOURCE_PATH",
     os.path.join(os.path.dirname(__file__), "product_categories.xml"),
 )
-
-
-def _database_dsn() -> Optional[str]:
-    url = os.environ.get("DATABASE_URL")
-    if url:
-        return url
-
-    host = os.environ.get("POSTGRES_HOST")
-    database = os.environ.get("POSTGRES_DB")
-    user = os.environ.get("POSTGRES_USER")
-    password = os.environ.get("POSTGRES_PASSWORD")
-    port = os.environ.get("POSTGRES_PORT", "5432")
-
-    if not all([host, database, user, password]):
-        return None
-
-    return f"postgresql://{user}:{password}@{host}:{port}/{database}"
-
-
-def _ensure_psycopg() -> bool:
-    """Ensure psycopg is importable so we can hit Postgres."""
-
-    global psycopg
-
-    if psycopg is not None:
-        return True
-
-    try:
-        psycopg = importlib.import_module("psycopg")  # type: ignore[assignment]
-        return True
-    except ModuleNotFoundError:
-        logger.error(
-            "psycopg is missing; skipping category sync. Install psycopg[binary] in the HARINA service."
-        )
-        return False
+_SNAPSHOT_PATH = os.environ.get(
+    "HARINA_CATEGORY_SNAPSHOT_PATH",
+    os.path.join(tempfile.gettempdir(), "harina_categories_snapshot.xml"),
+)
 
 
 def _ensure_schema(conn: "psycopg.Connection") -> None:
@@ -102,7 +68,38 @@ def _load_source_categories() -> List[CategoryDefinition]:
         return []
 
     tree = ET.parse(path)
-    root = tree.getroot()
+    return _parse_definitions(tree.getroot())
+
+
+def parse_categories_xml(xml_payload: str) -> List[CategoryDefinition]:
+    """Parse a ``<product_categories>`` payload such as the one from :func:`get_categories_xml`."""
+
+    try:
+        root = ET.fromstring(xml_payload.strip())
+    except ET.ParseError as exc:
+        logger.warning("Failed to parse categories XML: {}", exc)
+        return []
+    return _parse_definitions(root)
+
+
+def load_catalog(xml_payload: str) -> Dict[str, Set[str]]:
+    """Category name -> set of its subcategory names."""
+
+    return {
+        definition.name: set(definition.subcategories)
+        for definition in parse_categories_xml(xml_payload)
+    }
+
+
+def is_valid_category(catalog: Dict[str, Set[str]], category: str, subcategory: str) -> bool:
+    if category not in catalog:
+        return False
+    subcategories = catalog[category]
+    # サブカテゴリのないカテゴリは空欄のみ有効
+    return subcategory in subcategories if subcategories else not subcategory
+
+
+def _parse_definitions(root: ET.Element) -> List[CategoryDefinition]:
     definitions: List[CategoryDefinition] = []
     for category in root.findall("category"):
         name = category.get("name", "").strip()
@@ -117,33 +114,42 @@ def _load_source_categories() -> List[CategoryDefinition]:
     return definitions
 
 
-def _upsert_category(
-    conn: "psycopg.Connection", name: str, display_order: int
-) -> int:
-    query = (
+def _upsert_definitions(
+    conn: "psycopg.Connection", definitions: List[CategoryDefinition]
+) -> None:
+    """Upsert every category and subcategory with batched statements."""
+
+    if not definitions:
+        return
+
+    category_query = (
         "INSERT INTO categories (name, display_order) VALUES (%s, %s) "
-        "ON CONFLICT (name) DO UPDATE SET display_order = EXCLUDED.display_order "
-        "RETURNING id"
+        "ON CONFLICT (name) DO UPDATE SET display_order = EXCLUDED.display_order"
     )
-    with conn.cursor() as cur:
-        cur.execute(query, (name, display_order))
-        result = cur.fetchone()
-    if not result:
-        raise RuntimeError(f"Failed to upsert category '{name}'")
-    return result[0]
-
-
-def _upsert_subcategory(
-    conn: "psycopg.Connection",
-    category_id: int,
-    name: str,
-    display_order: int,
-) -> None:
-    query = (
+    subcategory_query = (
         "INSERT INTO subcategories (category_id, name, display_order) VALUES (%s, %s, %s) "
         "ON CONFLICT (category_id, name) DO UPDATE SET display_order = EXCLUDED.display_order"
     )
-    conn.execute(query, (category_id, name, display_order))
+
+    with conn.transaction(), conn.cursor() as cur:
+        cur.executemany(
+            category_query,
+            [(category.name, order) for order, category in enumerate(definitions)],
+        )
+        cur.execute(
+            "SELECT name, id FROM categories WHERE name = ANY(%s)",
+            ([category.name for category in definitions],),
+        )
+        category_ids = dict(cur.fetchall())
+
+        subcategory_rows = [
+            (category_ids[category.name], sub_name, sub_order)
+            for category in definitions
+            if category.name in category_ids
+            for sub_order, sub_name in enumerate(category.subcategories)
+        ]
+        if subcategory_rows:
+            cur.executemany(subcategory_query, subcategory_rows)
 
 
 def _fetch_categories_from_db(conn: "psycopg.Connection") -> List[CategoryDefinition]:
@@ -211,12 +217,13 @@ def sync_categories_with_database() -> Optional[str]:
 
     global _CATEGORIES_XML_CACHE
 
-    dsn = _database_dsn()
+    dsn = database_dsn()
     if not dsn:
         logger.warning("DATABASE_URL or individual Postgres credentials are not set; skipping category sync")
         return None
 
-    if not _ensure_psycopg():
+    psycopg = load_psycopg()
+    if psycopg is None:
         return None
 
     source_definitions = _load_source_categories()
@@ -226,11 +233,7 @@ def sync_categories_with_database() -> Optional[str]:
     try:
         with psycopg.connect(dsn, autocommit=True) as conn:
             _ensure_schema(conn)
-            for cat_order, category in enumerate(source_definitions):
-                category_id = _upsert_category(conn, category.name, cat_order)
-                for sub_order, sub_name in enumerate(category.subcategories):
-                    _upsert_subcategory(conn, category_id, sub_name, sub_order)
-
+            _upsert_definitions(conn, source_definitions)
             definitions = _fetch_categories_from_db(conn)
     except Exception as exc:  # pragma: no cover - defensive logging
         logger.exception("Failed to synchronise categories with the database: {}", exc)
@@ -239,6 +242,7 @@ def sync_categories_with_database() -> Optional[str]:
     xml_payload = _build_categories_xml(definitions)
     with _CACHE_LOCK:
         _CATEGORIES_XML_CACHE = xml_payload
+    _write_snapshot(xml_payload)
     return xml_payload
 
 
@@ -253,12 +257,13 @@ def get_categories_xml(refresh: bool = False) -> Optional[str]:
     if cached is not None and not refresh:
         return cached
 
-    dsn = _database_dsn()
+    dsn = database_dsn()
     if not dsn:
         logger.warning("DATABASE_URL or Postgres credentials are not configured; cannot fetch categories")
         return cached
 
-    if not _ensure_psycopg():
+    psycopg = load_psycopg()
+    if psycopg is None:
         return cached
 
     try:
@@ -273,4 +278,67 @@ def get_categories_xml(refresh: bool = False) -> Optional[str]:
 
     with _CACHE_LOCK:
         _CATEGORIES_XML_CACHE = xml_payload
+    _write_snapshot(xml_payload)
     return xml_payload
+
+
+def _write_snapshot(xml_payload: str) -> None:
+    try:
+        tmp_path = f"{_SNAPSHOT_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            handle.write(xml_payload)
+        os.replace(tmp_path, _SNAPSHOT_PATH)
+    except OSError as exc:  # pragma: no cover - best effort cache
+        logger.warning("Failed to persist category snapshot to {}: {}", _SNAPSHOT_PATH, exc)
+
+
+def load_category_snapshot() -> Optional[str]:
+    """Seed the cache from the last-known snapshot, or the bundled XML, without touching Postgres."""
+
+    global _CATEGORIES_XML_CACHE
+
+    with _CACHE_LOCK:
+        if _CATEGORIES_XML_CACHE is not None:
+            return _CATEGORIES_XML_CACHE
+
+    xml_payload: Optional[str] = None
+    if os.path.exists(_SNAPSHOT_PATH):
+        try:
+            with open(_SNAPSHOT_PATH, encoding="utf-8") as handle:
+                xml_payload = handle.read() or None
+        except OSError as exc:  # pragma: no cover - fall back to bundled XML
+            logger.warning("Failed to read category snapshot {}: {}", _SNAPSHOT_PATH, exc)
+
+    if xml_payload is None:
+        definitions = _load_source_categories()
+        if definitions:
+            xml_payload = _build_categories_xml(definitions)
+
+    if xml_payload is None:
+        return None
+
+    with _CACHE_LOCK:
+        if _CATEGORIES_XML_CACHE is None:
+            _CATEGORIES_XML_CACHE = xml_payload
+        return _CATEGORIES_XML_CACHE
+
+
+def start_background_sync(
+    on_complete: Optional[Callable[[Optional[str]], None]] = None,
+) -> Thread:
+    """Run ``sync_categories_with_database`` in a daemon thread.
+
+    Requests keep being served from the seeded snapshot until the sync
+    finishes and swaps the cache.
+    """
+
+    def _run() -> None:
+        snapshot = sync_categories_with_database()
+        if snapshot is None:
+            snapshot = get_categories_xml(refresh=True)
+        if on_complete is not None:
+            on_complete(snapshot)
+
+    thread = Thread(target=_run, name="harina-category-sync", daemon=True)
+    thread.start()
+    return thread
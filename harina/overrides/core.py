@@ -1,12 +1,18 @@
 """Harina v3 - Receipt OCR using Gemini API via LiteLLM (overridden)."""
 
+import base64
+import copy
+import importlib
+import io
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from xml.etree import ElementTree as ET
+from typing import BinaryIO, Callable, List, Optional, Union
 
-import litellm
 from loguru import logger
-from PIL import Image
+from PIL import Image, ImageOps
 
 from .utils import (
     image_to_base64,
@@ -14,7 +20,64 @@ from .utils import (
     format_xml,
     convert_xml_to_csv
 )
-from .category_sync import get_categories_xml
+from .category_memo import (
+    CATEGORY_MEMO_MODE,
+    MEMO_DEFERRED,
+    MEMO_OFF,
+    MEMO_PREFILL,
+    build_categorize_prompt,
+    get_category_memo,
+    parse_categorize_answer,
+    prefill,
+    refresh_in_background_if_due,
+    set_category,
+)
+from .category_sync import get_categories_xml, is_valid_category, load_catalog
+from .tiling import (
+    TILE_CONCURRENCY,
+    TILING_ENABLED,
+    EncodedTiles,
+    band_instructions,
+    display_size,
+    merge_band_xml,
+    needs_tiling,
+    peek_base64_size,
+    split_bands,
+)
+from .decoding import ImageTooLargeError, bounded_decode, check_pixels, open_image
+from .cropping import CROP_ENABLED, CropResult, apply as apply_crop, detect_preview
+from .retries import (
+    LLM_DEADLINE_SECONDS,
+    LLM_MAX_ATTEMPTS,
+    ErrorClass,
+    backoff_delay,
+    classify,
+    get_retry_budget,
+)
+from .duplicates import DuplicateImageError, get_duplicate_index, image_dhash
+from .preflight import PREFLIGHT_ENABLED, Preview, check_preview, decode_preview, upright_preview
+from .receipt_store import element_text
+from .reconcile import (
+    RECONCILE_ENABLED,
+    RECONCILE_MAX_ISSUES,
+    apply_corrections,
+    build_followup_prompt,
+    find_issues,
+    summary,
+)
+from .usage import UsageRecord, combine_usage, get_usage_tracker, usage_from_response
+
+_litellm = None
+
+
+def _get_litellm():
+    """Import litellm on first use; the import alone takes seconds at startup."""
+
+    global _litellm
+
+    if _litellm is None:
+        _litellm = importlib.import_module("litellm")
+    return _litellm
 
 
 class HarinaCore:
@@ -24,13 +87,30 @@ class HarinaCore:
         self,
         model_name: str = "gemini/gemini-2.5-flash",
         template_path: Optional[str] = None,
-        categories_path: Optional[str] = None
+        categories_path: Optional[str] = None,
+        uploader: Optional[str] = None
     ):
         self.model_name = model_name
         self.template_path = template_path
         self.categories_path = categories_path
         self.last_used_fallback = False
         self.last_used_key_label: Optional[str] = None
+        self.tiling_enabled = TILING_ENABLED
+        self.preflight_enabled = PREFLIGHT_ENABLED
+        self.crop_enabled = CROP_ENABLED
+        self.last_crop: Optional[CropResult] = None
+        self.reconcile_enabled = RECONCILE_ENABLED
+        self.last_reconciliation: Optional[dict] = None
+        self.category_mode = CATEGORY_MEMO_MODE
+        self.memo_enabled = True
+        self.last_categorization: Optional[dict] = None
+        self.uploader = uploader
+        self.last_usage: Optional[UsageRecord] = None
+        self.hashing_enabled = True
+        self.skip_duplicates = False
+        # 呼び出しごとに wait() する共有レートリミッター（一括インポートの --rpm など）
+        self.rate_limiter = None
+        self.last_image_hash: Optional[int] = None
 
     def _load_xml_template(self) -> str:
         if self.template_path:
@@ -61,25 +141,99 @@ class HarinaCore:
 
     def process_receipt(
         self,
-        image_path: Path,
+        image_path: Union[Path, BinaryIO],
         output_format: str = 'xml',
         additional_instructions: Optional[str] = None
     ) -> str:
         logger.debug(f"📂 Loading image: {image_path}")
         try:
-            image = Image.open(image_path)
+            image = open_image(image_path)
             logger.debug(f"✅ Image loaded successfully: {image.size} pixels, mode: {image.mode}")
+        except ImageTooLargeError:
+            raise
         except Exception as exc:
             logger.error(f"❌ Failed to load image: {exc}")
             raise ValueError(f"Failed to load image: {exc}") from exc
 
-        logger.debug("🔄 Converting image to base64...")
-        image_base64 = image_to_base64(image)
-        logger.debug(f"✅ Image converted to base64 ({len(image_base64)} characters)")
-
+        with bounded_decode(image) as image:
+            # ハッシュ・画質チェック・切り抜き検出は同じ縮小画像を使い回す
+            shared = upright_preview(image) if self._needs_preview() else None
+            if shared and self.hashing_enabled:
+                self._hash_image(shared.gray)
+
+            if shared and self.preflight_enabled:
+                check_preview(shared)
+
+            if shared and self.crop_enabled:
+                image = self._crop(image, shared)
+
+            tiles = None
+            if self.tiling_enabled and needs_tiling(display_size(image)):
+                tiles = self._encode_tiles(image)
+            else:
+                logger.debug("🔄 Converting image to base64...")
+                image_base64 = image_to_base64(image)
+                logger.debug(f"✅ Image converted to base64 ({len(image_base64)} characters)")
+        # LLM の応答を待つ間、復号済みの画素を保持しない
+        del image
+
+        if tiles:
+            return self._process_tiled(tiles, output_format, additional_instructions)
+
+        return self.process_receipt_base64(
+            image_base64,
+            output_format=output_format,
+            additional_instructions=additional_instructions,
+            prepared=True
+        )
+
+    def process_receipt_base64(
+        self,
+        image_base64: str,
+        output_format: str = 'xml',
+        additional_instructions: Optional[str] = None,
+        prepared: bool = False
+    ) -> str:
+        """Process an already JPEG-encoded base64 payload without decoding it again.
+
+        Unless ``prepared`` (the caller already checked and cropped the image), a reduced
+        preview is decoded first: unusable images raise ``PreflightError``, and the payload
+        is only decoded in full and re-encoded when cropping saves enough area.
+        """
+        size = None if prepared else peek_base64_size(image_base64)
+        if size:
+            check_pixels(size)
+
+        # 縮小プレビューは一度だけ復号し、ハッシュ・画質チェック・切り抜き検出で共有する
+        shared = decode_preview(image_base64) if not prepared and self._needs_preview() else None
+        if shared and self.hashing_enabled:
+            self._hash_image(shared.gray)
+
+        if shared and self.preflight_enabled:
+            check_preview(shared)
+
+        if shared and self.crop_enabled:
+            crop = detect_preview(shared)
+            if crop and crop.worthwhile:
+                with bounded_decode(open_image(io.BytesIO(base64.b64decode(image_base64)))) as image:
+                    cropped_base64 = image_to_base64(apply_crop(ImageOps.exif_transpose(image), crop))
+                del image
+                self._log_crop(crop, len(image_base64), len(cropped_base64))
+                image_base64 = cropped_base64
+                size = None
+
+        if self.tiling_enabled:
+            size = size or peek_base64_size(image_base64)
+            if size and needs_tiling(size):
+                with bounded_decode(open_image(io.BytesIO(base64.b64decode(image_base64)))) as image:
+                    tiles = self._encode_tiles(image)
+                del image
+                return self._process_tiled(tiles, output_format, additional_instructions)
+
+        deferred = self._defer_categories()
         logger.debug("📋 Loading XML template and product categories...")
         xml_template = self._load_xml_template()
-        product_categories = self._load_product_categories()
+        product_categories = None if deferred else self._load_product_categories()
         logger.debug("✅ Templates loaded successfully")
 
         prompt_sections = []
@@ -98,11 +252,19 @@ class HarinaCore:
             "",
             xml_template,
             "",
-            "商品のカテゴリ分けには以下の分類を参考にしてください：",
-            "",
-            product_categories,
-            "",
-            "各商品について、最も適切なカテゴリとサブカテゴリを選択してください。",
+        ])
+        if deferred:
+            # カテゴリは読み取り後に学習済みのメモと別の短い問い合わせで付けるので、一覧を送らない
+            prompt_sections.append("category と subcategory は空のままにしてください。")
+        else:
+            prompt_sections.extend([
+                "商品のカテゴリ分けには以下の分類を参考にしてください：",
+                "",
+                product_categories,
+                "",
+                "各商品について、最も適切なカテゴリとサブカテゴリを選択してください。",
+            ])
+        prompt_sections.extend([
             "情報が読み取れない場合は、該当する要素を空にするか省略してください。",
             "数値は数字のみで出力し、通貨記号は含めないでください。",
             "XMLタグのみを出力し、他の説明文は含めないでください。"
@@ -162,6 +324,9 @@ class HarinaCore:
             formatted_xml = format_xml(xml_content)
             logger.info("✅ XML formatted and validated successfully")
 
+            formatted_xml = self._reconcile(formatted_xml, lambda: image_base64)
+            formatted_xml = self._categorize(formatted_xml, deferred)
+
             if output_format.lower() == 'csv':
                 return convert_xml_to_csv(formatted_xml)
             return formatted_xml
@@ -170,6 +335,213 @@ class HarinaCore:
             logger.error(f"❌ Failed to process receipt: {exc}")
             raise RuntimeError(f"Failed to process receipt: {exc}") from exc
 
+    def complete_text(self, prompt: str) -> str:
+        """Send a text-only prompt (no image) with the same key fallback, retries and usage accounting."""
+        response = self._run_completion_with_fallback([
+            {"role": "user", "content": [{"type": "text", "text": prompt}]}
+        ])
+        if not response.choices or not response.choices[0].message.content:
+            raise ValueError("No response from Gemini API")
+        return response.choices[0].message.content
+
+    def _needs_preview(self) -> bool:
+        return self.hashing_enabled or self.preflight_enabled or self.crop_enabled
+
+    def _hash_image(self, gray: Image.Image) -> None:
+        """dHash of the shared preview for the duplicate index, kept in ``last_image_hash``.
+
+        With ``skip_duplicates`` an image already in the index raises
+        :class:`DuplicateImageError` before any LLM call.
+        """
+        try:
+            self.last_image_hash = image_dhash(gray)
+        except Exception as exc:  # noqa: BLE001 - hashing is best effort
+            logger.warning("⚠️ Failed to compute image hash: {}", exc)
+            return
+        if self.skip_duplicates:
+            match = get_duplicate_index().find(image_hash=self.last_image_hash)
+            if match:
+                raise DuplicateImageError(match, self.last_image_hash)
+
+    def _crop(self, image: Image.Image, shared: Preview) -> Image.Image:
+        """Crop to the receipt paper when that removes enough background; else return ``image``."""
+        crop = detect_preview(shared)
+        if not crop or not crop.worthwhile:
+            return image
+        cropped = apply_crop(ImageOps.exif_transpose(image), crop)
+        self._log_crop(crop, image.width * image.height, cropped.width * cropped.height, unit="px")
+        return cropped
+
+    def _log_crop(self, crop: CropResult, before: int, after: int, unit: str = "chars") -> None:
+        self.last_crop = crop
+        logger.info(
+            "✂️ Cropped to receipt {} (angle {:.1f}°): area -{:.0%}, {} -> {} {}",
+            crop.box,
+            crop.angle,
+            crop.reduction,
+            before,
+            after,
+            unit,
+        )
+
+    def _reconcile(self, formatted_xml: str, image_base64: Callable[[], str]) -> str:
+        """Re-ask only about items/totals whose arithmetic doesn't add up, and merge the answers."""
+        self.last_reconciliation = None
+        if not self.reconcile_enabled:
+            return formatted_xml
+        try:
+            root = ET.fromstring(formatted_xml.strip())
+        except ET.ParseError:
+            return formatted_xml
+        issues = find_issues(root)
+        if not issues:
+            return formatted_xml
+        if len(issues) > RECONCILE_MAX_ISSUES:
+            logger.warning("⚠️ {} arithmetic mismatches, skipping targeted re-query", len(issues))
+            self.last_reconciliation = summary(issues, issues, 0, requeried=False)
+            return formatted_xml
+
+        logger.info("🧮 {} arithmetic mismatch(es), re-asking only those fields", len(issues))
+        prompt = build_followup_prompt(root, issues)
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64()}"}},
+            ]
+        }]
+        answer = self._run_followup(messages, "Targeted re-query")
+        changed = apply_corrections(root, answer)
+        remaining = find_issues(root) if changed else issues
+        if changed and len(remaining) < len(issues):
+            formatted_xml = format_xml(ET.tostring(root, encoding="unicode"))
+        else:
+            changed, remaining = 0, issues
+        logger.info("🧮 Reconciliation changed {} value(s); {} mismatch(es) remain", changed, len(remaining))
+        self.last_reconciliation = summary(issues, remaining, changed, requeried=True)
+        return formatted_xml
+
+    def _run_followup(self, messages, purpose: str) -> str:
+        """A secondary LLM call whose usage is added to the request's; returns "" when it fails."""
+        main_usage, main_label, main_fallback = self.last_usage, self.last_used_key_label, self.last_used_fallback
+        try:
+            response = self._run_completion_with_fallback(messages)
+            return (response.choices[0].message.content if response.choices else "") or ""
+        except Exception as exc:  # noqa: BLE001 - keep the original extraction
+            logger.warning("⚠️ {} failed, keeping the original values: {}", purpose, exc)
+            return ""
+        finally:
+            self.last_usage = combine_usage([main_usage, self.last_usage])
+            self.last_used_key_label = main_label
+            self.last_used_fallback = main_fallback or self.last_used_fallback
+
+    def _defer_categories(self) -> bool:
+        """Leave categories out of the OCR prompt; only once the memo can answer most items."""
+        return self.category_mode == MEMO_DEFERRED and get_category_memo().ready
+
+    def _categorize(self, formatted_xml: str, deferred: bool) -> str:
+        """Fill item categories from the memo, and with a text-only call for unknown items when deferred."""
+        self.last_categorization = None
+        if not self.memo_enabled or self.category_mode == MEMO_OFF:
+            return formatted_xml
+        refresh_in_background_if_due()
+        try:
+            root = ET.fromstring(formatted_xml.strip())
+        except ET.ParseError:
+            return formatted_xml
+        categories_xml = self._load_product_categories()
+        catalog = load_catalog(categories_xml)
+        hits, changed, unknown = prefill(root, catalog)
+
+        asked = answered = 0
+        if deferred and unknown:
+            names = [element_text(item, "n", "name") for item in unknown]
+            logger.info("🏷️ {} item(s) not in the category memo, categorising them by name", len(unknown))
+            answer = self._run_followup(
+                [{"role": "user", "content": [{"type": "text", "text": build_categorize_prompt(categories_xml, names)}]}],
+                "Item categorisation",
+            )
+            for index, assignment in parse_categorize_answer(answer, len(unknown)).items():
+                if is_valid_category(catalog, *assignment):
+                    changed += set_category(unknown[index], assignment)
+                    answered += 1
+            asked = len(unknown)
+
+        if changed:
+            formatted_xml = format_xml(ET.tostring(root, encoding="unicode"))
+        total = hits + len(unknown)
+        if total:
+            logger.info("🏷️ Category memo answered {}/{} item(s), {} changed", hits, total, changed)
+        self.last_categorization = {
+            "mode": MEMO_DEFERRED if deferred else MEMO_PREFILL,
+            "items": total,
+            "memoHits": hits,
+            "changedItems": changed,
+            "asked": asked,
+            "answered": answered,
+        }
+        return formatted_xml
+
+    def _encode_tiles(self, image: Image.Image) -> EncodedTiles:
+        """Encode the bands (and the whole receipt, if reconciliation may re-ask) while the pixels are held."""
+        upright = ImageOps.exif_transpose(image)
+        return EncodedTiles(
+            size=upright.size,
+            bands=[image_to_base64(band) for band in split_bands(upright)],
+            whole=image_to_base64(upright) if self.reconcile_enabled else None,
+        )
+
+    def _process_tiled(
+        self,
+        tiles: EncodedTiles,
+        output_format: str,
+        additional_instructions: Optional[str]
+    ) -> str:
+        """OCR a very tall receipt as overlapping bands in parallel and merge the results.
+
+        Takes already-encoded tiles so no decoded pixels or decode budget are held during the LLM calls.
+        """
+        bands = tiles.bands
+        deferred = self._defer_categories()
+        logger.info(f"🧩 Tall receipt {tiles.size}: processing {len(bands)} bands in parallel")
+
+        # 帯ごとにインスタンスを複製し、キーのフォールバック状態が他の帯と混ざらないようにする
+        workers = [copy.copy(self) for _ in bands]
+        for worker in workers:
+            worker.tiling_enabled = False
+            worker.hashing_enabled = False
+            worker.preflight_enabled = False
+            worker.crop_enabled = False
+            worker.reconcile_enabled = False
+            worker.memo_enabled = False
+            # 帯ごとの判定がずれないよう、カテゴリ一覧を省くかどうかは親で決める
+            worker.category_mode = self.category_mode if deferred else MEMO_PREFILL
+
+        def run_band(index: int) -> str:
+            instructions = "\n".join(
+                part for part in (additional_instructions, band_instructions(index, len(bands))) if part
+            )
+            return workers[index].process_receipt_base64(
+                bands[index],
+                output_format='xml',
+                additional_instructions=instructions
+            )
+
+        with ThreadPoolExecutor(max_workers=min(TILE_CONCURRENCY, len(bands))) as executor:
+            parts = list(executor.map(run_band, range(len(bands))))
+
+        self.last_used_fallback = any(worker.last_used_fallback for worker in workers)
+        labels = {worker.last_used_key_label for worker in workers}
+        self.last_used_key_label = "primary" if "primary" in labels else workers[0].last_used_key_label
+        self.last_usage = combine_usage([worker.last_usage for worker in workers], parallel=True)
+
+        formatted_xml = format_xml(merge_band_xml(parts))
+        formatted_xml = self._reconcile(formatted_xml, lambda: tiles.whole or "")
+        formatted_xml = self._categorize(formatted_xml, deferred)
+        if output_format.lower() == 'csv':
+            return convert_xml_to_csv(formatted_xml)
+        return formatted_xml
+
     def _gemini_key_candidates(self) -> List[tuple[str, Optional[str]]]:
         if not self.model_name.lower().startswith("gemini"):
             return [("other", None)]
@@ -188,38 +560,102 @@ class HarinaCore:
 
         return candidates
 
+    def _record_usage(self, label: str, started: float, response) -> UsageRecord:
+        """Account one completion attempt; ``response`` is None when the call failed."""
+        prompt_tokens, completion_tokens, image_tokens = usage_from_response(response)
+        cost = 0.0
+        if response is not None:
+            try:
+                cost = float(_get_litellm().completion_cost(completion_response=response) or 0.0)
+            except Exception:  # noqa: BLE001 - unknown pricing for this model
+                cost = 0.0
+        record = UsageRecord(
+            model=self.model_name,
+            key_label=label,
+            uploader=self.uploader or "",
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            image_tokens=image_tokens,
+            latency_ms=(time.perf_counter() - started) * 1000,
+            cost_usd=cost,
+            success=response is not None,
+        )
+        get_usage_tracker().record(record)
+        return record
+
     def _run_completion_with_fallback(self, messages):
         self.last_used_fallback = False
         self.last_used_key_label = None
+        self.last_usage = None
         candidates = self._gemini_key_candidates()
         last_error: Optional[Exception] = None
         fallback_used_any = False
 
+        deadline = time.monotonic() + LLM_DEADLINE_SECONDS
+        budget = get_retry_budget()
+        budget.record_request()
+
         for index, (label, candidate) in enumerate(candidates):
-            try:
-                kwargs = {"model": self.model_name, "messages": messages}
-                if candidate:
-                    kwargs["api_key"] = candidate
-                response = litellm.completion(**kwargs)
-                self.last_used_fallback = fallback_used_any
-                self.last_used_key_label = label
-                return response
-            except Exception as exc:  # noqa: BLE001
-                last_error = exc
-                error_message = str(exc).lower()
-                has_additional_candidate = len(candidates) > index + 1
-                should_retry = (
-                    label == "free"
-                    and has_additional_candidate
-                    and candidate is not None
-                    and "quota" in error_message
-                )
-
-                if should_retry:
-                    logger.warning("⚠️ GEMINI_API_KEY_FREE quota exhausted, retrying with GEMINI_API_KEY")
-                    fallback_used_any = True
-                    continue
-                raise
+            attempt = 0
+            while True:
+                try:
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.wait()
+                    kwargs = {
+                        "model": self.model_name,
+                        "messages": messages,
+                        "timeout": max(1.0, deadline - time.monotonic()),
+                    }
+                    if candidate:
+                        kwargs["api_key"] = candidate
+                    started = time.perf_counter()
+                    try:
+                        response = _get_litellm().completion(**kwargs)
+                    except Exception:
+                        self._record_usage(label, started, None)
+                        raise
+                    self.last_usage = self._record_usage(label, started, response)
+                    self.last_used_fallback = fallback_used_any
+                    self.last_used_key_label = label
+                    return response
+                except Exception as exc:  # noqa: BLE001
+                    last_error = exc
+                    error_class = classify(exc)
+                    has_additional_candidate = len(candidates) > index + 1
+                    should_fall_back = (
+                        label == "free"
+                        and has_additional_candidate
+                        and candidate is not None
+                        and error_class in (ErrorClass.QUOTA, ErrorClass.RATE_LIMIT)
+                    )
+
+                    if should_fall_back:
+                        logger.warning("⚠️ GEMINI_API_KEY_FREE quota exhausted, retrying with GEMINI_API_KEY")
+                        fallback_used_any = True
+                        break
+
+                    if not error_class.retryable:
+                        raise
+                    delay = backoff_delay(attempt, exc)
+                    if attempt + 1 >= LLM_MAX_ATTEMPTS or time.monotonic() + delay >= deadline:
+                        logger.warning(
+                            "⚠️ Giving up on {} error after {} attempt(s): {}", error_class.value, attempt + 1, exc
+                        )
+                        raise
+                    if not budget.try_spend():
+                        logger.warning("⚠️ Retry budget exhausted, not retrying {} error: {}", error_class.value, exc)
+                        raise
+                    logger.warning(
+                        "🔁 {} error on {} key (attempt {}/{}), retrying in {:.1f}s: {}",
+                        error_class.value,
+                        label,
+                        attempt + 1,
+                        LLM_MAX_ATTEMPTS,
+                        delay,
+                        exc,
+                    )
+                    time.sleep(delay)
+                    attempt += 1
 
         if last_error:
             self.last_used_fallback = fallback_used_any
@@ -229,3 +665,4 @@ class HarinaCore:
         if self.last_used_key_label is None:
             self.last_used_key_label = "primary" if self.model_name.lower().startswith("gemini") else "other"
         raise RuntimeError("Failed to obtain completion response")
+
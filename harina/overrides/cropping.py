@@ -0,0 +1,225 @@
+"""Crop receipt photos to the paper before they are sent to the LLM.
+
+Detection runs on a ~256px grayscale preview: the paper is separated from
+the background with Otsu's threshold, its extent is found from row and
+column projections, and its skew from the second moments of the mask.
+Background pixels cost image tokens and latency, so only the paper (plus a
+small margin) is encoded.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from .preflight import Preview, decode_preview, np, preview, upright_preview
+
+CROP_ENABLED = os.environ.get("HARINA_CROP_ENABLED", "1").lower() not in ("0", "false", "no")
+DESKEW_ENABLED = os.environ.get("HARINA_DESKEW_ENABLED", "0").lower() not in ("0", "false", "no")
+# 削減できる面積がこの割合未満なら切り抜かない（BASE64 パススルーを優先）
+CROP_MIN_REDUCTION = float(os.environ.get("HARINA_CROP_MIN_REDUCTION", "0.15"))
+# 切り抜き範囲の外側に残す余白（画像サイズに対する割合）
+CROP_MARGIN = float(os.environ.get("HARINA_CROP_MARGIN", "0.02"))
+# この角度（度）未満の傾きは補正しない
+DESKEW_MIN_DEGREES = 1.0
+DESKEW_MAX_DEGREES = 20.0
+
+DETECT_SIDE = 256
+
+
+@dataclass
+class CropResult:
+    box: Tuple[int, int, int, int]
+    original_size: Tuple[int, int]
+    angle: float = 0.0
+
+    @property
+    def reduction(self) -> float:
+        """Share of the original area that is not sent."""
+        left, top, right, bottom = self.box
+        width, height = self.original_size
+        return 1.0 - ((right - left) * (bottom - top)) / max(1, width * height)
+
+    @property
+    def worthwhile(self) -> bool:
+        return self.reduction >= CROP_MIN_REDUCTION or abs(self.angle) >= DESKEW_MIN_DEGREES
+
+    def to_response(self) -> dict:
+        return {
+            "box": list(self.box),
+            "originalSize": list(self.original_size),
+            "angle": round(self.angle, 2),
+            "areaReduction": round(self.reduction, 3),
+        }
+
+
+def _otsu(histogram) -> int:
+    levels = np.arange(256, dtype=np.float64)
+    weight = np.cumsum(histogram, dtype=np.float64)
+    total = weight[-1]
+    mean = np.cumsum(histogram * levels, dtype=np.float64)
+    background = weight
+    foreground = total - weight
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mean[-1] * background / total - mean) ** 2 / (background * foreground)
+    return int(np.nanargmax(between[:-1]))
+
+
+def _widest_run(profile, threshold: float) -> Optional[Tuple[int, int]]:
+    """The contiguous run above ``threshold`` with the largest mass, as [start, end)."""
+    best = None
+    best_mass = 0.0
+    start = None
+    for index, value in enumerate(list(profile) + [0.0]):
+        if value > threshold and start is None:
+            start = index
+        elif value <= threshold and start is not None:
+            mass = float(profile[start:index].sum())
+            if mass > best_mass:
+                best, best_mass = (start, index), mass
+            start = None
+    return best
+
+
+def _extend(profile, run: Tuple[int, int], floor: float) -> Tuple[int, int]:
+    """Grow ``run`` outwards while ``profile`` stays above ``floor`` (the corners of a tilted receipt)."""
+    start, end = run
+    while start > 0 and profile[start - 1] > floor:
+        start -= 1
+    while end < len(profile) and profile[end] > floor:
+        end += 1
+    return start, end
+
+
+def _smooth(profile):
+    """Moving average over ~5% of the profile so rows of dark text don't split the paper."""
+    window = max(1, len(profile) // 20)
+    return np.convolve(profile, np.ones(window) / window, mode="same")
+
+
+def paper_mask(gray: Image.Image):
+    """Boolean mask of the paper, or None when it does not stand out from the background."""
+    pixels = np.asarray(gray, dtype=np.uint8)
+    histogram = np.bincount(pixels.ravel(), minlength=256)
+    threshold = _otsu(histogram)
+    mask = pixels > threshold
+    # 紙より背景の方が明るい（白い机など）場合、明るい領域が画像の縁に広がるので検出をあきらめる
+    border = np.concatenate([mask[0], mask[-1], mask[:, 0], mask[:, -1]])
+    if border.mean() > 0.5 or not 0.05 < mask.mean() < 0.95:
+        return None
+    return mask
+
+
+def _fill_rows(mask):
+    """Fill each row between its first and last paper pixel, closing the holes left by text."""
+    present = mask.any(axis=1)
+    width = mask.shape[1]
+    first = np.where(present, mask.argmax(axis=1), width)
+    last = np.where(present, width - 1 - mask[:, ::-1].argmax(axis=1), -1)
+    columns = np.arange(width)
+    return (columns >= first[:, None]) & (columns <= last[:, None])
+
+
+def skew_degrees(mask) -> float:
+    """Angle (degrees, counter-clockwise) that turns the paper's long axis upright; 0 when unclear."""
+    ys, xs = np.nonzero(_fill_rows(mask))
+    if len(xs) < 100:
+        return 0.0
+    xs = xs - xs.mean()
+    ys = ys - ys.mean()
+    mu20, mu02, mu11 = float((xs * xs).mean()), float((ys * ys).mean()), float((xs * ys).mean())
+    spread = math.hypot(mu20 - mu02, 2 * mu11)
+    major, minor = (mu20 + mu02 + spread) / 2, (mu20 + mu02 - spread) / 2
+    if minor <= 0 or major / minor < 1.5:
+        return 0.0
+    # 長軸の向き（画像座標、y 下向き）。縦長のレシートなら ±90 度付近
+    axis = math.degrees(0.5 * math.atan2(2 * mu11, mu20 - mu02))
+    skew = axis - 90.0 if axis > 0 else axis + 90.0
+    return skew if abs(skew) <= DESKEW_MAX_DEGREES else 0.0
+
+
+def detect(image: Image.Image, draft: bool = False) -> Optional[CropResult]:
+    """Find the paper in ``image``; the box is in display (EXIF-rotated) coordinates."""
+    if np is None:
+        return None
+    return detect_preview(upright_preview(image, draft=draft))
+
+
+def detect_preview(shared: Preview) -> Optional[CropResult]:
+    """:func:`detect` on a preview already decoded for the other checks."""
+    if np is None:
+        return None
+    size = shared.size
+    gray = preview(shared.gray, side=DETECT_SIDE)
+    mask = paper_mask(gray)
+    if mask is None:
+        return None
+
+    columns_profile = _smooth(mask.mean(axis=0))
+    columns = _widest_run(columns_profile, 0.4 * float(columns_profile.max()))
+    if columns is None:
+        return None
+    rows_profile = _smooth(mask[:, columns[0]:columns[1]].mean(axis=1))
+    rows = _widest_run(rows_profile, 0.4 * float(rows_profile.max()))
+    if rows is None:
+        return None
+    # 閾値で選んだ範囲は傾いたレシートの角を含まないので、紙の画素が続く限り広げる
+    columns = _extend(mask[rows[0]:rows[1]].mean(axis=0), columns, 0.02)
+    rows = _extend(mask[:, columns[0]:columns[1]].mean(axis=1), rows, 0.02)
+
+    scale_x = size[0] / mask.shape[1]
+    scale_y = size[1] / mask.shape[0]
+    margin_x = CROP_MARGIN * size[0]
+    margin_y = CROP_MARGIN * size[1]
+    box = (
+        max(0, int(columns[0] * scale_x - margin_x)),
+        max(0, int(rows[0] * scale_y - margin_y)),
+        min(size[0], int(math.ceil(columns[1] * scale_x + margin_x))),
+        min(size[1], int(math.ceil(rows[1] * scale_y + margin_y))),
+    )
+    pad = max(1, int(CROP_MARGIN * max(mask.shape)))
+    paper = mask[max(0, rows[0] - pad):rows[1] + pad, max(0, columns[0] - pad):columns[1] + pad]
+    return CropResult(box=box, original_size=size, angle=skew_degrees(paper) if DESKEW_ENABLED else 0.0)
+
+
+def detect_base64(image_base64: str) -> Optional[CropResult]:
+    """:func:`detect` for a base64 payload, decoding only a reduced preview."""
+    if np is None:
+        return None
+    shared = decode_preview(image_base64)
+    return detect_preview(shared) if shared else None
+
+
+def apply(image: Image.Image, result: CropResult) -> Image.Image:
+    """Crop (and deskew) ``image`` according to ``result``; ``image`` may be a reduced decode."""
+    box = result.box
+    if image.size != result.original_size:
+        # 縮小して復号した画像には、元の解像度で求めた範囲を同じ比率で当てはめる
+        scale_x = image.width / result.original_size[0]
+        scale_y = image.height / result.original_size[1]
+        box = (
+            int(box[0] * scale_x),
+            int(box[1] * scale_y),
+            min(image.width, int(math.ceil(box[2] * scale_x))),
+            min(image.height, int(math.ceil(box[3] * scale_y))),
+        )
+    cropped = image.crop(box)
+    if abs(result.angle) < DESKEW_MIN_DEGREES:
+        return cropped
+    # 外接矩形 (w, h) から傾いた紙そのものの幅と高さを逆算し、回転後に中央から切り出す
+    width, height = cropped.size
+    radians = math.radians(abs(result.angle))
+    cos, sin = math.cos(radians), math.sin(radians)
+    denominator = cos * cos - sin * sin
+    paper_width = (width * cos - height * sin) / denominator
+    paper_height = (height * cos - width * sin) / denominator
+    if paper_width <= 0 or paper_height <= 0:
+        return cropped
+    rotated = cropped.rotate(result.angle, resample=Image.Resampling.BICUBIC)
+    left = max(0, int((width - paper_width) / 2))
+    top = max(0, int((height - paper_height) / 2))
+    return rotated.crop((left, top, min(width, width - left), min(height, height - top)))
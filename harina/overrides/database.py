@@ -0,0 +1,47 @@
+"""Shared Postgres connection helpers for the HARINA overrides."""
+
+from __future__ import annotations
+
+import importlib
+import os
+from typing import Optional
+
+from loguru import logger
+
+try:  # psycopg is optional when running without a database
+    import psycopg
+except ModuleNotFoundError:  # pragma: no cover - runtime guard
+    psycopg = None  # type: ignore
+
+
+def database_dsn() -> Optional[str]:
+    url = os.environ.get("DATABASE_URL")
+    if url:
+        return url
+
+    host = os.environ.get("POSTGRES_HOST")
+    database = os.environ.get("POSTGRES_DB")
+    user = os.environ.get("POSTGRES_USER")
+    password = os.environ.get("POSTGRES_PASSWORD")
+    port = os.environ.get("POSTGRES_PORT", "5432")
+
+    if not all([host, database, user, password]):
+        return None
+
+    return f"postgresql://{user}:{password}@{host}:{port}/{database}"
+
+
+def load_psycopg():
+    """Return the psycopg module, importing it lazily, or None when it is not installed."""
+
+    global psycopg
+
+    if psycopg is not None:
+        return psycopg
+
+    try:
+        psycopg = importlib.import_module("psycopg")  # type: ignore[assignment]
+    except ModuleNotFoundError:
+        logger.error("psycopg is missing. Install psycopg[binary] in the HARINA service.")
+        return None
+    return psycopg
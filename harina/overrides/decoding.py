@@ -0,0 +1,155 @@
+"""Bounded-memory image decoding for HarinaCore.
+
+``Image.open`` only reads the header, so the pixel count is checked before
+any pixel is decoded. Large JPEGs are then decoded at 1/2, 1/4 or 1/8 scale
+(libjpeg's DCT scaling via ``Image.draft``) so no more than
+``DECODE_TARGET_PIXELS`` are materialised, and every full decode reserves
+its estimated size from a process-wide byte budget, so a burst of 48MP
+uploads queues instead of pushing the worker to gigabytes of RSS.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import BinaryIO, Deque, Iterator, Tuple, Union
+
+from loguru import logger
+from PIL import Image
+
+from .preflight import PreflightError
+
+# これを超える画素数の画像は復号せずに拒否する
+DECODE_MAX_IMAGE_PIXELS = int(os.environ.get("HARINA_DECODE_MAX_IMAGE_PIXELS", "100000000"))
+# JPEG はこの画素数以下になるよう 1/2・1/4・1/8 で復号する（0 で無効）
+DECODE_TARGET_PIXELS = int(os.environ.get("HARINA_DECODE_TARGET_PIXELS", "16000000"))
+# 同時に復号済みで保持できる画素データの合計（MB、0 で無制限）
+DECODE_BUDGET_MB = float(os.environ.get("HARINA_DECODE_BUDGET_MB", "512"))
+
+# 回転・切り抜き・RGB 変換で一時的に同じ大きさの画像がもう 1 枚できる
+_WORKING_COPIES = 2
+_DRAFT_SCALES = (1, 2, 4, 8)
+# Image.reduce が扱えるモード（P や 1 などはそのまま使う）
+_REDUCIBLE_MODES = {"L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "YCbCr", "I", "F"}
+
+
+class ImageTooLargeError(PreflightError):
+    def __init__(self, size: Tuple[int, int]):
+        width, height = size
+        super().__init__(
+            "too_large",
+            f"画像の画素数が大きすぎます（{width}x{height}）。"
+            f"{DECODE_MAX_IMAGE_PIXELS / 1_000_000:.0f}MP 以下に縮小してから送信してください",
+            {"width": width, "height": height},
+        )
+
+
+class DecodeBudget:
+    """A byte-counting semaphore; waiters are admitted in arrival order."""
+
+    def __init__(self, capacity_bytes: int):
+        self.capacity = capacity_bytes
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._queue: Deque[object] = deque()
+
+    @contextmanager
+    def reserve(self, nbytes: int) -> Iterator[float]:
+        """Hold ``nbytes`` (capped at the capacity, so one huge image runs alone) and yield the wait."""
+        if self.capacity <= 0:
+            yield 0.0
+            return
+        nbytes = min(nbytes, self.capacity)
+        started = time.monotonic()
+        with self._condition:
+            token = object()
+            self._queue.append(token)
+            while self._queue[0] is not token or self.in_flight + nbytes > self.capacity:
+                self._condition.wait()
+            self._queue.popleft()
+            self.in_flight += nbytes
+            self._condition.notify_all()
+        waited = time.monotonic() - started
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                self.in_flight -= nbytes
+                self._condition.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._condition:
+            return {
+                "capacityMb": round(self.capacity / 1024 / 1024, 1),
+                "inFlightMb": round(self.in_flight / 1024 / 1024, 1),
+                "waiting": len(self._queue),
+            }
+
+
+_BUDGET = DecodeBudget(int(DECODE_BUDGET_MB * 1024 * 1024))
+
+
+def get_decode_budget() -> DecodeBudget:
+    return _BUDGET
+
+
+def check_pixels(size: Tuple[int, int]) -> None:
+    if DECODE_MAX_IMAGE_PIXELS > 0 and size[0] * size[1] > DECODE_MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(size)
+
+
+def open_image(source: Union[str, os.PathLike, BinaryIO]) -> Image.Image:
+    """``Image.open`` (header only) plus the pixel ceiling."""
+    image = Image.open(source)
+    check_pixels(image.size)
+    return image
+
+
+def reduce_on_decode(image: Image.Image) -> int:
+    """Ask libjpeg to decode a large JPEG at a reduced scale; returns the scale (1 = full size)."""
+    width, height = image.size
+    if DECODE_TARGET_PIXELS <= 0 or image.format != "JPEG" or width * height <= DECODE_TARGET_PIXELS:
+        return 1
+    scale = next(
+        (scale for scale in _DRAFT_SCALES if width * height <= DECODE_TARGET_PIXELS * scale * scale),
+        _DRAFT_SCALES[-1],
+    )
+    # draft は要求サイズ以上を保つ最大の縮小率を選ぶので、ちょうど 1/scale の大きさを要求する
+    image.draft(image.mode, (math.ceil(width / scale), math.ceil(height / scale)))
+    return scale
+
+
+def decoded_bytes(image: Image.Image) -> int:
+    """Estimated peak bytes of decoding ``image`` at its current (possibly drafted) size."""
+    width, height = image.size
+    return width * height * max(3, len(image.getbands())) * _WORKING_COPIES
+
+
+@contextmanager
+def bounded_decode(image: Image.Image) -> Iterator[Image.Image]:
+    """Decode ``image`` within the byte budget, reduced on decode where possible.
+
+    Drop every reference to the yielded image once the block exits; the
+    reservation is released there, not when the pixels are freed.
+    """
+    original_size = image.size
+    scale = reduce_on_decode(image)
+    with get_decode_budget().reserve(decoded_bytes(image)) as waited:
+        if waited >= 1.0:
+            logger.info("⏳ Waited {:.1f}s for image decode memory", waited)
+        image.load()
+        if scale > 1:
+            logger.info("🪶 Decoded {} JPEG at 1/{} scale: {}", original_size, scale, image.size)
+        elif (
+            DECODE_TARGET_PIXELS > 0
+            and image.width * image.height > DECODE_TARGET_PIXELS
+            and image.mode in _REDUCIBLE_MODES
+        ):
+            # JPEG 以外は縮小しながら復号できないので、後段の複製が小さく済むよう復号直後に縮小する
+            factor = math.ceil(math.sqrt(image.width * image.height / DECODE_TARGET_PIXELS))
+            image = image.reduce(factor)
+        yield image
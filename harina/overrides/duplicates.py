@@ -0,0 +1,502 @@
+"""In-memory duplicate index over receipts, kept in sync with Postgres incrementally.
+
+Two kinds of match are answered without touching the database:
+
+* exact key: normalized ``store_name`` + ``transaction_date`` + ``total_amount``
+* image: 64-bit dHash within a small Hamming distance (multi-index hashing, so
+  only a handful of candidates are compared instead of every stored hash)
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import time
+import unicodedata
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+from threading import Lock, Thread
+from typing import BinaryIO, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from loguru import logger
+from PIL import Image, ImageOps
+
+from .database import database_dsn, load_psycopg
+
+DUPLICATE_MAX_DISTANCE = int(os.environ.get("HARINA_DUPLICATE_MAX_DISTANCE", "3"))
+DUPLICATE_REFRESH_SECONDS = float(os.environ.get("HARINA_DUPLICATE_REFRESH_SECONDS", "60"))
+# 削除・編集されたレシートを反映するため、この間隔で全件を読み直してインデックスを作り直す
+DUPLICATE_REBUILD_SECONDS = float(os.environ.get("HARINA_DUPLICATE_REBUILD_SECONDS", "900"))
+_LOAD_BATCH_SIZE = 5000
+
+# 64bit を (最大距離 + 1) 個の区間に分ける。距離がそれ以下なら少なくとも 1 区間は完全一致する（鳩の巣原理）。
+# 区間が短いほど候補が増えるので、索引で保証する距離はここまでに抑える
+_MAX_INDEXED_DISTANCE = 15
+_HASH_BITS = 64
+
+_STORE_NOISE = re.compile(r"[\s\W_]+")
+_STORE_AFFIXES = re.compile(r"株式会社|有限会社|\(株\)|（株）|\(有\)|（有）")
+
+DuplicateKey = Tuple[str, str, int]
+
+
+def normalize_store_name(name: Optional[str]) -> str:
+    value = unicodedata.normalize("NFKC", name or "")
+    value = _STORE_AFFIXES.sub("", value)
+    return _STORE_NOISE.sub("", value).lower()
+
+
+def _amount_cents(value: object) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    try:
+        return int((Decimal(str(value)) * 100).to_integral_value())
+    except (InvalidOperation, ValueError):
+        return None
+
+
+def duplicate_key(
+    store_name: Optional[str], transaction_date: Optional[str], total_amount: object
+) -> Optional[DuplicateKey]:
+    cents = _amount_cents(total_amount)
+    if cents is None or not transaction_date:
+        return None
+    return normalize_store_name(store_name), str(transaction_date).strip(), cents
+
+
+def image_dhash(source: Union[BinaryIO, Image.Image], hash_size: int = 8) -> int:
+    """64-bit difference hash; re-encoded or resized copies of a photo land within a few bits."""
+    if isinstance(source, Image.Image):
+        image = source
+    else:
+        position = source.tell()
+        image = Image.open(source)
+    try:
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        small = ImageOps.exif_transpose(image).convert("L").resize(
+            (hash_size + 1, hash_size), Image.Resampling.LANCZOS
+        )
+    finally:
+        if not isinstance(source, Image.Image):
+            source.seek(position)
+
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _to_signed(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value & ((1 << 64) - 1)
+
+
+@dataclass(frozen=True)
+class DuplicateMatch:
+    receipt_id: int
+    reason: str
+    distance: int = 0
+
+
+class DuplicateImageError(Exception):
+    """Raised by HarinaCore with ``skip_duplicates`` when the upload matches a stored image."""
+
+    def __init__(self, match: DuplicateMatch, image_hash: int):
+        super().__init__("同じ画像のレシートが登録済みです")
+        self.match = match
+        self.image_hash = image_hash
+
+
+def _chunk_spans(max_distance: int) -> List[Tuple[int, int]]:
+    """(shift, mask) of ``max_distance + 1`` nearly equal bit ranges covering the hash."""
+    count = max_distance + 1
+    spans = []
+    shift = 0
+    for index in range(count):
+        width = _HASH_BITS // count + (1 if index < _HASH_BITS % count else 0)
+        spans.append((shift, (1 << width) - 1))
+        shift += width
+    return spans
+
+
+class DuplicateIndex:
+    """Receipt id sets keyed for constant-time duplicate lookups.
+
+    The index only stores ids and keys; pages of ``/duplicates`` re-read their
+    rows from Postgres so edits and deletions made elsewhere are reflected.
+    """
+
+    def __init__(self, max_distance: int = DUPLICATE_MAX_DISTANCE) -> None:
+        if max_distance > _MAX_INDEXED_DISTANCE:
+            logger.warning(
+                "⚠️ HARINA_DUPLICATE_MAX_DISTANCE={} is above the supported {}; clamping",
+                max_distance,
+                _MAX_INDEXED_DISTANCE,
+            )
+        self.max_distance = max(0, min(max_distance, _MAX_INDEXED_DISTANCE))
+        self._spans = _chunk_spans(self.max_distance)
+        self._lock = Lock()
+        self._by_key: Dict[DuplicateKey, Set[int]] = {}
+        self._key_of: Dict[int, DuplicateKey] = {}
+        self._duplicate_keys: Set[DuplicateKey] = set()
+        self._hash_of: Dict[int, int] = {}
+        self._hash_buckets: Dict[Tuple[int, int], Set[int]] = {}
+        # refresh だけが進める。このプロセスで保存した行を add しても、他から挿入された行を飛ばさない
+        self._db_watermark = 0
+        self._last_refresh = 0.0
+        self._last_rebuild = 0.0
+        self._groups_cache: Optional[List[List[int]]] = None
+        self.ready = False
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._key_of)
+
+    # --- mutation -----------------------------------------------------------------
+
+    def add(self, receipt_id: int, key: Optional[DuplicateKey], image_hash: Optional[int] = None) -> None:
+        with self._lock:
+            self._discard_key(receipt_id)
+            if key is not None:
+                ids = self._by_key.setdefault(key, set())
+                ids.add(receipt_id)
+                self._key_of[receipt_id] = key
+                if len(ids) > 1:
+                    self._duplicate_keys.add(key)
+                    self._groups_cache = None
+            if image_hash is not None:
+                self._discard_hash(receipt_id)
+                self._hash_of[receipt_id] = image_hash
+                for bucket in self._chunks(image_hash):
+                    self._hash_buckets.setdefault(bucket, set()).add(receipt_id)
+
+    def remove(self, receipt_id: int) -> None:
+        with self._lock:
+            self._discard_key(receipt_id)
+            self._discard_hash(receipt_id)
+
+    def _discard_key(self, receipt_id: int) -> None:
+        key = self._key_of.pop(receipt_id, None)
+        if key is None:
+            return
+        ids = self._by_key.get(key)
+        if ids is not None:
+            ids.discard(receipt_id)
+            if key in self._duplicate_keys:
+                self._groups_cache = None
+            if len(ids) < 2:
+                self._duplicate_keys.discard(key)
+            if not ids:
+                del self._by_key[key]
+
+    def _discard_hash(self, receipt_id: int) -> None:
+        image_hash = self._hash_of.pop(receipt_id, None)
+        if image_hash is None:
+            return
+        for bucket in self._chunks(image_hash):
+            ids = self._hash_buckets.get(bucket)
+            if ids is not None:
+                ids.discard(receipt_id)
+                if not ids:
+                    del self._hash_buckets[bucket]
+
+    def _chunks(self, image_hash: int) -> Iterable[Tuple[int, int]]:
+        return ((index, (image_hash >> shift) & mask) for index, (shift, mask) in enumerate(self._spans))
+
+    # --- lookups ------------------------------------------------------------------
+
+    def find(
+        self,
+        key: Optional[DuplicateKey] = None,
+        image_hash: Optional[int] = None,
+        max_distance: Optional[int] = None,
+        exclude: Optional[int] = None,
+    ) -> Optional[DuplicateMatch]:
+        """Newest receipt sharing ``key``, else the closest stored image within ``max_distance``.
+
+        ``max_distance`` is capped at the distance the index was built for, since
+        images farther apart may share no chunk and would be missed anyway.
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        with self._lock:
+            if key is not None:
+                ids = self._by_key.get(key, set()) - {exclude}
+                if ids:
+                    return DuplicateMatch(max(ids), "key")
+            if image_hash is None:
+                return None
+            best: Optional[DuplicateMatch] = None
+            candidates: Set[int] = set()
+            for bucket in self._chunks(image_hash):
+                candidates |= self._hash_buckets.get(bucket, set())
+            candidates.discard(exclude)
+            for receipt_id in candidates:
+                distance = bin(self._hash_of[receipt_id] ^ image_hash).count("1")
+                if distance <= max_distance and (
+                    best is None
+                    or (distance, -receipt_id) < (best.distance, -best.receipt_id)
+                ):
+                    best = DuplicateMatch(receipt_id, "image", distance)
+            return best
+
+    def key_of(self, receipt_id: int) -> Optional[DuplicateKey]:
+        with self._lock:
+            return self._key_of.get(receipt_id)
+
+    def group_page(self, offset: int, limit: int) -> Tuple[int, List[List[int]]]:
+        """Duplicate groups ordered by size then newest id; returns (total groups, page of id lists)."""
+        with self._lock:
+            if self._groups_cache is None:
+                groups = [sorted(self._by_key[key], reverse=True) for key in self._duplicate_keys]
+                groups.sort(key=lambda ids: (len(ids), ids[0]), reverse=True)
+                self._groups_cache = groups
+            return len(self._groups_cache), self._groups_cache[offset:offset + limit]
+
+    # --- database sync ------------------------------------------------------------
+
+    def refresh(self, conn) -> int:
+        """Pull receipts (and stored image hashes) newer than the last id seen; returns the row count."""
+        with self._lock:
+            since = self._db_watermark
+        return self._load(conn, since)
+
+    def rebuild(self, conn) -> int:
+        """Re-read every receipt so rows deleted or edited elsewhere drop out; returns the row count.
+
+        The new contents are loaded into a separate index and swapped in at the end, so
+        lookups keep working meanwhile. Receipts this process added during the scan
+        and the scan did not see are carried over.
+        """
+        with self._lock:
+            before = set(self._key_of) | set(self._hash_of)
+        fresh = DuplicateIndex(self.max_distance)
+        loaded = fresh._load(conn, 0)
+        with self._lock:
+            kept = [
+                (receipt_id, self._key_of.get(receipt_id), self._hash_of.get(receipt_id))
+                for receipt_id in (set(self._key_of) | set(self._hash_of)) - before
+                if receipt_id not in fresh._key_of and receipt_id not in fresh._hash_of
+            ]
+            self._by_key = fresh._by_key
+            self._key_of = fresh._key_of
+            self._duplicate_keys = fresh._duplicate_keys
+            self._hash_of = fresh._hash_of
+            self._hash_buckets = fresh._hash_buckets
+            self._groups_cache = None
+            self._db_watermark = fresh._db_watermark
+        for receipt_id, key, image_hash in kept:
+            self.add(receipt_id, key, image_hash)
+        self._last_refresh = self._last_rebuild = time.monotonic()
+        return loaded
+
+    def _load(self, conn, since: int) -> int:
+        added = 0
+        watermark = since
+        # サーバーサイドカーソルで分割して読み、初回構築でも全件をメモリに載せない
+        with conn.transaction(), conn.cursor(name="harina_duplicate_index") as cur:
+            cur.itersize = _LOAD_BATCH_SIZE
+            cur.execute(
+                "SELECT r.id, r.store_name, r.transaction_date, r.total_amount, h.dhash "
+                "FROM receipts r LEFT JOIN receipt_image_hashes h ON h.receipt_id = r.id "
+                "WHERE r.id > %s ORDER BY r.id",
+                (since,),
+            )
+            for receipt_id, store_name, transaction_date, total_amount, dhash in cur:
+                self.add(
+                    receipt_id,
+                    duplicate_key(store_name, transaction_date, total_amount),
+                    _to_unsigned(dhash) if dhash is not None else None,
+                )
+                watermark = receipt_id
+                added += 1
+        with self._lock:
+            self._db_watermark = max(self._db_watermark, watermark)
+        self._last_refresh = time.monotonic()
+        return added
+
+    def refresh_due(self) -> bool:
+        return time.monotonic() - self._last_refresh >= DUPLICATE_REFRESH_SECONDS
+
+    def rebuild_due(self) -> bool:
+        return time.monotonic() - self._last_rebuild >= DUPLICATE_REBUILD_SECONDS
+
+
+_INDEX = DuplicateIndex()
+# 差分取り込みと全件の作り直しを同時に走らせない
+_REFRESH_LOCK = Lock()
+
+
+def get_duplicate_index() -> DuplicateIndex:
+    return _INDEX
+
+
+def _ensure_schema(conn) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS receipt_image_hashes (
+            receipt_id INTEGER PRIMARY KEY REFERENCES receipts(id) ON DELETE CASCADE,
+            dhash BIGINT NOT NULL
+        );
+        """
+    )
+
+
+def _connect():
+    dsn = database_dsn()
+    if not dsn:
+        return None
+    psycopg = load_psycopg()
+    if psycopg is None:
+        return None
+    return psycopg.connect(dsn, autocommit=True)
+
+
+def refresh_duplicate_index(full: bool = False) -> Optional[int]:
+    """Catch the index up with rows inserted since the last refresh (e.g. by the Next.js app).
+
+    With ``full`` every receipt is re-read instead, dropping deleted receipts and re-keying edited ones.
+    """
+    try:
+        conn = _connect()
+        if conn is None:
+            return None
+        with _REFRESH_LOCK, conn:
+            _ensure_schema(conn)
+            loaded = _INDEX.rebuild(conn) if full else _INDEX.refresh(conn)
+    except Exception as exc:  # pragma: no cover - defensive logging
+        logger.exception("Failed to refresh the duplicate index: {}", exc)
+        return None
+    _INDEX.ready = True
+    return loaded
+
+
+def start_background_load() -> Thread:
+    """Build the index in a daemon thread, then keep it in sync; lookups report no match until it is ready."""
+
+    def _run() -> None:
+        started = time.perf_counter()
+        loaded = refresh_duplicate_index(full=True)
+        if loaded is not None:
+            logger.info(
+                "🗂️ 重複インデックスを構築しました: {} 件 ({:.1f}s)", loaded, time.perf_counter() - started
+            )
+        while True:
+            time.sleep(max(1.0, DUPLICATE_REFRESH_SECONDS))
+            full = _INDEX.rebuild_due()
+            started = time.perf_counter()
+            loaded = refresh_duplicate_index(full=full)
+            if full and loaded is not None:
+                logger.info(
+                    "🗂️ 重複インデックスを作り直しました: {} 件 ({:.1f}s)", loaded, time.perf_counter() - started
+                )
+
+    thread = Thread(target=_run, name="harina-duplicate-index", daemon=True)
+    thread.start()
+    return thread
+
+
+def record_receipt(
+    receipt_id: int,
+    store_name: Optional[str],
+    transaction_date: Optional[str],
+    total_amount: object,
+    image_hash: Optional[int] = None,
+) -> None:
+    """Add a receipt saved by this process to the index and persist its image hash."""
+    _INDEX.add(receipt_id, duplicate_key(store_name, transaction_date, total_amount), image_hash)
+    if image_hash is None:
+        return
+    try:
+        conn = _connect()
+        if conn is None:
+            return
+        with conn:
+            _ensure_schema(conn)
+            conn.execute(
+                "INSERT INTO receipt_image_hashes (receipt_id, dhash) VALUES (%s, %s) "
+                "ON CONFLICT (receipt_id) DO UPDATE SET dhash = EXCLUDED.dhash",
+                (receipt_id, _to_signed(image_hash)),
+            )
+    except Exception as exc:  # pragma: no cover - the in-memory entry is still usable
+        logger.warning("Failed to store image hash for receipt {}: {}", receipt_id, exc)
+
+
+def fetch_duplicate_page(page: int, page_size: int, default_model: str) -> dict:
+    """Page of duplicate groups; only the receipts on the page are read from Postgres.
+
+    Receipts on the page that were deleted or edited since the last rebuild are
+    corrected in the index on the way, and ``totalGroups`` reflects that.
+    """
+    total, groups = _INDEX.group_page((page - 1) * page_size, page_size)
+    rows_by_id: Dict[int, dict] = {}
+    page_ids = [receipt_id for ids in groups for receipt_id in ids]
+    if page_ids:
+        conn = _connect()
+        if conn is None:
+            raise RuntimeError("DATABASE_URL or Postgres credentials are not configured")
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, filename, store_name, transaction_date, transaction_time, total_amount, "
+                "uploader, processed_at, image_path, model_used FROM receipts WHERE id = ANY(%s)",
+                (page_ids,),
+            )
+            columns = [column.name for column in cur.description]
+            for row in cur.fetchall():
+                rows_by_id[row[0]] = dict(zip(columns, row))
+
+    result_groups = []
+    for ids in groups:
+        receipts = []
+        for receipt_id in ids:
+            row = rows_by_id.get(receipt_id)
+            if row is None:
+                _INDEX.remove(receipt_id)
+                continue
+            key = duplicate_key(row["store_name"], row["transaction_date"], row["total_amount"])
+            if key != _INDEX.key_of(receipt_id):
+                # アプリ側で編集されたレシートはキーを付け替え、このグループからは外す
+                _INDEX.add(receipt_id, key)
+                continue
+            receipts.append(_receipt_payload(row, default_model))
+        if len(receipts) > 1:
+            result_groups.append(
+                {
+                    "transactionDate": receipts[0]["transaction_date"],
+                    "storeName": receipts[0]["store_name"],
+                    "totalAmount": receipts[0]["total_amount"] or 0,
+                    "receipts": receipts,
+                }
+            )
+
+    # このページで削除・編集が見つかった分をグループ数にも反映する
+    total, _ = _INDEX.group_page(0, 0)
+    return {
+        "groups": result_groups,
+        "page": page,
+        "pageSize": page_size,
+        "totalGroups": total,
+        "indexedReceipts": len(_INDEX),
+    }
+
+
+def _receipt_payload(row: dict, default_model: str) -> dict:
+    processed_at = row["processed_at"]
+    return {
+        "id": row["id"],
+        "filename": row["filename"],
+        "store_name": row["store_name"],
+        "transaction_date": row["transaction_date"],
+        "transaction_time": row["transaction_time"],
+        "total_amount": float(row["total_amount"]) if row["total_amount"] is not None else None,
+        "uploader": row["uploader"],
+        "processed_at": processed_at.isoformat() if processed_at else None,
+        "image_path": row["image_path"],
+        "model_used": row["model_used"] or default_model,
+    }
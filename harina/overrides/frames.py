@@ -0,0 +1,125 @@
+"""Scoring of live camera frames so only the best one of a burst is sent to OCR.
+
+The capture screen streams small previews (a few hundred pixels wide) while
+the user holds the receipt up. Each one is decoded at reduced size to a
+``ANALYSIS_SIDE`` grayscale image and scored with the preflight heuristics
+plus the paper mask from :mod:`cropping`, which keeps a frame in the low
+milliseconds on one core. Scores only rank frames of the same burst, so they
+are products of 0..1 terms rather than calibrated quality measures.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from .cropping import _fill_rows, paper_mask
+from .decoding import open_image
+from .preflight import PREFLIGHT_MIN_CONTRAST, measure, np, preview
+
+# 1 回のバーストで受け付けるフレーム数（これに達したら最良フレームを確定する）
+CAPTURE_MAX_FRAMES = int(os.environ.get("HARINA_CAPTURE_MAX_FRAMES", "30"))
+# プレビューフレーム 1 枚のサイズ上限（KB）
+CAPTURE_MAX_FRAME_BYTES = int(float(os.environ.get("HARINA_CAPTURE_MAX_FRAME_KB", "512")) * 1024)
+# フレームやフル解像度画像を待つ時間の上限（秒）
+CAPTURE_IDLE_SECONDS = float(os.environ.get("HARINA_CAPTURE_IDLE_SECONDS", "30"))
+# 鮮明度のスコアが 0.5 になるラプラシアン分散（解析用の縮小画像での値）
+CAPTURE_SHARPNESS_HALF = float(os.environ.get("HARINA_CAPTURE_SHARPNESS_HALF", "150"))
+# レシートが画面のこの割合以上を占めていれば写り込みのスコアを満点とする
+CAPTURE_TARGET_COVERAGE = float(os.environ.get("HARINA_CAPTURE_TARGET_COVERAGE", "0.35"))
+
+ANALYSIS_SIDE = 320
+# 背景の方が明るいなどで紙を検出できないフレームは、写り込みを半分の評価で扱う
+_UNKNOWN_COVERAGE_WEIGHT = 0.5
+
+
+class FrameError(ValueError):
+    """Raised when a preview frame cannot be scored (too large, not an image)."""
+
+
+@dataclass
+class FrameScore:
+    index: int
+    width: int
+    height: int
+    sharpness: float
+    exposure: float
+    coverage: Optional[float]
+    score: float
+
+    def to_response(self) -> Dict[str, Optional[float]]:
+        return {
+            "frame": self.index,
+            "width": self.width,
+            "height": self.height,
+            "sharpness": round(self.sharpness, 1),
+            "exposure": round(self.exposure, 3),
+            "coverage": round(self.coverage, 3) if self.coverage is not None else None,
+            "score": round(self.score, 4),
+        }
+
+
+def score_frame(data: bytes, index: int = 0) -> FrameScore:
+    """Score one encoded preview frame; raises :class:`FrameError` for unusable payloads."""
+    if np is None:
+        raise FrameError("numpy がインストールされていないためフレームを評価できません")
+    if len(data) > CAPTURE_MAX_FRAME_BYTES:
+        raise FrameError(f"プレビューフレームが大きすぎます（上限 {CAPTURE_MAX_FRAME_BYTES // 1024}KB）")
+    try:
+        image = open_image(io.BytesIO(data))
+        size = image.size
+        gray = preview(image, side=ANALYSIS_SIDE, draft=True)
+    except Exception as exc:  # noqa: BLE001 - any decoder error means the frame is unusable
+        raise FrameError(f"プレビューフレームを読み込めません: {exc}") from exc
+
+    report = measure(gray, size)
+    # 白飛び・黒つぶれの割合を差し引き、無地に近い（コントラストの低い）フレームも下げる
+    exposure = max(0.0, 1.0 - report.bright_ratio - report.dark_ratio)
+    exposure *= min(1.0, report.contrast / (3 * PREFLIGHT_MIN_CONTRAST))
+    # ほぼ無地のフレームは紙の検出（大津の二値化）ができないので評価しない
+    mask = paper_mask(gray) if report.contrast >= PREFLIGHT_MIN_CONTRAST else None
+    if report.contrast < PREFLIGHT_MIN_CONTRAST:
+        coverage, framing = None, 0.0
+    elif mask is not None:
+        coverage: Optional[float] = float(_fill_rows(mask).mean())
+        framing = min(1.0, coverage / CAPTURE_TARGET_COVERAGE)
+    else:
+        coverage, framing = None, _UNKNOWN_COVERAGE_WEIGHT
+
+    score = report.sharpness / (report.sharpness + CAPTURE_SHARPNESS_HALF) * exposure * framing
+    return FrameScore(
+        index=index,
+        width=size[0],
+        height=size[1],
+        sharpness=report.sharpness,
+        exposure=exposure,
+        coverage=coverage,
+        score=score,
+    )
+
+
+class FrameBurst:
+    """Keeps the best-scoring frame of one capture burst."""
+
+    def __init__(self, max_frames: int = CAPTURE_MAX_FRAMES):
+        self.max_frames = max(1, max_frames)
+        self.frames = 0
+        self.best: Optional[FrameScore] = None
+
+    @property
+    def full(self) -> bool:
+        return self.frames >= self.max_frames
+
+    def next_index(self) -> int:
+        index = self.frames
+        self.frames += 1
+        return index
+
+    def offer(self, score: FrameScore) -> bool:
+        """Record ``score``; returns True when it is the new best frame (ties keep the earlier one)."""
+        if self.best is None or score.score > self.best.score:
+            self.best = score
+            return True
+        return False
@@ -0,0 +1,215 @@
+"""Cheap local checks that reject unusable receipt photos before any LLM call.
+
+Everything runs on a grayscale preview of at most ``PREVIEW_SIDE`` pixels, so
+a 12MP photo is judged in a few milliseconds.
+"""
+
+from __future__ import annotations
+
+import base64
+import io
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from .tiling import display_size
+
+try:  # numpy is optional; without it the checks are skipped
+    import numpy as np
+except ModuleNotFoundError:  # pragma: no cover - runtime guard
+    np = None  # type: ignore
+
+PREFLIGHT_ENABLED = os.environ.get("HARINA_PREFLIGHT_ENABLED", "1").lower() not in ("0", "false", "no")
+# 短辺の最小ピクセル数
+PREFLIGHT_MIN_SIDE = int(os.environ.get("HARINA_PREFLIGHT_MIN_SIDE", "320"))
+# 長辺 / 短辺 の上限（縦長レシートは分割処理されるので緩めに）
+PREFLIGHT_MAX_ASPECT = float(os.environ.get("HARINA_PREFLIGHT_MAX_ASPECT", "25"))
+# ラプラシアン分散の下限（小さいほどぼやけている）
+PREFLIGHT_MIN_SHARPNESS = float(os.environ.get("HARINA_PREFLIGHT_MIN_SHARPNESS", "40"))
+# 輝度の標準偏差の下限（小さいほど無地）
+PREFLIGHT_MIN_CONTRAST = float(os.environ.get("HARINA_PREFLIGHT_MIN_CONTRAST", "10"))
+# 白飛び / 黒つぶれした画素の割合の上限
+PREFLIGHT_MAX_CLIPPED = float(os.environ.get("HARINA_PREFLIGHT_MAX_CLIPPED", "0.97"))
+
+PREVIEW_SIDE = 1024
+_EXIF_ORIENTATION = 0x0112
+# EXIF の向き -> 表示向きにするための変換（ImageOps.exif_transpose と同じ対応）
+_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class PreflightError(ValueError):
+    """Raised when an image is rejected locally; ``reason`` is a stable machine-readable code."""
+
+    def __init__(self, reason: str, message: str, metrics: Dict[str, float]):
+        super().__init__(message)
+        self.reason = reason
+        self.metrics = metrics
+
+
+@dataclass
+class Preview:
+    """One reduced grayscale decode in display orientation, shared by hashing, preflight and cropping."""
+
+    gray: Image.Image
+    # 元画像の表示向きでの解像度
+    size: Tuple[int, int]
+
+
+@dataclass
+class PreflightReport:
+    width: int
+    height: int
+    sharpness: float
+    brightness: float
+    contrast: float
+    bright_ratio: float
+    dark_ratio: float
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "sharpness": round(self.sharpness, 1),
+            "brightness": round(self.brightness, 1),
+            "contrast": round(self.contrast, 1),
+            "brightRatio": round(self.bright_ratio, 3),
+            "darkRatio": round(self.dark_ratio, 3),
+        }
+
+
+def preview(image: Image.Image, side: int = PREVIEW_SIDE, draft: bool = False) -> Image.Image:
+    """Grayscale copy whose longer side is at most ``side``.
+
+    With ``draft`` a JPEG is reduced while decoding; only pass it for images that are
+    not sent to the LLM afterwards, since draft mode changes how the image decodes.
+    """
+    if draft and image.format == "JPEG":
+        # draft は要求サイズ以上を保つ最大の 1/2^n を選ぶので、半分を要求して 1/4・1/8 まで縮小させる
+        image.draft("L", (side // 2, side // 2))
+    factor = max(1, max(image.size) // side)
+    reduced = image.reduce(factor) if factor > 1 else image
+    return reduced.convert("L")
+
+
+def upright_preview(image: Image.Image, draft: bool = False) -> Preview:
+    """:func:`preview` turned to display orientation, without transposing the full-size image."""
+    size = display_size(image)
+    try:
+        orientation = image.getexif().get(_EXIF_ORIENTATION, 1)
+    except Exception:  # noqa: BLE001 - broken EXIF is treated as upright
+        orientation = 1
+    gray = preview(image, draft=draft)
+    method = _TRANSPOSE.get(orientation)
+    return Preview(gray=gray.transpose(method) if method else gray, size=size)
+
+
+def decode_preview(image_base64: str) -> Optional[Preview]:
+    """Decode only a reduced preview of a base64 payload; None when it is not a readable image."""
+    try:
+        return upright_preview(Image.open(io.BytesIO(base64.b64decode(image_base64))), draft=True)
+    except Exception:  # noqa: BLE001 - let the normal path report undecodable payloads
+        return None
+
+
+def measure(gray: Image.Image, size: Optional[Tuple[int, int]] = None) -> PreflightReport:
+    """Compute the heuristics on a grayscale preview; ``size`` is the original resolution."""
+    pixels = np.asarray(gray, dtype=np.float32)
+    laplacian = (
+        pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1] - 4.0 * pixels[1:-1, 1:-1]
+    )
+    histogram = np.bincount(np.asarray(gray, dtype=np.uint8).ravel(), minlength=256)
+    total = max(1, int(histogram.sum()))
+    width, height = size or gray.size
+    return PreflightReport(
+        width=width,
+        height=height,
+        sharpness=float(laplacian.var()) if laplacian.size else 0.0,
+        brightness=float(pixels.mean()),
+        contrast=float(pixels.std()),
+        bright_ratio=float(histogram[250:].sum()) / total,
+        dark_ratio=float(histogram[:6].sum()) / total,
+    )
+
+
+def check_report(report: PreflightReport) -> None:
+    """Raise :class:`PreflightError` with an actionable message for the first failed check."""
+    metrics = report.metrics()
+    short_side, long_side = sorted((report.width, report.height))
+    if short_side < PREFLIGHT_MIN_SIDE:
+        raise PreflightError(
+            "resolution",
+            f"画像の解像度が低すぎます（{report.width}x{report.height}）。"
+            f"短辺 {PREFLIGHT_MIN_SIDE}px 以上で撮影し直してください",
+            metrics,
+        )
+    if long_side / max(1, short_side) > PREFLIGHT_MAX_ASPECT:
+        raise PreflightError(
+            "aspect",
+            f"画像の縦横比が極端です（{report.width}x{report.height}）。レシート全体が写るように撮影してください",
+            metrics,
+        )
+    if report.bright_ratio > PREFLIGHT_MAX_CLIPPED:
+        raise PreflightError(
+            "overexposed",
+            "画像が白飛びしています。照明の反射を避けて撮影し直してください",
+            metrics,
+        )
+    if report.dark_ratio > PREFLIGHT_MAX_CLIPPED:
+        raise PreflightError(
+            "underexposed",
+            "画像が暗すぎます。明るい場所で撮影し直してください",
+            metrics,
+        )
+    if report.contrast < PREFLIGHT_MIN_CONTRAST:
+        if report.brightness > 245:
+            raise PreflightError(
+                "overexposed",
+                "画像が白飛びして文字が読み取れません。照明の反射を避けて撮影し直してください",
+                metrics,
+            )
+        raise PreflightError(
+            "blank",
+            "画像にほとんど何も写っていません。レシートが写っているか確認してください",
+            metrics,
+        )
+    if report.sharpness < PREFLIGHT_MIN_SHARPNESS:
+        raise PreflightError(
+            "blurry",
+            f"画像がぼやけています（鮮明度 {report.sharpness:.0f} < {PREFLIGHT_MIN_SHARPNESS:.0f}）。"
+            "ピントを合わせ、手ぶれしないように撮影し直してください",
+            metrics,
+        )
+
+
+def check_preview(shared: Preview) -> Optional[PreflightReport]:
+    """Run every check on a shared preview; returns None when numpy is unavailable."""
+    if np is None:
+        return None
+    report = measure(shared.gray, shared.size)
+    check_report(report)
+    return report
+
+
+def check_image(image: Image.Image) -> Optional[PreflightReport]:
+    """:func:`check_preview` for an opened image."""
+    if np is None:
+        return None
+    return check_preview(upright_preview(image))
+
+
+def check_base64(image_base64: str) -> Optional[PreflightReport]:
+    """Same as :func:`check_image` for a base64 payload, decoding only a reduced preview."""
+    if np is None:
+        return None
+    shared = decode_preview(image_base64)
+    return check_preview(shared) if shared else None
@@ -0,0 +1,260 @@
+"""Re-categorise stored receipt items against the current category catalog.
+
+    uv run python -m harina.recategorize --batch-size 300 --concurrency 2
+
+After ``product_categories.xml`` changes (and ``/maintenance/refresh-categories``
+has run), items already in ``receipt_items`` keep their old categories. This
+job sends only the distinct item names, hundreds per text-only LLM call,
+together with the current ``get_categories_xml()`` snapshot, and writes the
+answers back with one bulk UPDATE per batch. No images are read or resent.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from .category_memo import Assignment, build_categorize_prompt, parse_categorize_answer
+from .category_sync import get_categories_xml, is_valid_category, load_catalog
+from .core import HarinaCore
+from .database import database_dsn, load_psycopg
+from .usage import get_usage_tracker, start_usage_flusher
+
+RECATEGORIZE_BATCH_SIZE = int(os.environ.get("HARINA_RECATEGORIZE_BATCH_SIZE", "300"))
+RECATEGORIZE_CONCURRENCY = int(os.environ.get("HARINA_RECATEGORIZE_CONCURRENCY", "2"))
+
+Catalog = Dict[str, Set[str]]
+# (商品名, 現在の分類, 新しい分類)
+Change = Tuple[str, Assignment, Assignment]
+
+
+@dataclass
+class ItemName:
+    """A distinct item name and the (category, subcategory) pairs it is currently stored with."""
+
+    name: str
+    current: Dict[Assignment, int]
+
+    @property
+    def rows(self) -> int:
+        return sum(self.current.values())
+
+
+def fetch_item_names(conn) -> List[ItemName]:
+    names: Dict[str, ItemName] = {}
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT name, COALESCE(category, ''), COALESCE(subcategory, ''), COUNT(*) "
+            "FROM receipt_items GROUP BY 1, 2, 3 ORDER BY 1"
+        )
+        for name, category, subcategory, count in cur.fetchall():
+            entry = names.setdefault(name, ItemName(name=name, current={}))
+            entry.current[(category, subcategory)] = count
+    return list(names.values())
+
+
+def write_assignments(conn, changes: Sequence[Change]) -> int:
+    """Move only the rows stored with each change's current pair, in one statement; returns rows changed."""
+    if not changes:
+        return 0
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE receipt_items AS ri
+            SET category = v.category, subcategory = v.subcategory
+            FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[])
+                AS v(name, old_category, old_subcategory, category, subcategory)
+            WHERE ri.name = v.name
+              AND COALESCE(ri.category, '') = v.old_category
+              AND COALESCE(ri.subcategory, '') = v.old_subcategory
+              AND (ri.category IS DISTINCT FROM v.category OR ri.subcategory IS DISTINCT FROM v.subcategory)
+            """,
+            (
+                [name for name, _, _ in changes],
+                [current[0] for _, current, _ in changes],
+                [current[1] for _, current, _ in changes],
+                [answer[0] for _, _, answer in changes],
+                [answer[1] for _, _, answer in changes],
+            ),
+        )
+        return cur.rowcount
+
+
+class Recategorizer:
+    def __init__(
+        self,
+        model: str,
+        batch_size: int,
+        concurrency: int,
+        include_valid: bool,
+        dry_run: bool,
+    ):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.include_valid = include_valid
+        self.dry_run = dry_run
+        self.names_done = 0
+        self.names_changed = 0
+        self.rows_changed = 0
+        self.invalid_answers = 0
+        self.failed_batches = 0
+
+    def select(self, items: List[ItemName], catalog: Catalog) -> List[ItemName]:
+        if self.include_valid:
+            return items
+        return [
+            item for item in items
+            if any(not is_valid_category(catalog, category, subcategory) for category, subcategory in item.current)
+        ]
+
+    def categorize(self, categories_xml: str, batch: List[ItemName]) -> Dict[int, Assignment]:
+        """One text-only LLM call for ``batch``; runs in a worker thread."""
+        ocr = HarinaCore(model_name=self.model)
+        prompt = build_categorize_prompt(categories_xml, [item.name for item in batch])
+        return parse_categorize_answer(ocr.complete_text(prompt), len(batch))
+
+    def collect(self, catalog: Catalog, batch: List[ItemName], answers: Dict[int, Assignment]) -> List[Change]:
+        """Turn valid answers into per-pair changes, counting the rest.
+
+        Without ``--all`` only the pairs that are invalid in ``catalog`` move, so rows
+        of the same name that already have a valid (e.g. hand-corrected) category stay.
+        """
+        changes: List[Change] = []
+        for index, item in enumerate(batch):
+            answer = answers.get(index)
+            if answer is None or not is_valid_category(catalog, *answer):
+                self.invalid_answers += 1
+                continue
+            moved = [
+                current for current in item.current
+                if current != answer and (self.include_valid or not is_valid_category(catalog, *current))
+            ]
+            changes.extend((item.name, current, answer) for current in moved)
+            self.names_changed += bool(moved)
+        self.names_done += len(batch)
+        return changes
+
+    def run(self) -> int:
+        dsn = database_dsn()
+        psycopg = load_psycopg()
+        if not dsn or psycopg is None:
+            logger.error("DATABASE_URL or Postgres credentials are not configured")
+            return 2
+
+        categories_xml = get_categories_xml(refresh=True)
+        catalog = load_catalog(categories_xml or "")
+        if not catalog:
+            logger.error("No categories available; run /maintenance/refresh-categories first")
+            return 2
+
+        with psycopg.connect(dsn, autocommit=True) as conn:
+            items = fetch_item_names(conn)
+            selected = self.select(items, catalog)
+            total_rows = sum(item.rows for item in selected)
+            if not selected:
+                logger.info("✅ All {} item names already use valid categories", len(items))
+                return 0
+
+            batches = [selected[start:start + self.batch_size] for start in range(0, len(selected), self.batch_size)]
+            logger.info(
+                "🏷️ Re-categorising {} item names ({} rows) in {} text-only batches{}",
+                len(selected),
+                total_rows,
+                len(batches),
+                " (dry run)" if self.dry_run else "",
+            )
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="harina-recat") as executor:
+                futures = {executor.submit(self.categorize, categories_xml, batch): batch for batch in batches}
+                # 書き込みは 1 接続で順番に行い、終わったバッチから反映する（中断しても済んだ分は残る）
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    try:
+                        changes = self.collect(catalog, batch, future.result())
+                    except Exception as exc:  # noqa: BLE001 - one failed batch must not stop the run
+                        logger.warning("⚠️ Batch of {} names failed: {}", len(batch), exc)
+                        self.failed_batches += 1
+                        continue
+                    if self.dry_run:
+                        counts = {item.name: item.current for item in batch}
+                        self.rows_changed += sum(counts[name][current] for name, current, _ in changes)
+                    else:
+                        self.rows_changed += write_assignments(conn, changes)
+                    self._log_progress(started, len(selected))
+            self._log_progress(started, len(selected), final=True)
+
+        return 1 if self.failed_batches else 0
+
+    def _log_progress(self, started: float, total: int, final: bool = False) -> None:
+        elapsed = max(1e-9, time.monotonic() - started)
+        logger.info(
+            "{} {}/{} names | {:.0f} names/min | {} names / {} rows {}changed | {} invalid answers",
+            "🏁" if final else "📈",
+            self.names_done,
+            total,
+            self.names_done / elapsed * 60,
+            self.names_changed,
+            self.rows_changed,
+            "would be " if self.dry_run else "",
+            self.invalid_answers,
+        )
+        if final:
+            usage = get_usage_tracker().totals()
+            tokens = sum(totals.prompt_tokens + totals.completion_tokens for totals in usage.values())
+            cost = sum(totals.cost_usd for totals in usage.values())
+            logger.info("🪙 {} tokens | ${:.4f} | {:.1f}s", tokens, cost, elapsed)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m harina.recategorize",
+        description="receipt_items の商品名を現在のカテゴリ一覧でまとめて分類し直します（画像は再送しません）",
+    )
+    parser.add_argument("--model", default="gemini/gemini-2.5-flash")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=RECATEGORIZE_BATCH_SIZE,
+        help="1回の LLM 呼び出しで分類する商品名の数",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=RECATEGORIZE_CONCURRENCY,
+        help="同時に実行する LLM 呼び出し数",
+    )
+    parser.add_argument(
+        "--all",
+        dest="include_valid",
+        action="store_true",
+        help="現在のカテゴリ一覧で有効な分類の商品も分類し直す（既定は無効な分類の商品のみ）",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="データベースを更新せず、変更件数だけを表示する")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    load_dotenv(Path.cwd() / ".env")
+
+    recategorizer = Recategorizer(
+        model=args.model,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        include_valid=args.include_valid,
+        dry_run=args.dry_run,
+    )
+    start_usage_flusher()
+    return recategorizer.run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""Parse HARINA receipt XML and persist it straight into ``receipts``/``receipt_items``."""
+
+from __future__ import annotations
+
+import base64
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import BinaryIO, List, Optional, Sequence, Union
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+
+from .database import database_dsn, load_psycopg
+
+DEFAULT_UPLOADER = os.environ.get("HARINA_DEFAULT_UPLOADER", "夫")
+# persist 時に画像を保存するディレクトリ（app の public/uploads と共有する）。未設定なら保存しない
+UPLOADS_DIR = os.environ.get("HARINA_UPLOADS_DIR", "")
+# 保存した画像を app から参照するときの URL パス
+UPLOADS_URL_PREFIX = os.environ.get("HARINA_UPLOADS_URL_PREFIX", "/uploads")
+
+_IMAGE_EXTENSION = re.compile(r"[a-z0-9]{1,5}")
+
+_NUMERIC_NOISE = re.compile(r"[^\d.\-]")
+
+_ITEM_COLUMNS = (
+    "receipt_id",
+    "name",
+    "category",
+    "subcategory",
+    "quantity",
+    "unit_price",
+    "total_price",
+)
+
+
+@dataclass
+class ReceiptItemRecord:
+    name: str
+    category: str
+    subcategory: str
+    quantity: int
+    unit_price: float
+    total_price: float
+
+
+@dataclass
+class ReceiptRecord:
+    store_name: str
+    store_address: str
+    store_phone: str
+    transaction_date: str
+    transaction_time: str
+    receipt_number: str
+    subtotal: float
+    tax: float
+    total_amount: float
+    payment_method: str
+    items: List[ReceiptItemRecord] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class SaveResult:
+    id: int
+    was_duplicate: bool
+    duplicate_of: Optional[int] = None
+    # 同じ内容（SHA-256）の画像が保存済みで、新しい行を作らなかった
+    already_saved: bool = False
+
+
+def element_text(node: Optional[ET.Element], *paths: str) -> str:
+    """Stripped text of the first non-empty child among ``paths``, or ``""``."""
+    if node is None:
+        return ""
+    for path in paths:
+        found = node.find(path)
+        if found is not None and found.text and found.text.strip():
+            return found.text.strip()
+    return ""
+
+
+def parse_number(value: str) -> float:
+    """Amount or quantity from model output, ignoring currency marks and separators; 0.0 when unreadable."""
+    cleaned = _NUMERIC_NOISE.sub("", value)
+    try:
+        return float(cleaned) if cleaned else 0.0
+    except ValueError:
+        return 0.0
+
+
+def parse_receipt_xml(xml_payload: str) -> ReceiptRecord:
+    """Mirror the Next.js ``parseXmlToReceiptData`` defaults so both write paths store the same rows."""
+
+    try:
+        root = ET.fromstring(xml_payload.strip())
+    except ET.ParseError as exc:
+        raise ValueError(f"Failed to parse receipt XML: {exc}") from exc
+
+    store = root.find("store_info")
+    transaction = root.find("transaction_info")
+    totals = root.find("totals")
+    payment = root.find("payment_info")
+
+    items: List[ReceiptItemRecord] = []
+    for item in root.findall("./items/item"):
+        quantity = int(parse_number(element_text(item, "quantity")) or 1)
+        items.append(
+            ReceiptItemRecord(
+                name=element_text(item, "n", "name") or "Unknown Item",
+                category=element_text(item, "category") or "その他",
+                subcategory=element_text(item, "subcategory"),
+                quantity=max(quantity, 1),
+                unit_price=parse_number(element_text(item, "unit_price")),
+                total_price=parse_number(element_text(item, "total_price")),
+            )
+        )
+
+    return ReceiptRecord(
+        store_name=element_text(store, "n", "name") or "Unknown Store",
+        store_address=element_text(store, "address"),
+        store_phone=element_text(store, "phone"),
+        transaction_date=element_text(transaction, "date") or date.today().isoformat(),
+        transaction_time=element_text(transaction, "time"),
+        receipt_number=element_text(transaction, "receipt_number"),
+        subtotal=parse_number(element_text(totals, "subtotal")),
+        tax=parse_number(element_text(totals, "tax")),
+        total_amount=parse_number(element_text(totals, "total")),
+        payment_method=element_text(payment, "method") or "Unknown",
+        items=items,
+    )
+
+
+def _insert_items(cur, receipt_id: int, items: Sequence[ReceiptItemRecord]) -> None:
+    if not items:
+        return
+    placeholders = ", ".join(["(" + ", ".join(["%s"] * len(_ITEM_COLUMNS)) + ")"] * len(items))
+    params: List[object] = []
+    for item in items:
+        params.extend(
+            (
+                receipt_id,
+                item.name,
+                item.category,
+                item.subcategory,
+                item.quantity,
+                item.unit_price,
+                item.total_price,
+            )
+        )
+    cur.execute(
+        f"INSERT INTO receipt_items ({', '.join(_ITEM_COLUMNS)}) VALUES {placeholders}",
+        params,
+    )
+
+
+def save_upload_image(source: Union[str, BinaryIO], filename: str) -> Optional[str]:
+    """Store the uploaded image the way the app does (``receipt_<ms>.<ext>``) and return its URL path.
+
+    ``source`` is a seekable file or a base64 string. Returns None when no
+    uploads directory is configured.
+    """
+
+    if not UPLOADS_DIR:
+        return None
+    extension = os.path.splitext(filename)[1].lstrip(".").lower()
+    if not _IMAGE_EXTENSION.fullmatch(extension):
+        extension = "jpg"
+
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    timestamp = int(time.time() * 1000)
+    while True:
+        name = f"receipt_{timestamp}.{extension}"
+        try:
+            target = open(os.path.join(UPLOADS_DIR, name), "xb")
+            break
+        except FileExistsError:
+            timestamp += 1
+
+    with target:
+        if isinstance(source, str):
+            target.write(base64.b64decode(source))
+        else:
+            source.seek(0)
+            shutil.copyfileobj(source, target)
+    return f"{UPLOADS_URL_PREFIX.rstrip('/')}/{name}"
+
+
+def _ensure_content_hashes(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS receipt_content_hashes (
+            sha256 TEXT PRIMARY KEY,
+            receipt_id INTEGER NOT NULL REFERENCES receipts(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+
+def _connect_or_raise():
+    dsn = database_dsn()
+    if not dsn:
+        raise RuntimeError("DATABASE_URL or Postgres credentials are not configured")
+
+    psycopg = load_psycopg()
+    if psycopg is None:
+        raise RuntimeError("psycopg is not installed")
+    return psycopg.connect(dsn)
+
+
+def find_receipt_by_content(content_sha256: str) -> Optional[int]:
+    """Id of the receipt saved from an image with this SHA-256, if any."""
+    with _connect_or_raise() as conn, conn.transaction(), conn.cursor() as cur:
+        _ensure_content_hashes(cur)
+        cur.execute("SELECT receipt_id FROM receipt_content_hashes WHERE sha256 = %s", (content_sha256,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def save_receipt(
+    record: ReceiptRecord,
+    filename: str,
+    model_used: str,
+    uploader: Optional[str] = None,
+    image_path: Optional[str] = None,
+    content_sha256: Optional[str] = None,
+) -> SaveResult:
+    """Insert the receipt and all of its items in one transaction and return the new id.
+
+    With ``content_sha256`` the image digest is stored in the same transaction, and an
+    image that was already saved returns the existing receipt instead of a second row.
+    """
+
+    with _connect_or_raise() as conn, conn.transaction(), conn.cursor() as cur:
+        if content_sha256:
+            _ensure_content_hashes(cur)
+            cur.execute("SELECT receipt_id FROM receipt_content_hashes WHERE sha256 = %s", (content_sha256,))
+            existing = cur.fetchone()
+            if existing:
+                logger.info("♻️ Image {} was already saved as receipt {}", content_sha256[:12], existing[0])
+                return SaveResult(id=existing[0], was_duplicate=True, duplicate_of=existing[0], already_saved=True)
+
+        cur.execute(
+            "SELECT id FROM receipts WHERE transaction_date = %s AND total_amount = %s "
+            "ORDER BY processed_at DESC LIMIT 1",
+            (record.transaction_date, record.total_amount),
+        )
+        duplicate_row = cur.fetchone()
+
+        cur.execute(
+            """
+            INSERT INTO receipts (
+                filename, store_name, store_address, store_phone,
+                transaction_date, transaction_time, receipt_number,
+                subtotal, tax, total_amount, payment_method, processed_at,
+                image_path, uploader, model_used
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (
+                filename,
+                record.store_name,
+                record.store_address,
+                record.store_phone,
+                record.transaction_date,
+                record.transaction_time,
+                record.receipt_number,
+                record.subtotal,
+                record.tax,
+                record.total_amount,
+                record.payment_method,
+                datetime.now(),
+                image_path,
+                uploader or DEFAULT_UPLOADER,
+                model_used,
+            ),
+        )
+        receipt_id = cur.fetchone()[0]
+        _insert_items(cur, receipt_id, record.items)
+        if content_sha256:
+            # 同じ画像を同時に保存しようとした場合は主キー違反でこのトランザクションごと失敗する
+            cur.execute(
+                "INSERT INTO receipt_content_hashes (sha256, receipt_id) VALUES (%s, %s)",
+                (content_sha256, receipt_id),
+            )
+
+    duplicate_of = duplicate_row[0] if duplicate_row else None
+    logger.info(
+        "💾 Saved receipt {} with {} items{}",
+        receipt_id,
+        len(record.items),
+        f" (duplicate of {duplicate_of})" if duplicate_of else "",
+    )
+    return SaveResult(id=receipt_id, was_duplicate=duplicate_of is not None, duplicate_of=duplicate_of)
@@ -0,0 +1,211 @@
+"""Arithmetic checks on extracted receipts and targeted corrections.
+
+After OCR the line math (``quantity × unit_price = total_price``) and the
+receipt totals are checked locally. When something does not add up, only
+the inconsistent items and totals are asked about again (a short prompt with
+no template or category catalog) and the answers are merged back, instead of
+reprocessing the whole receipt.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from xml.etree import ElementTree as ET
+
+from .receipt_store import element_text, parse_number
+
+RECONCILE_ENABLED = os.environ.get("HARINA_RECONCILE_ENABLED", "1").lower() not in ("0", "false", "no")
+# 金額の一致とみなす誤差（円）
+RECONCILE_TOLERANCE = float(os.environ.get("HARINA_RECONCILE_TOLERANCE", "1"))
+# 不整合がこれより多い場合は部分的な再問い合わせをしない（読み取り自体が失敗している可能性が高い）
+RECONCILE_MAX_ISSUES = int(os.environ.get("HARINA_RECONCILE_MAX_ISSUES", "10"))
+
+_CORRECTIONS = re.compile(r"<corrections\b.*?</corrections>", re.DOTALL)
+_ITEM_FIELDS = ("quantity", "unit_price", "total_price")
+_TOTAL_FIELDS = ("subtotal", "tax", "total")
+
+
+@dataclass
+class Issue:
+    """One inconsistency; ``item`` is the 0-based item index, or None for the totals."""
+
+    item: Optional[int]
+    message: str
+
+
+def _close(left: float, right: float) -> bool:
+    return abs(left - right) <= RECONCILE_TOLERANCE
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:g}"
+
+
+def find_issues(root: ET.Element) -> List[Issue]:
+    issues: List[Issue] = []
+    items = root.findall("./items/item")
+    for index, item in enumerate(items):
+        quantity = parse_number(element_text(item, "quantity")) or 1
+        unit_price = parse_number(element_text(item, "unit_price"))
+        total_price = parse_number(element_text(item, "total_price"))
+        if unit_price and total_price and not _close(quantity * unit_price, total_price):
+            issues.append(
+                Issue(
+                    index,
+                    f"数量 {_format_number(quantity)} × 単価 {_format_number(unit_price)} が"
+                    f"金額 {_format_number(total_price)} と一致しません",
+                )
+            )
+
+    totals = root.find("totals")
+    subtotal = parse_number(element_text(totals, "subtotal"))
+    tax = parse_number(element_text(totals, "tax"))
+    total = parse_number(element_text(totals, "total"))
+    items_sum = sum(parse_number(element_text(item, "total_price")) for item in items)
+    if items and subtotal and not _close(items_sum, subtotal):
+        issues.append(
+            Issue(None, f"商品金額の合計 {_format_number(items_sum)} が小計 {_format_number(subtotal)} と一致しません")
+        )
+    # 外税なら 小計 + 税 = 合計、内税なら 小計 = 合計
+    if subtotal and total and not (_close(subtotal + tax, total) or _close(subtotal, total)):
+        issues.append(
+            Issue(
+                None,
+                f"小計 {_format_number(subtotal)} と税 {_format_number(tax)} から合計 {_format_number(total)} になりません",
+            )
+        )
+    if items and not subtotal and total and not (_close(items_sum, total) or _close(items_sum + tax, total)):
+        issues.append(
+            Issue(None, f"商品金額の合計 {_format_number(items_sum)} が合計 {_format_number(total)} と一致しません")
+        )
+    return issues
+
+
+def build_followup_prompt(root: ET.Element, issues: List[Issue]) -> str:
+    """A short prompt that asks only about the inconsistent items and totals."""
+    items = root.findall("./items/item")
+    lines = [
+        "このレシート画像の読み取り結果に計算の合わない箇所があります。",
+        "以下の箇所だけをレシートから読み直し、指定した XML 形式のみで回答してください。",
+        "値引きがある場合は値引き後の金額を total_price に入れてください。",
+        "",
+    ]
+    asked_items = sorted({issue.item for issue in issues if issue.item is not None})
+    for index in asked_items:
+        item = items[index]
+        lines.append(
+            f"- 商品 {index + 1}「{element_text(item, 'n', 'name')}」: "
+            f"数量 {element_text(item, 'quantity') or '?'} / 単価 {element_text(item, 'unit_price') or '?'} / "
+            f"金額 {element_text(item, 'total_price') or '?'}"
+        )
+    for issue in issues:
+        lines.append(f"  ({issue.message})")
+    asks_totals = any(issue.item is None for issue in issues)
+    if asks_totals:
+        totals = root.find("totals")
+        lines.append(
+            f"- 合計欄: 小計 {element_text(totals, 'subtotal') or '?'} / 税 {element_text(totals, 'tax') or '?'} / "
+            f"合計 {element_text(totals, 'total') or '?'}"
+        )
+        # 商品の合計が合わない場合は、読み落とし・重複した商品行がないかも確認してもらう
+        lines.append("  商品の読み落としや重複がある場合は missing_items / duplicate_items に記載してください。")
+
+    lines.extend(["", "<corrections>"])
+    for index in asked_items:
+        lines.append(
+            f'  <item index="{index + 1}"><quantity></quantity><unit_price></unit_price>'
+            "<total_price></total_price></item>"
+        )
+    if asks_totals:
+        lines.append("  <totals><subtotal></subtotal><tax></tax><total></total></totals>")
+        lines.append("  <missing_items><item><n></n><quantity></quantity><unit_price></unit_price>"
+                     "<total_price></total_price></item></missing_items>")
+        lines.append('  <duplicate_items><item index=""/></duplicate_items>')
+    lines.append("</corrections>")
+    return "\n".join(lines)
+
+
+def apply_corrections(root: ET.Element, response_text: str) -> int:
+    """Merge a ``<corrections>`` answer into ``root``; returns the number of values changed."""
+    match = _CORRECTIONS.search(response_text or "")
+    if not match:
+        return 0
+    try:
+        corrections = ET.fromstring(match.group(0))
+    except ET.ParseError:
+        return 0
+
+    changed = 0
+    items = root.findall("./items/item")
+    for correction in corrections.findall("item"):
+        try:
+            index = int(correction.get("index", "")) - 1
+        except ValueError:
+            continue
+        if 0 <= index < len(items):
+            changed += _merge_fields(items[index], correction, _ITEM_FIELDS)
+
+    totals_correction = corrections.find("totals")
+    if totals_correction is not None:
+        totals = root.find("totals")
+        if totals is None:
+            totals = ET.SubElement(root, "totals")
+        changed += _merge_fields(totals, totals_correction, _TOTAL_FIELDS)
+
+    container = root.find("items")
+    duplicates = sorted(
+        {
+            int(node.get("index", "0")) - 1
+            for node in corrections.findall("./duplicate_items/item")
+            if node.get("index", "").isdigit()
+        },
+        reverse=True,
+    )
+    for index in duplicates:
+        if container is not None and 0 <= index < len(items):
+            container.remove(items[index])
+            changed += 1
+
+    for missing in corrections.findall("./missing_items/item"):
+        name = element_text(missing, "n", "name")
+        if not name or not parse_number(element_text(missing, "total_price")):
+            continue
+        if container is None:
+            container = ET.SubElement(root, "items")
+        item = ET.SubElement(container, "item")
+        ET.SubElement(item, "n").text = name
+        for field in _ITEM_FIELDS:
+            value = element_text(missing, field)
+            if value:
+                ET.SubElement(item, field).text = _format_number(parse_number(value))
+        changed += 1
+    return changed
+
+
+def _merge_fields(target: ET.Element, source: ET.Element, fields) -> int:
+    changed = 0
+    for field in fields:
+        value = element_text(source, field)
+        if not value or not re.search(r"\d", value):
+            continue
+        formatted = _format_number(parse_number(value))
+        node = target.find(field)
+        if node is None:
+            node = ET.SubElement(target, field)
+        if (node.text or "").strip() != formatted:
+            node.text = formatted
+            changed += 1
+    return changed
+
+
+def summary(before: List[Issue], after: List[Issue], changed: int, requeried: bool) -> Dict[str, object]:
+    return {
+        "issues": len(before),
+        "remaining": len(after),
+        "changedValues": changed,
+        "requeried": requeried,
+        "messages": [issue.message for issue in after],
+    }
@@ -0,0 +1,183 @@
+"""Classified retries for LLM calls.
+
+Provider errors are sorted into classes: rate limits, quota exhaustion,
+server errors and transport failures are retryable, while everything else
+(bad requests, authentication, content policy, unknown errors) fails
+immediately. Retries back off exponentially with full jitter, honour
+``Retry-After``, stop at the request's deadline, and draw from a
+process-wide budget so a provider outage is not amplified by every
+request retrying at once.
+"""
+
+from __future__ import annotations
+
+import email.utils
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import Any, Deque, Optional
+
+LLM_MAX_ATTEMPTS = int(os.environ.get("HARINA_LLM_MAX_ATTEMPTS", "4"))
+LLM_BACKOFF_BASE_SECONDS = float(os.environ.get("HARINA_LLM_BACKOFF_BASE_SECONDS", "1"))
+LLM_BACKOFF_MAX_SECONDS = float(os.environ.get("HARINA_LLM_BACKOFF_MAX_SECONDS", "30"))
+# 1リクエストあたりの LLM 呼び出し（リトライ込み）の上限時間
+LLM_DEADLINE_SECONDS = float(os.environ.get("HARINA_LLM_DEADLINE_SECONDS", "120"))
+# 直近1分間のリクエスト数に対してリトライを許す割合と、最低限許すリトライ数
+RETRY_BUDGET_RATIO = float(os.environ.get("HARINA_RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_MINUTE = int(os.environ.get("HARINA_RETRY_BUDGET_MIN_PER_MINUTE", "10"))
+RETRY_BUDGET_WINDOW_SECONDS = 60.0
+
+
+class ErrorClass(str, Enum):
+    RATE_LIMIT = "rate_limit"
+    QUOTA = "quota"
+    SERVER = "server"
+    TRANSPORT = "transport"
+    CLIENT = "client"
+    UNKNOWN = "unknown"
+
+    @property
+    def retryable(self) -> bool:
+        # 日次クォータの枯渇はリクエスト中には回復しないので再試行しない（別キーへの切り替えだけ行う）
+        return self in (ErrorClass.RATE_LIMIT, ErrorClass.SERVER, ErrorClass.TRANSPORT)
+
+
+_TRANSPORT_NAMES = ("timeout", "connection", "connecterror", "readerror", "remoteprotocol")
+_SERVER_NAMES = ("internalservererror", "serviceunavailable", "badgateway", "apierror")
+_CLIENT_NAMES = (
+    "badrequest",
+    "authentication",
+    "permissiondenied",
+    "notfound",
+    "contextwindowexceeded",
+    "contentpolicyviolation",
+    "unprocessableentity",
+    "unsupportedparams",
+)
+_DAILY_QUOTA = re.compile(r"per\s*day|daily", re.IGNORECASE)
+_RETRY_DELAY = re.compile(r"(?:retry[_ ]?delay\"?\s*[:=]\s*\"?|retry in\s+)(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    for candidate in (getattr(exc, "status_code", None), getattr(getattr(exc, "response", None), "status_code", None)):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+
+def classify(exc: BaseException) -> ErrorClass:
+    """Sort a litellm/httpx/OS exception into an :class:`ErrorClass` without importing litellm."""
+    name = type(exc).__name__.lower()
+    message = str(exc).lower()
+    status = _status_code(exc)
+
+    if status == 429 or "ratelimit" in name or "resource_exhausted" in message or "quota" in message:
+        # 日次上限の枯渇は QUOTA。分単位の上限も "quota" を含むが、retryDelay などで待ち時間が示される
+        if _DAILY_QUOTA.search(message) or ("quota" in message and retry_after(exc) is None):
+            return ErrorClass.QUOTA
+        return ErrorClass.RATE_LIMIT
+    if isinstance(exc, (TimeoutError, ConnectionError)) or any(part in name for part in _TRANSPORT_NAMES):
+        return ErrorClass.TRANSPORT
+    if status is not None and status >= 500:
+        return ErrorClass.SERVER
+    if status is not None and 400 <= status < 500:
+        return ErrorClass.CLIENT
+    if any(part in name for part in _CLIENT_NAMES):
+        return ErrorClass.CLIENT
+    if any(part in name for part in _SERVER_NAMES) or "overloaded" in message or "unavailable" in message:
+        return ErrorClass.SERVER
+    return ErrorClass.UNKNOWN
+
+
+def _headers(exc: BaseException) -> Any:
+    headers = getattr(exc, "litellm_response_headers", None)
+    if headers is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+    return headers
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds the provider asked us to wait, from ``Retry-After`` or a ``retryDelay`` in the body."""
+    headers = _headers(exc)
+    value = None
+    if headers is not None:
+        try:
+            value = headers.get("retry-after") or headers.get("Retry-After")
+        except Exception:  # noqa: BLE001 - unexpected header container
+            value = None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                parsed = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                # "soon" のような解釈できないヘッダーは無視する
+                return None
+            if parsed is not None:
+                return max(0.0, parsed.timestamp() - time.time())
+    match = _RETRY_DELAY.search(str(exc))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt: int, exc: Optional[BaseException] = None) -> float:
+    """Full-jitter exponential backoff for ``attempt`` (0-based), never shorter than Retry-After."""
+    ceiling = min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * (2 ** attempt))
+    delay = random.uniform(0, ceiling)
+    requested = retry_after(exc) if exc is not None else None
+    return max(delay, requested) if requested is not None else delay
+
+
+class RetryBudget:
+    """Allow at most ``ratio`` retries per request (plus a floor) over a sliding window."""
+
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_window: int = RETRY_BUDGET_MIN_PER_MINUTE,
+        window: float = RETRY_BUDGET_WINDOW_SECONDS,
+    ):
+        self.ratio = ratio
+        self.min_per_window = min_per_window
+        self.window = window
+        self._lock = threading.Lock()
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+    def _trim(self, now: float) -> None:
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_request(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self._retries) >= self.min_per_window + self.ratio * len(self._requests):
+                return False
+            self._retries.append(now)
+            return True
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._trim(time.monotonic())
+            return {"requests": len(self._requests), "retries": len(self._retries)}
+
+
+_BUDGET = RetryBudget()
+
+
+def get_retry_budget() -> RetryBudget:
+    return _BUDGET
@@ -0,0 +1,220 @@
+"""Admission scheduling in front of HarinaCore.
+
+Every OCR request passes through two gates before it may call the LLM:
+
+* a token bucket per uploader, so one person's bulk upload cannot use up
+  the whole key quota;
+* a per-model concurrency limit whose waiters are served by weighted fair
+  queuing across priority lanes (``interactive`` for the web UI and the
+  Discord bot, ``bulk`` for imports), so bulk work keeps moving without
+  starving interactive requests.
+
+Both gates run on the event loop; the time spent waiting is reported back
+so clients can tell queueing from LLM latency.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+def _parse_pairs(value: str) -> Dict[str, float]:
+    """Parse ``name=value,name=value`` (model names may contain ``/``)."""
+    pairs: Dict[str, float] = {}
+    for item in value.split(","):
+        name, sep, number = item.strip().rpartition("=")
+        if not sep or not name:
+            continue
+        try:
+            pairs[name.strip()] = float(number)
+        except ValueError:
+            logger.warning("Ignoring invalid scheduling entry: {}", item)
+    return pairs
+
+
+# レーンの重み（同じだけ待っている場合、interactive が bulk の何倍の頻度で処理されるか）
+LANE_WEIGHTS = {INTERACTIVE: 4.0, BULK: 1.0, **_parse_pairs(os.environ.get("HARINA_LANE_WEIGHTS", ""))}
+# モデルごとの同時実行数（例: gemini/gemini-2.5-flash=6,gemini/gemini-2.5-pro=2）
+MODEL_CONCURRENCY = {
+    name: int(limit) for name, limit in _parse_pairs(os.environ.get("HARINA_MODEL_CONCURRENCY", "")).items()
+}
+DEFAULT_MODEL_CONCURRENCY = int(os.environ.get("HARINA_DEFAULT_MODEL_CONCURRENCY", "4"))
+# アップローダーごとのトークンバケット（1分あたりの補充数と最大保持数）
+UPLOADER_RATE_PER_MINUTE = float(os.environ.get("HARINA_UPLOADER_RATE_PER_MINUTE", "30"))
+UPLOADER_BURST = float(os.environ.get("HARINA_UPLOADER_BURST", "10"))
+# これ以上待たせることになる場合は 429 を返す
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("HARINA_ADMISSION_MAX_WAIT_SECONDS", "120"))
+
+
+class AdmissionRejected(Exception):
+    """The request would wait longer than ``ADMISSION_MAX_WAIT_SECONDS``."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class Ticket:
+    lane: str
+    uploader: str
+    model: str
+    rate_wait: float = 0.0
+    queue_wait: float = 0.0
+
+    @property
+    def wait_ms(self) -> float:
+        return round((self.rate_wait + self.queue_wait) * 1000, 1)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, burst: float):
+        self.rate = rate_per_second
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait: float) -> float:
+        """Take a token, returning how long to wait before using it, or raise if too long."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, (1.0 - self.tokens) / self.rate)
+        if wait > max_wait:
+            raise AdmissionRejected("アップロードが集中しています。しばらくしてから再度お試しください", wait)
+        self.tokens -= 1.0
+        return wait
+
+
+class FairSemaphore:
+    """A concurrency limit whose waiters are released in weighted-fair order across lanes."""
+
+    def __init__(self, limit: int, weights: Dict[str, float]):
+        self.limit = max(1, limit)
+        self.weights = weights
+        self.active = 0
+        self._virtual_time = 0.0
+        self._lane_finish: Dict[str, float] = {}
+        self._waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    def waiting(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for _, _, future in self._waiters:
+            if not future.done():
+                lane = getattr(future, "lane", "")
+                counts[lane] = counts.get(lane, 0) + 1
+        return counts
+
+    async def acquire(self, lane: str, timeout: float) -> None:
+        # 仮想終了時刻: レーンの重みが大きいほど間隔が短く、先に順番が回ってくる
+        start = max(self._virtual_time, self._lane_finish.get(lane, 0.0))
+        finish = start + 1.0 / self.weights.get(lane, 1.0)
+        self._lane_finish[lane] = finish
+        future = asyncio.get_running_loop().create_future()
+        future.lane = lane  # type: ignore[attr-defined]
+        heapq.heappush(self._waiters, (finish, next(self._sequence), future))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                self.release()
+            future.cancel()
+            raise AdmissionRejected("処理待ちのリクエストが多すぎます。しばらくしてから再度お試しください", timeout)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            future.cancel()
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._waiters and self.active < self.limit:
+            finish, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._virtual_time = finish
+            self.active += 1
+            future.set_result(None)
+
+
+class AdmissionScheduler:
+    def __init__(
+        self,
+        model_limits: Optional[Dict[str, int]] = None,
+        default_limit: int = DEFAULT_MODEL_CONCURRENCY,
+        lane_weights: Optional[Dict[str, float]] = None,
+        rate_per_minute: float = UPLOADER_RATE_PER_MINUTE,
+        burst: float = UPLOADER_BURST,
+        max_wait: float = ADMISSION_MAX_WAIT_SECONDS,
+    ):
+        self.model_limits = dict(MODEL_CONCURRENCY if model_limits is None else model_limits)
+        self.default_limit = default_limit
+        self.lane_weights = dict(LANE_WEIGHTS if lane_weights is None else lane_weights)
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_wait = max_wait
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._models: Dict[str, FairSemaphore] = {}
+
+    @property
+    def lanes(self) -> List[str]:
+        return list(self.lane_weights)
+
+    def _semaphore(self, model: str) -> FairSemaphore:
+        semaphore = self._models.get(model)
+        if semaphore is None:
+            semaphore = FairSemaphore(self.model_limits.get(model, self.default_limit), self.lane_weights)
+            self._models[model] = semaphore
+        return semaphore
+
+    @asynccontextmanager
+    async def admit(self, model: str, uploader: str, lane: str = INTERACTIVE) -> AsyncIterator[Ticket]:
+        """Wait for the uploader's rate limit and a model slot; raises :class:`AdmissionRejected`."""
+        if lane not in self.lane_weights:
+            raise ValueError(f"unknown lane: {lane}")
+        ticket = Ticket(lane=lane, uploader=uploader, model=model)
+
+        bucket = self._buckets.get(uploader)
+        if bucket is None:
+            bucket = self._buckets[uploader] = TokenBucket(self.rate_per_second, self.burst)
+        ticket.rate_wait = bucket.reserve(self.max_wait)
+        if ticket.rate_wait > 0:
+            await asyncio.sleep(ticket.rate_wait)
+
+        semaphore = self._semaphore(model)
+        started = time.monotonic()
+        await semaphore.acquire(lane, max(0.0, self.max_wait - ticket.rate_wait))
+        ticket.queue_wait = time.monotonic() - started
+        if ticket.wait_ms >= 1000:
+            logger.info(
+                "⏳ {} request from {} waited {:.1f}s for {}", lane, uploader, ticket.wait_ms / 1000, model
+            )
+        try:
+            yield ticket
+        finally:
+            semaphore.release()
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        return {
+            model: {"limit": semaphore.limit, "active": semaphore.active, "waiting": semaphore.waiting()}
+            for model, semaphore in self._models.items()
+        }
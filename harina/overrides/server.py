@@ -1,24 +1,61 @@
 """FastAPI server for Harina v3 CLI - Receipt OCR API (overridden)."""
 
+import asyncio
+import io
+import json
 import os
 import sys
-import tempfile
 import base64
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import BinaryIO, Optional, Tuple, Union
+from urllib.parse import unquote
 from xml.etree import ElementTree as ET
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import (
+    FastAPI, File, UploadFile, HTTPException, Form, Header, Query, Request, WebSocket, WebSocketDisconnect
+)
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
 from dotenv import load_dotenv
 from loguru import logger
 
 from .core import HarinaCore
+from .uploads import (
+    BASE64_PASSTHROUGH,
+    MAX_UPLOAD_BYTES,
+    RequestSizeLimitMiddleware,
+    UploadTooLargeError,
+    hash_upload,
+    is_jpeg_base64,
+    spool_upload,
+)
+from .receipt_store import DEFAULT_UPLOADER, parse_receipt_xml, save_receipt, save_upload_image
+from .retries import get_retry_budget
+from .scheduling import INTERACTIVE, AdmissionRejected, AdmissionScheduler
+from .duplicates import (
+    DuplicateImageError,
+    duplicate_key,
+    fetch_duplicate_page,
+    get_duplicate_index,
+    record_receipt,
+    start_background_load,
+)
+from .cropping import CROP_ENABLED
+from .decoding import get_decode_budget
+from .frames import CAPTURE_IDLE_SECONDS, FrameBurst, FrameError, score_frame
+from .preflight import PREFLIGHT_ENABLED, PreflightError, np
+from .usage import get_usage_tracker, query_usage, start_usage_flusher
 from .utils import convert_xml_to_csv
-from .category_sync import get_categories_xml, sync_categories_with_database
+from .category_memo import get_category_memo, record_items, start_memo_load
+from .category_sync import (
+    get_categories_xml,
+    load_category_snapshot,
+    start_background_sync,
+    sync_categories_with_database,
+)
 
 
 def _category_stats(xml_payload: str) -> Tuple[int, int]:
@@ -82,6 +119,7 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(RequestSizeLimitMiddleware)
 
     class ReceiptResponse(BaseModel):
         success: bool
@@ -91,12 +129,175 @@ def create_app() -> FastAPI:
         error: Optional[str] = None
         fallbackUsed: Optional[bool] = None
         keyType: Optional[str] = None
+        contentSha256: Optional[str] = None
+        receiptId: Optional[int] = None
+        duplicateOf: Optional[int] = None
+        duplicateReason: Optional[str] = None
+        imageHash: Optional[str] = None
+        usage: Optional[dict] = None
+        preflightReason: Optional[str] = None
+        crop: Optional[dict] = None
+        lane: Optional[str] = None
+        queueWaitMs: Optional[float] = None
+        reconciliation: Optional[dict] = None
+        categorization: Optional[dict] = None
 
     class Base64Request(BaseModel):
         image_base64: str
         model: str = "gemini/gemini-2.5-flash"
         format: str = "xml"
         instructions: Optional[str] = None
+        persist: bool = False
+        uploader: Optional[str] = None
+        filename: Optional[str] = None
+        skip_duplicates: bool = False
+        priority: str = INTERACTIVE
+
+    def _run_harina(
+        source: Union[str, BinaryIO],
+        model: str,
+        output_format: str,
+        instructions: Optional[str],
+        content_sha256: Optional[str] = None,
+        persist: bool = False,
+        uploader: Optional[str] = None,
+        filename: Optional[str] = None,
+        skip_duplicates: bool = False,
+    ) -> ReceiptResponse:
+        """Run OCR on a file-like image, or on a JPEG base64 string passed through untouched.
+
+        With ``persist`` the parsed receipt is written to Postgres and its id returned.
+        With ``skip_duplicates`` an image already in the duplicate index is answered
+        without calling the LLM.
+        """
+        duplicates = get_duplicate_index()
+        ocr = HarinaCore(model_name=model, uploader=uploader)
+        ocr.skip_duplicates = skip_duplicates
+
+        def _hash_hex() -> Optional[str]:
+            return f"{ocr.last_image_hash:016x}" if ocr.last_image_hash is not None else None
+
+        try:
+            if isinstance(source, str):
+                xml_result = ocr.process_receipt_base64(
+                    source,
+                    output_format='xml',
+                    additional_instructions=instructions
+                )
+            else:
+                xml_result = ocr.process_receipt(
+                    source,
+                    output_format='xml',
+                    additional_instructions=instructions
+                )
+        except DuplicateImageError as exc:
+            logger.info(
+                "♻️ Duplicate image of receipt {} (distance {}), skipping OCR",
+                exc.match.receipt_id,
+                exc.match.distance,
+            )
+            return ReceiptResponse(
+                success=False,
+                format=output_format,
+                model=model,
+                error=str(exc),
+                contentSha256=content_sha256,
+                duplicateOf=exc.match.receipt_id,
+                duplicateReason=exc.match.reason,
+                imageHash=_hash_hex()
+            )
+        except PreflightError as exc:
+            logger.info("🚫 Rejected before OCR ({}): {}", exc.reason, exc.metrics)
+            return ReceiptResponse(
+                success=False,
+                format=output_format,
+                model=model,
+                error=str(exc),
+                contentSha256=content_sha256,
+                imageHash=_hash_hex(),
+                preflightReason=exc.reason
+            )
+        image_hash = ocr.last_image_hash
+        result = xml_result if output_format == 'xml' else convert_xml_to_csv(xml_result)
+
+        saved = None
+        match = None
+        if persist:
+            record = parse_receipt_xml(xml_result)
+            try:
+                image_path = save_upload_image(source, filename or "receipt.jpg")
+            except Exception as exc:  # noqa: BLE001 - the receipt is still worth saving without its image
+                logger.warning("⚠️ Failed to save the uploaded image: {}", exc)
+                image_path = None
+            saved = save_receipt(
+                record,
+                filename=filename or "receipt.jpg",
+                model_used=model,
+                uploader=uploader,
+                image_path=image_path,
+            )
+            key = duplicate_key(record.store_name, record.transaction_date, record.total_amount)
+            match = duplicates.find(key, image_hash, exclude=saved.id)
+            record_receipt(saved.id, record.store_name, record.transaction_date, record.total_amount, image_hash)
+            record_items(record.store_name, record.items)
+        else:
+            try:
+                record = parse_receipt_xml(xml_result)
+                match = duplicates.find(
+                    duplicate_key(record.store_name, record.transaction_date, record.total_amount), image_hash
+                )
+            except ValueError:
+                match = duplicates.find(image_hash=image_hash)
+
+        return ReceiptResponse(
+            success=True,
+            data=result,
+            format=output_format,
+            model=model,
+            fallbackUsed=ocr.last_used_fallback,
+            keyType=ocr.last_used_key_label,
+            contentSha256=content_sha256,
+            receiptId=saved.id if saved else None,
+            duplicateOf=match.receipt_id if match else (saved.duplicate_of if saved else None),
+            duplicateReason=match.reason if match else ("date_total" if saved and saved.duplicate_of else None),
+            imageHash=_hash_hex(),
+            usage=ocr.last_usage.to_response() if ocr.last_usage else None,
+            crop=ocr.last_crop.to_response() if ocr.last_crop else None,
+            reconciliation=ocr.last_reconciliation,
+            categorization=ocr.last_categorization
+        )
+
+    scheduler = AdmissionScheduler()
+
+    async def _admit_and_run(
+        source: Union[str, BinaryIO],
+        model: str,
+        output_format: str,
+        instructions: Optional[str],
+        priority: str,
+        uploader: Optional[str] = None,
+        **options,
+    ) -> ReceiptResponse:
+        """Wait for the uploader's rate limit and a model slot, then run OCR off the event loop."""
+        if priority not in scheduler.lanes:
+            raise HTTPException(
+                status_code=400,
+                detail=f"priorityは {' / '.join(repr(lane) for lane in scheduler.lanes)} のいずれかを指定してください"
+            )
+        try:
+            async with scheduler.admit(model, uploader or DEFAULT_UPLOADER, priority) as ticket:
+                response = await run_in_threadpool(
+                    _run_harina, source, model, output_format, instructions, uploader=uploader, **options
+                )
+        except AdmissionRejected as exc:
+            raise HTTPException(
+                status_code=429,
+                detail=str(exc),
+                headers={"Retry-After": str(max(1, int(exc.retry_after + 0.999)))}
+            ) from exc
+        response.lane = ticket.lane
+        response.queueWaitMs = ticket.wait_ms
+        return response
 
     @app.get("/")
     async def root():
@@ -106,6 +307,10 @@ def create_app() -> FastAPI:
             "endpoints": {
                 "process": "/process - レシート画像を処理（ファイルアップロード）",
                 "process_base64": "/process_base64 - レシート画像を処理（BASE64）",
+                "process_raw": "/process_raw - レシート画像を処理（バイナリ本文、パラメータはクエリ/ヘッダー）",
+                "capture": "/ws/capture - カメラのプレビューを評価し、最良フレームだけを処理（WebSocket）",
+                "duplicates": "/duplicates - 重複レシートのグループ一覧（ページング）",
+                "usage": "/usage - LLM のトークン・レイテンシ・コストの集計",
                 "health": "/health - ヘルスチェック"
             }
         }
@@ -117,6 +322,10 @@ def create_app() -> FastAPI:
         return {
             "status": "healthy",
             "service": "harina-v3-api",
+            "admission": scheduler.snapshot(),
+            "retryBudget": get_retry_budget().snapshot(),
+            "decodeBudget": get_decode_budget().snapshot(),
+            "categoryMemo": get_category_memo().stats(),
             "categories": {
                 "count": category_count,
                 "subcategories": subcategory_count,
@@ -135,12 +344,44 @@ def create_app() -> FastAPI:
             "subcategories": subcategory_count,
         }
 
+    @app.get("/duplicates")
+    def list_duplicates(
+        page: int = Query(default=1, ge=1, description="ページ番号"),
+        page_size: int = Query(default=50, ge=1, le=200, description="1ページあたりのグループ数"),
+    ):
+        try:
+            return fetch_duplicate_page(page, page_size, default_model="gemini/gemini-2.5-flash")
+        except Exception as exc:
+            logger.exception("Failed to list duplicates")
+            raise HTTPException(status_code=500, detail="重複レシートの取得に失敗しました") from exc
+
+    @app.get("/usage")
+    async def usage_summary(
+        hours: float = Query(default=24, gt=0, le=24 * 366, description="集計する期間（時間）"),
+    ):
+        tracker = get_usage_tracker()
+        recent = {
+            label: tracker.recent(window_seconds=60, key_label=label).to_response()
+            for label in ("free", "primary", "other")
+        }
+        # 未書き出し分の flush と集計クエリは DB を待つので、イベントループの外で実行する
+        rows = await run_in_threadpool(query_usage, hours)
+        return {
+            "hours": hours,
+            "rows": rows,
+            "lastMinute": {label: totals for label, totals in recent.items() if totals["calls"]},
+        }
+
     @app.post("/process", response_model=ReceiptResponse)
     async def process_receipt(
         file: UploadFile = File(..., description="レシート画像ファイル"),
         model: str = Form(default="gemini/gemini-2.5-flash", description="使用するAIモデル"),
         format: str = Form(default="xml", description="出力形式 (xml/csv)"),
-        instructions: Optional[str] = Form(default=None, description="追加の解析指示")
+        instructions: Optional[str] = Form(default=None, description="追加の解析指示"),
+        persist: bool = Form(default=False, description="結果をデータベースに保存する"),
+        uploader: Optional[str] = Form(default=None, description="保存時のアップローダー"),
+        skip_duplicates: bool = Form(default=False, description="登録済みの画像ならLLMを呼ばずに返す"),
+        priority: str = Form(default=INTERACTIVE, description="処理の優先レーン (interactive/bulk)")
     ):
         if not file.content_type or not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="画像ファイルをアップロードしてください")
@@ -149,101 +390,316 @@ def create_app() -> FastAPI:
             raise HTTPException(status_code=400, detail="formatは 'xml' または 'csv' を指定してください")
 
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                content = await file.read()
-                temp_file.write(content)
-                temp_file_path = Path(temp_file.name)
+            upload = await hash_upload(file)
+        except UploadTooLargeError as exc:
+            raise HTTPException(status_code=413, detail=str(exc)) from exc
 
-            try:
-                ocr = HarinaCore(model_name=model)
-
-                if instructions:
-                    logger.info("🗒️ Received additional instructions: {}", instructions.strip())
-
-                if format == 'xml':
-                    result = ocr.process_receipt(
-                        temp_file_path,
-                        output_format='xml',
-                        additional_instructions=instructions
-                    )
-                else:
-                    xml_result = ocr.process_receipt(
-                        temp_file_path,
-                        output_format='xml',
-                        additional_instructions=instructions
-                    )
-                    result = convert_xml_to_csv(xml_result)
-
-                return ReceiptResponse(
-                    success=True,
-                    data=result,
-                    format=format,
-                    model=model,
-                    fallbackUsed=ocr.last_used_fallback,
-                    keyType=ocr.last_used_key_label
-                )
+        logger.debug("📥 Upload received: {} bytes, sha256={}", upload.size, upload.sha256)
 
-            finally:
-                if temp_file_path.exists():
-                    temp_file_path.unlink()
+        if instructions:
+            logger.info("🗒️ Received additional instructions: {}", instructions.strip())
 
+        try:
+            return await _admit_and_run(
+                upload.file,
+                model,
+                format,
+                instructions,
+                priority,
+                content_sha256=upload.sha256,
+                persist=persist,
+                uploader=uploader,
+                filename=file.filename,
+                skip_duplicates=skip_duplicates
+            )
+        except HTTPException:
+            raise
         except Exception as e:
             logger.exception("Processing failed")
-            return ReceiptResponse(success=False, format=format, model=model, error=str(e))
+            return ReceiptResponse(
+                success=False,
+                format=format,
+                model=model,
+                error=str(e),
+                contentSha256=upload.sha256
+            )
+        finally:
+            upload.close()
 
     @app.post("/process_base64", response_model=ReceiptResponse)
     async def process_receipt_base64(request: Base64Request):
         if request.format not in ['xml', 'csv']:
             raise HTTPException(status_code=400, detail="formatは 'xml' または 'csv' を指定してください")
 
+        if request.instructions:
+            logger.info("🗒️ Received additional instructions (base64): {}", request.instructions.strip())
+
         try:
+            if BASE64_PASSTHROUGH and is_jpeg_base64(request.image_base64):
+                logger.debug("⚡ Forwarding JPEG base64 payload as-is ({} characters)", len(request.image_base64))
+                return await _admit_and_run(
+                    request.image_base64,
+                    request.model,
+                    request.format,
+                    request.instructions,
+                    request.priority,
+                    persist=request.persist,
+                    uploader=request.uploader,
+                    filename=request.filename,
+                    skip_duplicates=request.skip_duplicates
+                )
+
             try:
                 image_data = base64.b64decode(request.image_base64)
             except Exception as exc:
                 raise HTTPException(status_code=400, detail="無効なBASE64データです") from exc
 
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                temp_file.write(image_data)
-                temp_file_path = Path(temp_file.name)
+            if len(image_data) > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=str(UploadTooLargeError(MAX_UPLOAD_BYTES)))
+
+            return await _admit_and_run(
+                io.BytesIO(image_data),
+                request.model,
+                request.format,
+                request.instructions,
+                request.priority,
+                persist=request.persist,
+                uploader=request.uploader,
+                filename=request.filename,
+                skip_duplicates=request.skip_duplicates
+            )
 
-            try:
-                ocr = HarinaCore(model_name=request.model)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.exception("Processing failed")
+            return ReceiptResponse(success=False, format=request.format, model=request.model, error=str(e))
 
-                if request.instructions:
-                    logger.info("🗒️ Received additional instructions (base64): {}", request.instructions.strip())
+    @app.post("/process_raw", response_model=ReceiptResponse)
+    async def process_receipt_raw(
+        request: Request,
+        model: Optional[str] = Query(default=None, description="使用するAIモデル"),
+        format: Optional[str] = Query(default=None, description="出力形式 (xml/csv)"),
+        instructions: Optional[str] = Query(default=None, description="追加の解析指示"),
+        persist: Optional[bool] = Query(default=None, description="結果をデータベースに保存する"),
+        uploader: Optional[str] = Query(default=None, description="保存時のアップローダー"),
+        filename: Optional[str] = Query(default=None, description="保存時のファイル名"),
+        skip_duplicates: Optional[bool] = Query(default=None, description="登録済みの画像ならLLMを呼ばずに返す"),
+        priority: Optional[str] = Query(default=None, description="処理の優先レーン (interactive/bulk)"),
+        x_harina_model: Optional[str] = Header(default=None),
+        x_harina_format: Optional[str] = Header(default=None),
+        x_harina_instructions: Optional[str] = Header(default=None, description="URLエンコードした追加の解析指示"),
+        x_harina_persist: Optional[bool] = Header(default=None),
+        x_harina_uploader: Optional[str] = Header(default=None, description="URLエンコードしたアップローダー"),
+        x_harina_filename: Optional[str] = Header(default=None, description="URLエンコードしたファイル名"),
+        x_harina_skip_duplicates: Optional[bool] = Header(default=None),
+        x_harina_priority: Optional[str] = Header(default=None),
+    ):
+        content_type = (request.headers.get("content-type") or "").split(";", 1)[0].strip().lower()
+        if content_type != "application/octet-stream" and not content_type.startswith("image/"):
+            raise HTTPException(
+                status_code=415,
+                detail="Content-Type は application/octet-stream または image/* を指定してください"
+            )
+
+        model = model or x_harina_model or "gemini/gemini-2.5-flash"
+        output_format = format or x_harina_format or "xml"
+        if instructions is None and x_harina_instructions:
+            instructions = unquote(x_harina_instructions)
+        if persist is None:
+            persist = bool(x_harina_persist)
+        if uploader is None and x_harina_uploader:
+            uploader = unquote(x_harina_uploader)
+        if filename is None and x_harina_filename:
+            filename = unquote(x_harina_filename)
+        if skip_duplicates is None:
+            skip_duplicates = bool(x_harina_skip_duplicates)
+        priority = priority or x_harina_priority or INTERACTIVE
+
+        if output_format not in ['xml', 'csv']:
+            raise HTTPException(status_code=400, detail="formatは 'xml' または 'csv' を指定してください")
 
-                if request.format == 'xml':
-                    result = ocr.process_receipt(
-                        temp_file_path,
-                        output_format='xml',
-                        additional_instructions=request.instructions
-                    )
-                else:
-                    xml_result = ocr.process_receipt(
-                        temp_file_path,
-                        output_format='xml',
-                        additional_instructions=request.instructions
-                    )
-                    result = convert_xml_to_csv(xml_result)
-
-                return ReceiptResponse(
-                    success=True,
-                    data=result,
-                    format=request.format,
-                    model=request.model,
-                    fallbackUsed=ocr.last_used_fallback,
-                    keyType=ocr.last_used_key_label
-                )
+        try:
+            upload = await spool_upload(request.stream())
+        except UploadTooLargeError as exc:
+            raise HTTPException(status_code=413, detail=str(exc)) from exc
+
+        if upload.size == 0:
+            upload.close()
+            raise HTTPException(status_code=400, detail="画像データが空です")
 
-            finally:
-                if temp_file_path.exists():
-                    temp_file_path.unlink()
+        logger.debug("📥 Raw body spooled: {} bytes, sha256={}", upload.size, upload.sha256)
 
+        if instructions:
+            logger.info("🗒️ Received additional instructions (raw): {}", instructions.strip())
+
+        try:
+            return await _admit_and_run(
+                upload.file,
+                model,
+                output_format,
+                instructions,
+                priority,
+                content_sha256=upload.sha256,
+                persist=persist,
+                uploader=uploader,
+                filename=filename,
+                skip_duplicates=skip_duplicates
+            )
         except HTTPException:
             raise
         except Exception as e:
             logger.exception("Processing failed")
-            return ReceiptResponse(success=False, format=request.format, model=request.model, error=str(e))
+            return ReceiptResponse(
+                success=False,
+                format=output_format,
+                model=model,
+                error=str(e),
+                contentSha256=upload.sha256
+            )
+        finally:
+            upload.close()
+
+    async def _receive_capture(websocket: WebSocket) -> dict:
+        message = await asyncio.wait_for(websocket.receive(), CAPTURE_IDLE_SECONDS)
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        return message
+
+    def _capture_command(message: dict) -> Optional[str]:
+        try:
+            payload = json.loads(message.get("text") or "")
+        except ValueError:
+            return None
+        return payload.get("type") if isinstance(payload, dict) else None
+
+    async def _close_capture(websocket: WebSocket, error: str, code: int = 1008, **extra) -> None:
+        await websocket.send_json({"type": "error", "error": error, **extra})
+        await websocket.close(code=code)
+
+    @app.websocket("/ws/capture")
+    async def capture_best_frame(
+        websocket: WebSocket,
+        model: str = Query(default="gemini/gemini-2.5-flash", description="使用するAIモデル"),
+        format: str = Query(default="xml", description="出力形式 (xml/csv)"),
+        instructions: Optional[str] = Query(default=None, description="追加の解析指示"),
+        persist: bool = Query(default=False, description="結果をデータベースに保存する"),
+        uploader: Optional[str] = Query(default=None, description="保存時のアップローダー"),
+        filename: Optional[str] = Query(default=None, description="保存時のファイル名"),
+        skip_duplicates: bool = Query(default=False, description="登録済みの画像ならLLMを呼ばずに返す"),
+        priority: str = Query(default=INTERACTIVE, description="処理の優先レーン (interactive/bulk)"),
+    ):
+        """Score a burst of preview frames, then OCR only the full-resolution copy of the best one.
+
+        1. binary preview frames -> ``{"type": "score", ...}`` for each
+        2. ``{"type": "select"}`` (or the frame cap) -> ``{"type": "best", "frame": n, ...}``
+        3. frame ``n`` at full resolution as binary chunks, then ``{"type": "end"}``
+           -> ``{"type": "result", ...}`` with the ReceiptResponse fields
+        """
+        await websocket.accept()
+        if format not in ['xml', 'csv']:
+            await _close_capture(websocket, "formatは 'xml' または 'csv' を指定してください")
+            return
+        if priority not in scheduler.lanes:
+            await _close_capture(
+                websocket,
+                f"priorityは {' / '.join(repr(lane) for lane in scheduler.lanes)} のいずれかを指定してください"
+            )
+            return
+
+        burst = FrameBurst()
+        upload = None
+        try:
+            while not burst.full:
+                message = await _receive_capture(websocket)
+                if message.get("bytes") is not None:
+                    index = burst.next_index()
+                    try:
+                        score = await run_in_threadpool(score_frame, message["bytes"], index)
+                    except FrameError as exc:
+                        await websocket.send_json({"type": "score", "frame": index, "error": str(exc)})
+                        continue
+                    burst.offer(score)
+                    await websocket.send_json({"type": "score", **score.to_response(), "bestFrame": burst.best.index})
+                elif _capture_command(message) == "select":
+                    break
+                else:
+                    await _close_capture(websocket, "プレビューフレーム（バイナリ）または select を送信してください")
+                    return
+
+            best = burst.best
+            if best is None or best.score <= 0:
+                await _close_capture(
+                    websocket,
+                    "レシートを読み取れるフレームがありませんでした。明るい場所でピントを合わせて撮影し直してください",
+                    frames=burst.frames
+                )
+                return
+            logger.info(
+                "🎞️ Best capture frame {}/{} (score={:.3f}, sharpness={:.0f})",
+                best.index + 1, burst.frames, best.score, best.sharpness
+            )
+            await websocket.send_json({"type": "best", **best.to_response(), "frames": burst.frames})
+
+            async def _full_resolution_chunks():
+                while True:
+                    message = await _receive_capture(websocket)
+                    if message.get("bytes") is not None:
+                        yield message["bytes"]
+                    elif _capture_command(message) == "end":
+                        return
+                    else:
+                        raise ValueError("フル解像度の画像（バイナリ）と end を送信してください")
+
+            try:
+                upload = await spool_upload(_full_resolution_chunks())
+            except UploadTooLargeError as exc:
+                await _close_capture(websocket, str(exc), code=1009)
+                return
+            except ValueError as exc:
+                await _close_capture(websocket, str(exc))
+                return
+            if upload.size == 0:
+                await _close_capture(websocket, "画像データが空です")
+                return
+
+            logger.debug("📥 Capture frame spooled: {} bytes, sha256={}", upload.size, upload.sha256)
+            try:
+                response = await _admit_and_run(
+                    upload.file,
+                    model,
+                    format,
+                    instructions,
+                    priority,
+                    content_sha256=upload.sha256,
+                    persist=persist,
+                    uploader=uploader,
+                    filename=filename,
+                    skip_duplicates=skip_duplicates
+                )
+            except HTTPException as exc:
+                await _close_capture(
+                    websocket, str(exc.detail), code=1013 if exc.status_code == 429 else 1008, status=exc.status_code
+                )
+                return
+            except Exception as e:
+                logger.exception("Processing failed")
+                response = ReceiptResponse(
+                    success=False,
+                    format=format,
+                    model=model,
+                    error=str(e),
+                    contentSha256=upload.sha256
+                )
+            await websocket.send_json({"type": "result", "frame": best.index, **response.model_dump()})
+            await websocket.close()
+        except asyncio.TimeoutError:
+            await _close_capture(websocket, f"{CAPTURE_IDLE_SECONDS:.0f} 秒間データが届かなかったため切断しました")
+        except WebSocketDisconnect:
+            logger.debug("📴 Capture client disconnected after {} frames", burst.frames)
+        finally:
+            if upload is not None:
+                upload.close()
 
     return app
 
@@ -254,13 +710,24 @@ def run_server(host: str = "0.0.0.0", port: int = 8000, reload: bool = False):
 
     setup_environment()
 
-    snapshot = sync_categories_with_database()
-    if snapshot is None:
-        snapshot = get_categories_xml(refresh=True)
-    else:
-        # Ensure subsequent lookups use the latest data from the database cache
-        get_categories_xml(refresh=True)
-    _log_category_snapshot(snapshot)
+    if np is None and PREFLIGHT_ENABLED:
+        logger.warning("⚠️ numpy がインストールされていないため、OCR 前の画質チェックを無効化しています")
+    if np is None and CROP_ENABLED:
+        logger.warning("⚠️ numpy がインストールされていないため、レシートの切り抜きを無効化しています")
+
+    # Serve from the last-known (or bundled) snapshot while the database sync runs
+    snapshot = load_category_snapshot()
+    if snapshot:
+        category_count, subcategory_count = _category_stats(snapshot)
+        logger.info(
+            "📦 カテゴリスナップショットを読み込みました: カテゴリ {} 件 / サブカテゴリ {} 件",
+            category_count,
+            subcategory_count,
+        )
+    start_background_sync(on_complete=_log_category_snapshot)
+    start_background_load()
+    start_memo_load()
+    start_usage_flusher()
 
     app = create_app()
 
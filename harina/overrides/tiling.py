@@ -0,0 +1,161 @@
+"""Split very tall receipt photos into overlapping bands and merge the per-band XML."""
+
+from __future__ import annotations
+
+import base64
+import binascii
+import io
+import os
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+from PIL import Image
+
+TILING_ENABLED = os.environ.get("HARINA_TILING_ENABLED", "1").lower() not in {"0", "false", "no"}
+# 高さ / 幅 がこの値を超える画像を帯に分割する
+TILE_MIN_ASPECT = float(os.environ.get("HARINA_TILE_MIN_ASPECT", "3.0"))
+# 1 帯あたりの高さ（幅に対する倍率）と、隣の帯と重ねる割合
+TILE_BAND_ASPECT = float(os.environ.get("HARINA_TILE_BAND_ASPECT", "1.6"))
+TILE_OVERLAP = min(0.5, max(0.0, float(os.environ.get("HARINA_TILE_OVERLAP", "0.15"))))
+TILE_MAX_BANDS = max(2, int(os.environ.get("HARINA_TILE_MAX_BANDS", "8")))
+TILE_CONCURRENCY = max(1, int(os.environ.get("HARINA_TILE_CONCURRENCY", "4")))
+
+# JPEG のヘッダー（EXIF 含む）を読むのに十分な BASE64 の先頭部分
+_HEADER_PEEK_CHARS = 128 * 1024
+
+_HEADER_SECTIONS = ("store_info", "transaction_info")
+_FOOTER_SECTIONS = ("totals", "payment_info")
+_NAME_NOISE = re.compile(r"[\s　・\-－ー*＊]+")
+# EXIF Orientation が 90°/270° 回転を示す値
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+@dataclass(frozen=True)
+class EncodedTiles:
+    """A tall receipt already split and JPEG-encoded, so its decoded pixels can be dropped."""
+
+    size: Tuple[int, int]
+    bands: List[str]
+    # 照合の再問い合わせ用に全体を符号化したもの（照合しない場合は None）
+    whole: Optional[str] = None
+
+
+def needs_tiling(size: Tuple[int, int]) -> bool:
+    width, height = size
+    return width > 0 and height / width > TILE_MIN_ASPECT
+
+
+def display_size(image: Image.Image) -> Tuple[int, int]:
+    """Size as the photo is meant to be viewed, read from EXIF without decoding pixels."""
+    width, height = image.size
+    try:
+        orientation = image.getexif().get(0x0112)
+    except Exception:  # noqa: BLE001 - broken EXIF should not block OCR
+        orientation = None
+    return (height, width) if orientation in _ROTATED_ORIENTATIONS else (width, height)
+
+
+def peek_base64_size(image_base64: str) -> Optional[Tuple[int, int]]:
+    """Read the pixel size from the start of a base64 image without decoding the whole payload."""
+    head = image_base64[: _HEADER_PEEK_CHARS - _HEADER_PEEK_CHARS % 4]
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(head))) as image:
+            return display_size(image)
+    except (binascii.Error, OSError, ValueError):
+        return None
+
+
+def band_boxes(size: Tuple[int, int]) -> List[Tuple[int, int, int, int]]:
+    """Crop boxes for overlapping horizontal bands covering the whole image top to bottom."""
+    width, height = size
+    band_height = int(width * TILE_BAND_ASPECT)
+    stride = int(band_height * (1 - TILE_OVERLAP))
+    count = max(2, -(-(height - band_height) // max(stride, 1)) + 1)
+    if count > TILE_MAX_BANDS:
+        # 帯の数を抑えるため、重なり率は保ったまま帯を縦に伸ばす
+        count = TILE_MAX_BANDS
+        band_height = int(height / (count - (count - 1) * TILE_OVERLAP))
+        stride = int(band_height * (1 - TILE_OVERLAP))
+    boxes = []
+    for index in range(count):
+        top = min(index * stride, height - band_height)
+        boxes.append((0, top, width, top + band_height if index < count - 1 else height))
+    return boxes
+
+
+def split_bands(image: Image.Image) -> List[Image.Image]:
+    return [image.crop(box) for box in band_boxes(image.size)]
+
+
+def band_instructions(index: int, count: int) -> str:
+    position = "先頭" if index == 0 else "末尾" if index == count - 1 else "途中"
+    return "\n".join(
+        [
+            f"この画像は縦に長いレシートを分割した {index + 1}/{count} 枚目（{position}部分）です。",
+            "隣の画像と上下が少し重なっています。画像内で読み取れる商品行のみを抽出し、",
+            "上端・下端で文字が切れている行は含めないでください。",
+            "写っていない店舗情報・合計・支払い情報は空にしてください。",
+        ]
+    )
+
+
+def _has_content(element: Optional[ET.Element]) -> bool:
+    return element is not None and any((node.text or "").strip() for node in element.iter())
+
+
+def _item_key(item: ET.Element) -> Tuple[str, str]:
+    name = item.findtext("n") or item.findtext("name") or ""
+    price = re.sub(r"[^\d.\-]", "", item.findtext("total_price") or "")
+    return _NAME_NOISE.sub("", name).lower(), price
+
+
+def _overlap_length(previous: Sequence[Tuple[str, str]], current: Sequence[Tuple[str, str]]) -> int:
+    """Longest run that ends ``previous`` and starts ``current`` (the rows both bands saw)."""
+    for length in range(min(len(previous), len(current)), 0, -1):
+        if list(previous[-length:]) == list(current[:length]):
+            return length
+    return 0
+
+
+def merge_band_xml(parts: Sequence[str]) -> str:
+    """Merge per-band receipt XML: header from the first band, totals from the last, items de-overlapped."""
+    roots = [ET.fromstring(part.strip()) for part in parts]
+    merged = ET.Element(roots[0].tag, roots[0].attrib)
+
+    def first_with(tag: str, candidates: Sequence[ET.Element]) -> Optional[ET.Element]:
+        for root in candidates:
+            if _has_content(root.find(tag)):
+                return root.find(tag)
+        return candidates[0].find(tag)
+
+    for tag in _HEADER_SECTIONS:
+        section = first_with(tag, roots)
+        if section is not None:
+            merged.append(section)
+
+    items = ET.SubElement(merged, "items")
+    previous_keys: List[Tuple[str, str]] = []
+    dropped = 0
+    for root in roots:
+        band_items = root.findall("./items/item")
+        keys = [_item_key(item) for item in band_items]
+        skip = _overlap_length(previous_keys, keys)
+        dropped += skip
+        items.extend(band_items[skip:])
+        previous_keys = keys
+
+    for tag in _FOOTER_SECTIONS:
+        section = first_with(tag, list(reversed(roots)))
+        if section is not None:
+            merged.append(section)
+
+    known = set(_HEADER_SECTIONS) | set(_FOOTER_SECTIONS) | {"items"}
+    for child in roots[0]:
+        if child.tag not in known:
+            merged.append(child)
+
+    logger.info("🧩 Merged {} bands: {} items ({} overlapping rows dropped)", len(roots), len(items), dropped)
+    return ET.tostring(merged, encoding="unicode")
@@ -0,0 +1,175 @@
+"""Upload helpers: size caps, disk spooling and hashing of request bodies."""
+
+from __future__ import annotations
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import IO, AsyncIterator, Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+_MB = 1024 * 1024
+
+MAX_UPLOAD_BYTES = int(float(os.environ.get("HARINA_MAX_UPLOAD_MB", "20")) * _MB)
+SPOOL_THRESHOLD_BYTES = int(float(os.environ.get("HARINA_UPLOAD_SPOOL_MB", "1")) * _MB)
+UPLOAD_CHUNK_BYTES = 256 * 1024
+
+BASE64_PASSTHROUGH = os.environ.get("HARINA_BASE64_PASSTHROUGH", "1").lower() not in {"0", "false", "no"}
+
+_BASE64_BODY = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+_JPEG_SOI = b"\xff\xd8\xff"
+
+# Request bodies carry multipart boundaries or base64 (4/3 inflation) on top of the image itself
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024
+
+
+class UploadTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured byte cap."""
+
+    def __init__(self, limit: int):
+        super().__init__(f"アップロードサイズが上限 {limit // _MB}MB を超えています")
+        self.limit = limit
+
+
+@dataclass
+class SpooledUpload:
+    """Upload body in a spooled temp file together with its size and digest."""
+
+    file: IO[bytes]
+    size: int
+    sha256: str
+
+    def close(self) -> None:
+        self.file.close()
+
+
+async def hash_upload(
+    upload: UploadFile,
+    max_bytes: int = MAX_UPLOAD_BYTES,
+    chunk_size: int = UPLOAD_CHUNK_BYTES,
+) -> SpooledUpload:
+    """Hash a multipart file in place and rewind it.
+
+    Starlette has already spooled the part into its own temporary file while
+    parsing the form, so the bytes are read once for the digest and size check
+    instead of being copied into a second spool.
+    """
+
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLargeError(max_bytes)
+        digest.update(chunk)
+    await upload.seek(0)
+    return SpooledUpload(file=upload.file, size=size, sha256=digest.hexdigest())
+
+
+async def spool_upload(
+    chunks: AsyncIterator[bytes],
+    max_bytes: int = MAX_UPLOAD_BYTES,
+    spool_threshold: int = SPOOL_THRESHOLD_BYTES,
+) -> SpooledUpload:
+    """Copy ``chunks`` into memory (spilling to disk past ``spool_threshold``) while hashing them.
+
+    Raises :class:`UploadTooLargeError` as soon as more than ``max_bytes`` have been read.
+    """
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=spool_threshold, suffix=".jpg")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLargeError(max_bytes)
+            digest.update(chunk)
+            spooled.write(chunk)
+    except BaseException:
+        spooled.close()
+        raise
+
+    spooled.seek(0)
+    return SpooledUpload(file=spooled, size=size, sha256=digest.hexdigest())
+
+
+def is_jpeg_base64(payload: str, max_bytes: int = MAX_UPLOAD_BYTES) -> bool:
+    """Return True when ``payload`` is canonical base64 of a JPEG, checked without decoding it all."""
+
+    if not payload or len(payload) % 4 or len(payload) // 4 * 3 > max_bytes:
+        return False
+    try:
+        head = base64.b64decode(payload[:4], validate=True)
+    except binascii.Error:
+        return False
+    if not head.startswith(_JPEG_SOI):
+        return False
+    return _BASE64_BODY.fullmatch(payload) is not None
+
+
+class RequestBodyTooLarge(HTTPException):
+    """413 raised from ``receive`` so FastAPI's body parsing re-raises it untouched."""
+
+    def __init__(self, limit: int):
+        super().__init__(
+            status_code=413,
+            detail=f"リクエストサイズが上限 {limit // _MB}MB を超えています",
+        )
+
+
+class RequestSizeLimitMiddleware:
+    """ASGI middleware that answers 413 before the body is buffered by form/JSON parsing.
+
+    ``Content-Length`` is checked up front; chunked bodies are counted as they stream in.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") not in {"POST", "PUT", "PATCH"}:
+            await self.app(scope, receive, send)
+            return
+
+        declared = _content_length(scope)
+        if declared is not None and declared > self.max_bytes:
+            error = RequestBodyTooLarge(self.max_bytes)
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise RequestBodyTooLarge(self.max_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def _content_length(scope) -> Optional[int]:
+    for name, value in scope.get("headers") or []:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
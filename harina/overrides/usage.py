@@ -0,0 +1,390 @@
+"""Token, latency and cost accounting for LLM calls.
+
+Every completion attempt is recorded in memory; hourly aggregates per
+(model, key, uploader) are flushed to Postgres in batches and only the last
+``HARINA_USAGE_MEMORY_HOURS`` of them stay in memory afterwards. A one-minute
+window of recent calls backs the ``lastMinute`` figures of ``/usage``.
+"""
+
+from __future__ import annotations
+
+import atexit
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock, Thread
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from .database import database_dsn, load_psycopg
+
+USAGE_FLUSH_SECONDS = float(os.environ.get("HARINA_USAGE_FLUSH_SECONDS", "30"))
+USAGE_FLUSH_BATCH = int(os.environ.get("HARINA_USAGE_FLUSH_BATCH", "200"))
+# 書き出し済みの時間別集計をメモリに残す時間（DB に接続できないときの /usage の参照範囲）
+USAGE_MEMORY_HOURS = float(os.environ.get("HARINA_USAGE_MEMORY_HOURS", "48"))
+# /usage の lastMinute 用に保持する直近の呼び出し履歴の長さ
+_RECENT_WINDOW_SECONDS = 60.0
+
+UsageKey = Tuple[datetime, str, str, str]
+
+
+@dataclass
+class UsageRecord:
+    """One completion attempt."""
+
+    model: str
+    key_label: str
+    uploader: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    image_tokens: int = 0
+    latency_ms: float = 0.0
+    cost_usd: float = 0.0
+    success: bool = True
+    timestamp: float = field(default_factory=time.time)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def to_response(self) -> Dict[str, Any]:
+        return {
+            "promptTokens": self.prompt_tokens,
+            "completionTokens": self.completion_tokens,
+            "imageTokens": self.image_tokens,
+            "latencyMs": round(self.latency_ms, 1),
+            "costUsd": round(self.cost_usd, 6),
+        }
+
+
+@dataclass
+class UsageTotals:
+    calls: int = 0
+    failures: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    image_tokens: int = 0
+    latency_ms: float = 0.0
+    cost_usd: float = 0.0
+
+    def add(self, record: UsageRecord) -> None:
+        self.calls += 1
+        self.failures += 0 if record.success else 1
+        self.prompt_tokens += record.prompt_tokens
+        self.completion_tokens += record.completion_tokens
+        self.image_tokens += record.image_tokens
+        self.latency_ms += record.latency_ms
+        self.cost_usd += record.cost_usd
+
+    def merge(self, other: "UsageTotals") -> None:
+        self.calls += other.calls
+        self.failures += other.failures
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.image_tokens += other.image_tokens
+        self.latency_ms += other.latency_ms
+        self.cost_usd += other.cost_usd
+
+    def to_response(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "promptTokens": self.prompt_tokens,
+            "completionTokens": self.completion_tokens,
+            "imageTokens": self.image_tokens,
+            "avgLatencyMs": round(self.latency_ms / self.calls, 1) if self.calls else 0.0,
+            "costUsd": round(self.cost_usd, 6),
+        }
+
+
+def _as_int(value: Any) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _field(container: Any, name: str) -> Any:
+    if container is None:
+        return None
+    if isinstance(container, dict):
+        return container.get(name)
+    return getattr(container, name, None)
+
+
+def usage_from_response(response: Any) -> Tuple[int, int, int]:
+    """(prompt, completion, image) tokens from a litellm response; missing fields count as 0."""
+    usage = _field(response, "usage")
+    details = _field(usage, "prompt_tokens_details")
+    return (
+        _as_int(_field(usage, "prompt_tokens")),
+        _as_int(_field(usage, "completion_tokens")),
+        _as_int(_field(details, "image_tokens")),
+    )
+
+
+def combine_usage(records: List[Optional[UsageRecord]], parallel: bool = False) -> Optional[UsageRecord]:
+    """Sum tokens and cost of several calls made for one receipt.
+
+    Latency is the slowest call when they ran in ``parallel`` (tiled bands), else the sum.
+    """
+    present = [record for record in records if record is not None]
+    if not present:
+        return None
+    latencies = [record.latency_ms for record in present]
+    return UsageRecord(
+        model=present[0].model,
+        key_label=present[0].key_label,
+        uploader=present[0].uploader,
+        prompt_tokens=sum(record.prompt_tokens for record in present),
+        completion_tokens=sum(record.completion_tokens for record in present),
+        image_tokens=sum(record.image_tokens for record in present),
+        latency_ms=max(latencies) if parallel else sum(latencies),
+        cost_usd=sum(record.cost_usd for record in present),
+    )
+
+
+def _hour(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+class UsageTracker:
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._totals: Dict[UsageKey, UsageTotals] = {}
+        # プロセス起動からの累計。時間別集計を間引いても一括処理の最終集計は変わらない
+        self._lifetime: Dict[Tuple[str, str, str], UsageTotals] = {}
+        self._pending: Dict[UsageKey, UsageTotals] = {}
+        self._pending_records = 0
+        self._recent: Deque[UsageRecord] = deque()
+        self._flush_requested = Event()
+
+    def record(self, record: UsageRecord) -> None:
+        key = (_hour(record.timestamp), record.model, record.key_label, record.uploader)
+        with self._lock:
+            self._totals.setdefault(key, UsageTotals()).add(record)
+            self._lifetime.setdefault(key[1:], UsageTotals()).add(record)
+            self._pending.setdefault(key, UsageTotals()).add(record)
+            self._pending_records += 1
+            self._recent.append(record)
+            self._trim_recent(record.timestamp)
+            if self._pending_records >= USAGE_FLUSH_BATCH:
+                self._flush_requested.set()
+
+    def _trim_recent(self, now: float) -> None:
+        while self._recent and now - self._recent[0].timestamp > _RECENT_WINDOW_SECONDS:
+            self._recent.popleft()
+
+    def _prune(self, now: float) -> None:
+        """Drop hourly totals older than ``USAGE_MEMORY_HOURS`` that have already been flushed."""
+        cutoff = _hour(now - USAGE_MEMORY_HOURS * 3600)
+        for key in [key for key in self._totals if key[0] < cutoff and key not in self._pending]:
+            del self._totals[key]
+
+    # --- in-memory aggregates ----------------------------------------------------
+
+    def recent(
+        self,
+        window_seconds: float = 60.0,
+        model: Optional[str] = None,
+        key_label: Optional[str] = None,
+        uploader: Optional[str] = None,
+    ) -> UsageTotals:
+        """Totals over the last ``window_seconds`` (at most a minute), optionally filtered."""
+        now = time.time()
+        totals = UsageTotals()
+        with self._lock:
+            self._trim_recent(now)
+            for record in reversed(self._recent):
+                if now - record.timestamp > window_seconds:
+                    break
+                if model and record.model != model:
+                    continue
+                if key_label and record.key_label != key_label:
+                    continue
+                if uploader and record.uploader != uploader:
+                    continue
+                totals.add(record)
+        return totals
+
+    def totals(self, since: Optional[datetime] = None) -> Dict[Tuple[str, str, str], UsageTotals]:
+        """In-process totals per (model, key, uploader) since ``since`` (hour granularity).
+
+        Without ``since`` these are the totals since the process started; with it, only
+        the last ``USAGE_MEMORY_HOURS`` are available.
+        """
+        grouped: Dict[Tuple[str, str, str], UsageTotals] = {}
+        with self._lock:
+            if since is None:
+                for group, totals in self._lifetime.items():
+                    grouped.setdefault(group, UsageTotals()).merge(totals)
+                return grouped
+            for (hour, model, key_label, uploader), totals in self._totals.items():
+                if hour < since.replace(minute=0, second=0, microsecond=0):
+                    continue
+                grouped.setdefault((model, key_label, uploader), UsageTotals()).merge(totals)
+        return grouped
+
+    # --- persistence -------------------------------------------------------------
+
+    def flush(self) -> int:
+        """Upsert pending hourly deltas into ``llm_usage``; returns the number of rows written."""
+        with self._lock:
+            self._prune(time.time())
+            pending, self._pending = self._pending, {}
+            self._pending_records = 0
+            self._flush_requested.clear()
+        if not pending:
+            return 0
+
+        try:
+            conn = _connect()
+            if conn is None:
+                return 0
+            with conn, conn.cursor() as cur:
+                _ensure_schema(cur)
+                cur.executemany(
+                    """
+                    INSERT INTO llm_usage (
+                        bucket_start, model, key_label, uploader, calls, failures,
+                        prompt_tokens, completion_tokens, image_tokens, latency_ms_total, cost_usd
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (bucket_start, model, key_label, uploader) DO UPDATE SET
+                        calls = llm_usage.calls + EXCLUDED.calls,
+                        failures = llm_usage.failures + EXCLUDED.failures,
+                        prompt_tokens = llm_usage.prompt_tokens + EXCLUDED.prompt_tokens,
+                        completion_tokens = llm_usage.completion_tokens + EXCLUDED.completion_tokens,
+                        image_tokens = llm_usage.image_tokens + EXCLUDED.image_tokens,
+                        latency_ms_total = llm_usage.latency_ms_total + EXCLUDED.latency_ms_total,
+                        cost_usd = llm_usage.cost_usd + EXCLUDED.cost_usd
+                    """,
+                    [
+                        (
+                            hour,
+                            model,
+                            key_label,
+                            uploader,
+                            totals.calls,
+                            totals.failures,
+                            totals.prompt_tokens,
+                            totals.completion_tokens,
+                            totals.image_tokens,
+                            totals.latency_ms,
+                            totals.cost_usd,
+                        )
+                        for (hour, model, key_label, uploader), totals in pending.items()
+                    ],
+                )
+        except Exception as exc:  # pragma: no cover - keep the deltas for the next attempt
+            logger.warning("Failed to flush LLM usage ({} rows), will retry: {}", len(pending), exc)
+            with self._lock:
+                for key, totals in pending.items():
+                    self._pending.setdefault(key, UsageTotals()).merge(totals)
+            return 0
+        return len(pending)
+
+    def wait_for_flush(self, timeout: float) -> None:
+        self._flush_requested.wait(timeout)
+
+
+_TRACKER = UsageTracker()
+
+
+def get_usage_tracker() -> UsageTracker:
+    return _TRACKER
+
+
+def _ensure_schema(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            bucket_start TIMESTAMPTZ NOT NULL,
+            model VARCHAR(100) NOT NULL,
+            key_label VARCHAR(20) NOT NULL,
+            uploader VARCHAR(50) NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens BIGINT NOT NULL DEFAULT 0,
+            completion_tokens BIGINT NOT NULL DEFAULT 0,
+            image_tokens BIGINT NOT NULL DEFAULT 0,
+            latency_ms_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+            cost_usd NUMERIC(12, 6) NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket_start, model, key_label, uploader)
+        );
+        """
+    )
+
+
+def _connect():
+    dsn = database_dsn()
+    if not dsn:
+        return None
+    psycopg = load_psycopg()
+    if psycopg is None:
+        return None
+    return psycopg.connect(dsn, autocommit=True)
+
+
+def start_usage_flusher() -> Thread:
+    """Flush usage every ``HARINA_USAGE_FLUSH_SECONDS`` (or sooner once a batch fills up)."""
+
+    def _run() -> None:
+        while True:
+            _TRACKER.wait_for_flush(USAGE_FLUSH_SECONDS)
+            _TRACKER.flush()
+
+    atexit.register(_TRACKER.flush)
+    thread = Thread(target=_run, name="harina-usage-flush", daemon=True)
+    thread.start()
+    return thread
+
+
+def query_usage(hours: float) -> List[Dict[str, Any]]:
+    """Usage per (model, key, uploader) over the last ``hours``, from Postgres when available."""
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    _TRACKER.flush()
+
+    grouped: Optional[Dict[Tuple[str, str, str], UsageTotals]] = None
+    try:
+        conn = _connect()
+        if conn is not None:
+            with conn, conn.cursor() as cur:
+                _ensure_schema(cur)
+                cur.execute(
+                    """
+                    SELECT model, key_label, uploader, SUM(calls), SUM(failures), SUM(prompt_tokens),
+                           SUM(completion_tokens), SUM(image_tokens), SUM(latency_ms_total), SUM(cost_usd)
+                    FROM llm_usage
+                    WHERE bucket_start >= date_trunc('hour', %s::timestamptz)
+                    GROUP BY model, key_label, uploader
+                    """,
+                    (since,),
+                )
+                grouped = {
+                    (model, key_label, uploader): UsageTotals(
+                        calls=int(calls),
+                        failures=int(failures),
+                        prompt_tokens=int(prompt),
+                        completion_tokens=int(completion),
+                        image_tokens=int(image),
+                        latency_ms=float(latency),
+                        cost_usd=float(cost),
+                    )
+                    for model, key_label, uploader, calls, failures, prompt, completion, image, latency, cost
+                    in cur.fetchall()
+                }
+    except Exception as exc:  # pragma: no cover - fall back to this process's numbers
+        logger.warning("Failed to query LLM usage from the database: {}", exc)
+
+    if grouped is None:
+        grouped = _TRACKER.totals(since)
+
+    rows = [
+        {"model": model, "keyType": key_label, "uploader": uploader, **totals.to_response()}
+        for (model, key_label, uploader), totals in grouped.items()
+    ]
+    rows.sort(key=lambda row: row["costUsd"], reverse=True)
+    return rows
@@ -0,0 +1,175 @@
+import contextlib
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from harina.duplicates import DuplicateIndex, duplicate_key, image_dhash
+
+
+def _flip_bits(value: int, count: int, seed: int) -> int:
+    for bit in random.Random(seed).sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def test_find_returns_newest_receipt_with_same_key():
+    index = DuplicateIndex(max_distance=3)
+    key = duplicate_key("株式会社 サンプル商店", "2024-05-01", 1200)
+    index.add(1, key)
+    index.add(7, key)
+    index.add(3, duplicate_key("別の店", "2024-05-01", 1200))
+
+    match = index.find(key=key)
+
+    assert (match.receipt_id, match.reason) == (7, "key")
+    assert index.find(key=key, exclude=7).receipt_id == 1
+
+
+def test_store_name_affixes_do_not_change_the_key():
+    assert duplicate_key("（株）サンプル 商店", "2024-05-01", "1200.00") == duplicate_key("サンプル商店", "2024-05-01", 1200)
+
+
+@pytest.mark.parametrize("max_distance", [0, 3, 15])
+def test_every_image_within_max_distance_is_found(max_distance):
+    index = DuplicateIndex(max_distance=max_distance)
+    stored = 0x9E3779B97F4A7C15
+    index.add(1, None, stored)
+
+    for distance in range(max_distance + 1):
+        for seed in range(20):
+            match = index.find(image_hash=_flip_bits(stored, distance, seed))
+            assert match is not None and match.distance == distance
+
+
+def test_image_beyond_max_distance_is_not_matched():
+    index = DuplicateIndex(max_distance=3)
+    stored = 0x0123456789ABCDEF
+    index.add(1, None, stored)
+
+    assert index.find(image_hash=_flip_bits(stored, 4, 0)) is None
+    # インデックスの閾値より大きい距離を指定しても、閾値で打ち切られる
+    assert index.find(image_hash=_flip_bits(stored, 4, 0), max_distance=10) is None
+
+
+def test_closest_image_wins():
+    index = DuplicateIndex(max_distance=3)
+    stored = 0x0F0F0F0F0F0F0F0F
+    index.add(1, None, _flip_bits(stored, 2, 1))
+    index.add(2, None, _flip_bits(stored, 1, 2))
+
+    assert index.find(image_hash=stored).receipt_id == 2
+
+
+def test_remove_drops_key_and_hash():
+    index = DuplicateIndex(max_distance=3)
+    key = duplicate_key("店", "2024-05-01", 100)
+    index.add(1, key, 0xFFFF)
+    index.remove(1)
+
+    assert index.find(key=key, image_hash=0xFFFF) is None
+    assert len(index) == 0
+
+
+def test_max_distance_is_clamped():
+    assert DuplicateIndex(max_distance=40).max_distance == 15
+
+
+def test_group_page_orders_larger_groups_first():
+    index = DuplicateIndex()
+    pair = duplicate_key("A", "2024-05-01", 100)
+    triple = duplicate_key("B", "2024-05-01", 100)
+    for receipt_id in (1, 2):
+        index.add(receipt_id, pair)
+    for receipt_id in (3, 4, 5):
+        index.add(receipt_id, triple)
+    index.add(6, duplicate_key("C", "2024-05-01", 100))
+
+    assert index.group_page(0, 10) == (2, [[5, 4, 3], [2, 1]])
+
+
+def test_dhash_of_resized_copy_is_close():
+    image = Image.new("L", (640, 480), 200)
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 640, 80):
+        draw.rectangle((x, 60 + x // 4, x + 40, 400 - x // 8), fill=30)
+
+    original = image_dhash(image)
+    resized = image_dhash(image.resize((320, 240)))
+
+    assert bin(original ^ resized).count("1") <= 3
+
+
+class _Cursor:
+    def __init__(self, rows, on_execute):
+        self.rows = rows
+        self.on_execute = on_execute
+        self.itersize = None
+        self.selected = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params):
+        self.on_execute()
+        self.selected = [row for row in self.rows if row[0] > params[0]]
+
+    def __iter__(self):
+        return iter(self.selected)
+
+
+class _Connection:
+    """Serves ``rows`` of (id, store_name, transaction_date, total_amount, dhash) like the receipts query."""
+
+    def __init__(self, rows, on_execute=lambda: None):
+        self.rows = rows
+        self.on_execute = on_execute
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    def cursor(self, name=None):
+        return _Cursor(self.rows, self.on_execute)
+
+
+def test_refresh_only_reads_rows_after_the_watermark():
+    index = DuplicateIndex()
+    rows = [(1, "A", "2024-05-01", 100, None), (2, "B", "2024-05-01", 100, None)]
+    assert index.refresh(_Connection(rows)) == 2
+
+    rows.append((3, "A", "2024-05-01", 100, None))
+    assert index.refresh(_Connection(rows)) == 1
+    assert index.find(key=duplicate_key("A", "2024-05-01", 100), exclude=3).receipt_id == 1
+
+
+def test_rebuild_drops_deleted_and_rekeys_edited_receipts():
+    index = DuplicateIndex()
+    index.refresh(_Connection([
+        (1, "A", "2024-05-01", 100, 0xFF),
+        (2, "A", "2024-05-01", 100, None),
+        (3, "B", "2024-05-01", 100, None),
+    ]))
+    assert index.group_page(0, 10)[0] == 1
+
+    # 1 は削除され、2 は金額が修正された
+    assert index.rebuild(_Connection([(2, "A", "2024-05-01", 120, None), (3, "B", "2024-05-01", 100, None)])) == 2
+
+    assert index.find(image_hash=0xFF) is None
+    assert index.find(key=duplicate_key("A", "2024-05-01", 100)) is None
+    assert index.find(key=duplicate_key("A", "2024-05-01", 120)).receipt_id == 2
+    assert index.group_page(0, 10) == (0, [])
+    assert len(index) == 2
+
+
+def test_rebuild_keeps_receipts_added_while_scanning():
+    index = DuplicateIndex()
+    index.refresh(_Connection([(1, "A", "2024-05-01", 100, None)]))
+    key = duplicate_key("C", "2024-05-02", 300)
+
+    index.rebuild(_Connection([(1, "A", "2024-05-01", 100, None)], on_execute=lambda: index.add(9, key, 0xABC)))
+
+    assert index.find(key=key).receipt_id == 9
+    assert index.find(image_hash=0xABC).receipt_id == 9
@@ -0,0 +1,46 @@
+from xml.etree import ElementTree as ET
+
+from harina.reconcile import find_issues
+
+
+def _receipt(items, subtotal="", tax="", total=""):
+    rows = "".join(
+        f"<item><n>商品{index}</n><quantity>{quantity}</quantity>"
+        f"<unit_price>{unit}</unit_price><total_price>{price}</total_price></item>"
+        for index, (quantity, unit, price) in enumerate(items)
+    )
+    return ET.fromstring(
+        f"<receipt><items>{rows}</items><totals><subtotal>{subtotal}</subtotal>"
+        f"<tax>{tax}</tax><total>{total}</total></totals></receipt>"
+    )
+
+
+def test_consistent_receipt_has_no_issues():
+    root = _receipt([(2, "100", "200"), (1, "¥1,000", "1,000")], subtotal="1200", tax="96", total="1296")
+
+    assert find_issues(root) == []
+
+
+def test_tax_inclusive_total_is_accepted():
+    assert find_issues(_receipt([(1, "500", "500")], subtotal="500", tax="45", total="500")) == []
+
+
+def test_rounding_within_tolerance_is_accepted():
+    assert find_issues(_receipt([(3, "33.3", "100")], subtotal="100", total="100")) == []
+
+
+def test_item_arithmetic_mismatch_points_at_the_item():
+    issues = find_issues(_receipt([(1, "100", "100"), (2, "150", "200")], subtotal="300", total="300"))
+
+    assert [issue.item for issue in issues] == [1]
+
+
+def test_subtotal_and_total_mismatches_are_receipt_level():
+    issues = find_issues(_receipt([(1, "100", "100")], subtotal="120", tax="10", total="200"))
+
+    assert [issue.item for issue in issues] == [None, None]
+
+
+def test_total_is_checked_against_items_without_subtotal():
+    assert len(find_issues(_receipt([(1, "100", "100")], total="300"))) == 1
+    assert find_issues(_receipt([(1, "100", "100")], tax="10", total="110")) == []
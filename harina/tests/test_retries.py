@@ -0,0 +1,67 @@
+import pytest
+
+from harina.retries import ErrorClass, classify, retry_after
+
+
+class _StatusError(Exception):
+    def __init__(self, status_code, message="", headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.litellm_response_headers = headers
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class ServiceUnavailableError(Exception):
+    pass
+
+
+@pytest.mark.parametrize(
+    "exc, expected",
+    [
+        (_StatusError(429, "Too many requests"), ErrorClass.RATE_LIMIT),
+        (RateLimitError("slow down"), ErrorClass.RATE_LIMIT),
+        (_StatusError(429, "Quota exceeded for metric"), ErrorClass.QUOTA),
+        (_StatusError(429, 'Quota exceeded for metric, "retryDelay": "20s"'), ErrorClass.RATE_LIMIT),
+        (_StatusError(429, 'GenerateRequestsPerDayPerProjectPerModel quota, "retryDelay": "20s"'), ErrorClass.QUOTA),
+        (TimeoutError(), ErrorClass.TRANSPORT),
+        (APIConnectionError("reset by peer"), ErrorClass.TRANSPORT),
+        (_StatusError(503, "backend error"), ErrorClass.SERVER),
+        (ServiceUnavailableError("try later"), ErrorClass.SERVER),
+        (_StatusError(400, "bad image"), ErrorClass.CLIENT),
+        (AuthenticationError("invalid key"), ErrorClass.CLIENT),
+        (ValueError("unexpected"), ErrorClass.UNKNOWN),
+    ],
+)
+def test_classify(exc, expected):
+    assert classify(exc) is expected
+
+
+def test_only_transient_classes_are_retryable():
+    # 日次クォータはリクエスト中に回復しないので再試行しない
+    assert {error_class for error_class in ErrorClass if error_class.retryable} == {
+        ErrorClass.RATE_LIMIT,
+        ErrorClass.SERVER,
+        ErrorClass.TRANSPORT,
+    }
+
+
+def test_retry_after_reads_header_then_message():
+    assert retry_after(_StatusError(429, headers={"retry-after": "7"})) == 7
+    assert retry_after(_StatusError(429, 'error: {"retryDelay": "12s"}')) == 12
+    assert retry_after(_StatusError(500, "no hint")) is None
+
+
+def test_unparseable_retry_after_header_is_ignored():
+    assert retry_after(_StatusError(429, headers={"Retry-After": "soon"})) is None
+    assert classify(_StatusError(400, "bad image", headers={"Retry-After": "soon"})) is ErrorClass.CLIENT
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from harina.scheduling import BULK, INTERACTIVE, AdmissionRejected, AdmissionScheduler, FairSemaphore, TokenBucket
+
+
+def test_token_bucket_allows_burst_then_rejects_long_waits():
+    bucket = TokenBucket(rate_per_second=1 / 60, burst=2)
+
+    assert bucket.reserve(max_wait=0) == 0
+    assert bucket.reserve(max_wait=0) == 0
+    with pytest.raises(AdmissionRejected) as excinfo:
+        bucket.reserve(max_wait=1)
+    assert excinfo.value.retry_after == pytest.approx(60, abs=1)
+
+
+def test_token_bucket_returns_wait_within_limit():
+    bucket = TokenBucket(rate_per_second=10, burst=1)
+    bucket.reserve(max_wait=0)
+
+    assert 0 < bucket.reserve(max_wait=1) <= 0.1
+
+
+def test_fair_semaphore_serves_heavier_lane_more_often():
+    async def scenario():
+        semaphore = FairSemaphore(limit=1, weights={INTERACTIVE: 4.0, BULK: 1.0})
+        await semaphore.acquire(BULK, timeout=1)
+        order = []
+
+        async def waiter(lane):
+            await semaphore.acquire(lane, timeout=5)
+            order.append(lane)
+            await asyncio.sleep(0)
+            semaphore.release()
+
+        tasks = [asyncio.create_task(waiter(BULK)) for _ in range(4)]
+        tasks += [asyncio.create_task(waiter(INTERACTIVE)) for _ in range(4)]
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        return order, semaphore.active
+
+    order, active = asyncio.run(scenario())
+
+    # 4:1 の重みでは、先に並んだ bulk より interactive が先に 3 件処理される
+    assert order == [INTERACTIVE, INTERACTIVE, INTERACTIVE, BULK, INTERACTIVE, BULK, BULK, BULK]
+    assert active == 0
+
+
+def test_admission_rejects_when_model_slot_wait_exceeds_limit():
+    async def scenario():
+        scheduler = AdmissionScheduler(model_limits={}, default_limit=1, rate_per_minute=0, max_wait=0.05)
+        async with scheduler.admit("model", "夫") as ticket:
+            assert ticket.lane == INTERACTIVE
+            with pytest.raises(AdmissionRejected):
+                async with scheduler.admit("model", "妻"):
+                    pass
+        return scheduler.snapshot()
+
+    snapshot = asyncio.run(scenario())
+
+    assert snapshot["model"]["active"] == 0
+    assert snapshot["model"]["waiting"] == {}
+
+
+def test_admission_rejects_unknown_lane():
+    async def scenario():
+        scheduler = AdmissionScheduler(rate_per_minute=0)
+        async with scheduler.admit("model", "夫", lane="urgent"):
+            pass
+
+    with pytest.raises(ValueError):
+        asyncio.run(scenario())
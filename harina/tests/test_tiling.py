@@ -0,0 +1,55 @@
+from xml.etree import ElementTree as ET
+
+from harina.tiling import merge_band_xml
+
+
+def _band(store, items, total=""):
+    rows = "".join(
+        f"<item><n>{name}</n><total_price>{price}</total_price></item>" for name, price in items
+    )
+    return (
+        f"<receipt><store_info><n>{store}</n></store_info><items>{rows}</items>"
+        f"<totals><total>{total}</total></totals></receipt>"
+    )
+
+
+def _names(xml):
+    root = ET.fromstring(xml)
+    return [(item.findtext("n"), item.findtext("total_price")) for item in root.findall("./items/item")]
+
+
+def test_overlapping_rows_are_kept_once():
+    merged = merge_band_xml([
+        _band("サンプル商店", [("牛乳", "198"), ("食パン", "158"), ("卵", "248")]),
+        _band("", [("食パン", "158"), ("卵", "248"), ("バナナ", "128")], total="732"),
+    ])
+
+    assert _names(merged) == [("牛乳", "198"), ("食パン", "158"), ("卵", "248"), ("バナナ", "128")]
+
+
+def test_header_comes_from_first_band_and_totals_from_last():
+    merged = ET.fromstring(merge_band_xml([
+        _band("サンプル商店", [("牛乳", "198")]),
+        _band("", [("バナナ", "128")], total="326"),
+    ]))
+
+    assert merged.findtext("store_info/n") == "サンプル商店"
+    assert merged.findtext("totals/total") == "326"
+
+
+def test_same_name_with_different_price_is_not_an_overlap():
+    merged = merge_band_xml([
+        _band("店", [("おにぎり", "120")]),
+        _band("", [("おにぎり", "150")]),
+    ])
+
+    assert _names(merged) == [("おにぎり", "120"), ("おにぎり", "150")]
+
+
+def test_repeated_purchase_inside_one_band_is_kept():
+    merged = merge_band_xml([
+        _band("店", [("コーヒー", "150"), ("コーヒー", "150")]),
+        _band("", [("水", "100")]),
+    ])
+
+    assert _names(merged) == [("コーヒー", "150"), ("コーヒー", "150"), ("水", "100")]